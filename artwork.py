@@ -0,0 +1,230 @@
+"""
+Cover art for what's playing, read from mpd once and kept on disk as thumbnails.
+
+mpd hands out artwork a chunk at a time, through albumart (a cover image in the track's directory) and readpicture
+(a picture embedded in the file itself). The first time a track plays we read its artwork, scale it down once to the
+sizes our clients show it at, and store the thumbnails under a hash of the original image, so an album whose every
+track embeds the same picture is stored once. Which image each directory and file has (or that it has none) is
+remembered too, so mpd is never asked twice. The cache is held to a size limit by letting go of the images used
+longest ago.
+
+Now playing frames carry the image's key; clients fetch each image once, with the artwork command, and keep it.
+"""
+
+import asyncio
+import hashlib
+import io
+import os
+
+from mpd.base import CommandError
+
+from persistence import CoalescingWriter, read_json
+
+import logging
+
+# Scale artwork down only if Pillow is available; without it, we keep (and send) the original
+NO_PILLOW = False
+try:
+    # noinspection PyUnresolvedReferences
+    from PIL import Image
+except ImportError:
+    NO_PILLOW = True
+
+logger = logging.getLogger(__name__)
+
+ARTWORK_DIR = "saved/artwork"
+# The thumbnails we make of each image (pixels along the longer side)
+ARTWORK_SIZES = (96, 320)
+# How much disk the thumbnails may take (bytes); the images used longest ago go first
+ARTWORK_LIMIT = 32 * 1024 * 1024
+# How long to gather changes to the index before writing it (seconds)
+ARTWORK_DELAY = 5.0
+THUMBNAIL_QUALITY = 85
+
+# The size we file an original under, when we can't make thumbnails
+ORIGINAL = 0
+
+
+def sniff_type(data):
+    """The MIME type of an image, from its first few bytes (albumart doesn't tell us)."""
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    return 'application/octet-stream'
+
+
+def make_thumbnails(data, sizes):
+    """{size: JPEG} for an image, scaled to fit each of the sizes (but never scaled up)."""
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        # Each one is made from the last, which is quicker than going back to the original every time
+        image.thumbnail((size, size))
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=THUMBNAIL_QUALITY)
+        thumbnails[size] = out.getvalue()
+    return thumbnails
+
+
+class ArtworkCache:
+    """
+    Thumbnails of the artwork of the tracks we've played, by key, and the key for each directory and file.
+
+    sources maps a directory (with a trailing slash) to the key of its cover image, and a file to the key of its
+    embedded picture; '' records that there isn't one. A file only has an entry if its directory has no cover.
+    images maps each key to [MIME type, bytes on disk, sizes], least recently used first.
+    """
+
+    def __init__(self, pool, directory=ARTWORK_DIR, sizes=ARTWORK_SIZES, limit=ARTWORK_LIMIT, delay=ARTWORK_DELAY):
+        self.pool = pool
+        self.directory = directory
+        self.sizes = tuple(sizes)
+        self.limit = limit
+        index_path = os.path.join(directory, "index.json")
+        self.writer = CoalescingWriter(index_path, self.compose, delay)
+
+        saved = read_json(index_path, default={}) or {}
+        self.sources = saved.get('sources', {})
+        self.images = saved.get('images', {})
+        self.total = sum(entry[1] for entry in self.images.values())
+        # Reads from mpd under way, by file, so a track is only read once however many ask for it
+        self.fetches = {}
+
+    def compose(self):
+        return {'sources': self.sources, 'images': self.images}
+
+    def flush(self):
+        """Write any changes to the index still waiting."""
+        if self.writer.pending is not None:
+            self.writer.flush()
+
+    @staticmethod
+    def folder(file):
+        return file.rpartition('/')[0] + '/'
+
+    def key_for(self, file):
+        """The key of a track's artwork, '' if it has none, or None if we haven't looked yet."""
+        key = self.sources.get(self.folder(file))
+        if key == '':
+            # No cover in the directory, so it's down to the file
+            return self.sources.get(file)
+        return key
+
+    async def art_for(self, file):
+        """The key of a track's artwork ('' if it has none), reading it from mpd if it's new to us."""
+        key = self.key_for(file)
+        if key is not None:
+            return key
+        if file not in self.fetches:
+            self.fetches[file] = asyncio.ensure_future(self.fetch(file))
+        # Someone giving up on the artwork shouldn't stop it arriving for everyone else
+        return await asyncio.shield(self.fetches[file])
+
+    async def fetch(self, file):
+        try:
+            folder = self.folder(file)
+            if folder not in self.sources:
+                self.sources[folder] = await self.read('albumart', file)
+            if self.sources[folder] == '':
+                self.sources[file] = await self.read('readpicture', file)
+            self.writer.mark_dirty()
+            return self.key_for(file)
+        finally:
+            del self.fetches[file]
+
+    async def read(self, command, file):
+        """Read a picture from mpd (mpd2 gathers the chunks for us), and file it; return its key, or ''."""
+        try:
+            picture = await self.pool.run(command, file)
+        except CommandError:
+            return ''
+        data = picture.get('binary') if picture else None
+        if not data:
+            return ''
+
+        key = hashlib.sha1(data).hexdigest()[:20]
+        if key in self.images:
+            self.touch(key)
+        else:
+            loop = asyncio.get_event_loop()
+            entry = await loop.run_in_executor(None, self.store, key, data, picture.get('type'))
+            self.images[key] = entry
+            self.total += entry[1]
+            self.evict()
+        return key
+
+    def path(self, key, size):
+        return os.path.join(self.directory, "{}-{}".format(key, size))
+
+    def store(self, key, data, mime=None):
+        """Write the thumbnails of an image (or, failing that, the image itself); return its entry in images."""
+        thumbnails = None
+        if not NO_PILLOW:
+            try:
+                thumbnails = make_thumbnails(data, self.sizes)
+                mime = 'image/jpeg'
+            except (OSError, ValueError) as e:
+                logger.error("Could not make thumbnails of artwork {}: {}".format(key, e))
+        if thumbnails is None:
+            thumbnails = {ORIGINAL: data}
+            mime = mime or sniff_type(data)
+
+        os.makedirs(self.directory, exist_ok=True)
+        for size, image in thumbnails.items():
+            tmp_path = "{}.tmp".format(self.path(key, size))
+            with open(tmp_path, mode='wb') as the_file:
+                the_file.write(image)
+            os.replace(tmp_path, self.path(key, size))
+        return [mime, sum(len(image) for image in thumbnails.values()), sorted(thumbnails)]
+
+    def touch(self, key):
+        self.images[key] = self.images.pop(key)
+        self.writer.mark_dirty()
+
+    def evict(self):
+        """Let go of the images used longest ago until the rest fit in the limit (keeping the newest, at least)."""
+        while self.total > self.limit and len(self.images) > 1:
+            self.forget(next(iter(self.images)))
+        self.writer.mark_dirty()
+
+    def forget(self, key):
+        mime, size, sizes = self.images.pop(key)
+        self.total -= size
+        for stored in sizes:
+            try:
+                os.remove(self.path(key, stored))
+            except FileNotFoundError:
+                pass
+        # Whoever had this image will have to read it from mpd again, if they're played again
+        for source in [source for source, known in self.sources.items() if known == key]:
+            del self.sources[source]
+        self.writer.mark_dirty()
+
+    def image(self, key, size=None):
+        """
+        The thumbnail of an image nearest a size: the smallest that's at least that big, or else the biggest.
+
+        :return: (size, MIME type, data), or None if we don't have the image
+        """
+        entry = self.images.get(key)
+        if entry is None:
+            return None
+        mime, _, sizes = entry
+        stored = sizes[-1]
+        if size is not None:
+            stored = next((s for s in sizes if s >= size), stored)
+        try:
+            with open(self.path(key, stored), mode='rb') as the_file:
+                data = the_file.read()
+        except OSError as e:
+            logger.error("Lost artwork {}: {}".format(key, e))
+            self.forget(key)
+            return None
+        self.touch(key)
+        return stored, mime, data
@@ -4,6 +4,7 @@ These base classes support objects in the opuscule system.
 
 """
 
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -33,6 +34,10 @@ class MenuList(MenuNode):
         if self.children:
             return self.children[self.index]
 
+    def menu_enter(self):
+        """Called as the menu is entered; lists that fill themselves in when they're first needed start here."""
+        pass
+
     def has_child(self, node):
         return node in self.children
 
@@ -43,16 +48,22 @@ class MenuList(MenuNode):
     def reset_children(self):
         self.children = []
 
+    def replace_children(self, children):
+        """Swap in a complete new list of children in one go, keeping the same child selected if it's still here."""
+        selected = self.selected_node()
+        for node in children:
+            node.parent = self
+        self.children = children
+        if selected in children:
+            self.index = children.index(selected)
+        else:
+            self.index = min(self.index, max(len(children) - 1, 0))
+
     def update_menu_labels(self, name, short_name, comment):
         self.menu_labels['name'] = name
         self.menu_labels['short_name'] = short_name
         self.menu_labels['comment'] = comment
 
-    def sort_children(self):
-        # https: // docs.python.org / 3 / howto / sorting.html
-        # Sorts in place!
-        self.children.sort(key=lambda name: name.labels['name'])
-
     def get_path(self, the_path):
         if self.menu_labels['name'] == 'root':
             return the_path
@@ -67,8 +78,14 @@ class MenuComponent(MenuList):
 
     Components are a sectiong device to name sub-trees: all of the menus, operai, commands, or anything else
     to do with a particular component should be a descendant of that compnent node in the hierarchy.
+
+    Constructors should be quick; anything slow (reading from daemons, the disk, or the network) belongs in
+    start(), which runs alongside the other components' once the server is already taking connections.
     """
 
+    # How long start() gets before we give up on it (seconds)
+    start_timeout = 10.0
+
     def __init__(self, name, short_name, comment):
         super().__init__(name, short_name, comment)
 
@@ -77,8 +94,20 @@ class MenuComponent(MenuList):
         The base case is false; a module passing this should be an intentional thing."""
         return False
 
+    def requirement_probes(self):
+        """Probes (from the probes module) for requirements that have to be checked on the system at hand."""
+        return []
 
-class AudioComponent(MenuList):
+    async def start(self):
+        """Do the slow part of starting up."""
+        pass
+
+    async def stop(self):
+        """Let go of anything start() took hold of."""
+        pass
+
+
+class AudioComponent(MenuComponent):
     """Specialized object that contains a (possibly optional) component
 
     These menu items can insert keyword shortcuts into the protocol?
@@ -89,11 +118,7 @@ class AudioComponent(MenuList):
         self.favorites_node = MenuList("Favorites", "Fav", "Generic Favorites")
         self.add_child(self.favorites_node)
         self.component = "audiocomponentbase"
-
-    def requirements_met(self):
-        """Test for things the component needs to work: external commands, etc.
-        The base case is false; a module passing this should be an intentional thing."""
-        return False
+        self.change_listeners = []
 
     def add_favorite(self, fav):
         if fav not in self.favorites_node.children:
@@ -105,6 +130,18 @@ class AudioComponent(MenuList):
     def load_favorites(self):
         pass
 
+    def opus_from_metadata(self, md):
+        """Rebuild one of this component's operai from the metadata it returned from opus_get_metadata."""
+        return None
+
+    def add_change_listener(self, callback):
+        """Call back whenever the component changes its menus on its own (not in answer to the user)."""
+        self.change_listeners.append(callback)
+
+    def notify_changed(self):
+        for callback in self.change_listeners:
+            callback(self)
+
 
 class Opus(MenuNode):
     """Parent class for playable objects.
@@ -132,6 +169,8 @@ class Opus(MenuNode):
         self.children = False
         self.component = "opusbase"
         self.supported_data = []
+        # Operai played by an external daemon (like mpd) keep playing while the server restarts
+        self.survives_restart = False
 
     def __repr__(self):
         return "[Opus] {} ".format(self.menu_labels['name'])
@@ -142,6 +181,11 @@ class Opus(MenuNode):
     def opus_stop(self):
         pass
 
+    def opus_transition(self, previous):
+        """Stop the previous opus and start this one."""
+        previous.opus_stop()
+        self.opus_play()
+
     def opus_pause(self):
         pass
 
@@ -166,11 +210,83 @@ class Opus(MenuNode):
     def opus_update_shuffle(self):
         pass
 
+    async def opus_prepare(self):
+        """
+        Do ahead of time whatever slow work playing this opus needs, so that playing it is quick.
+
+        Called when the cursor rests on the opus. It may be cancelled at any point, and the opus must still play
+        properly (if more slowly) whether or not it finished.
+        """
+        pass
+
+    def opus_unprepare(self):
+        # Let go of anything opus_prepare kept
+        pass
+
+    def opus_enqueue(self):
+        # Add the opus to the end of whatever is playing, for operai that play from a queue
+        pass
+
+    def opus_adopt(self):
+        # Take over, from a restarting server, an opus that kept playing through the restart
+        pass
+
     def opus_get_metadata(self):
         # Return metatdata for opus to serialize it and recreate from persistant store
         return {}
 
 
+class MPDOpus(Opus):
+    """Parent class for operai played through mpd.
+
+    Each change to the player is sent to mpd as a single command list; when we move from one mpd opus to
+    another, stopping the old one and starting the new one go out together in one list.
+    """
+
+    def __init__(self, name, short_name, comment, mpd_pool):
+        super().__init__(name, short_name, comment)
+        self.pool = mpd_pool
+        self.loop = asyncio.get_event_loop()
+        self.pause_support = True
+        # mpd keeps playing while the server restarts
+        self.survives_restart = True
+
+    def opus_play_commands(self):
+        """The commands that load this opus into mpd and start it playing."""
+        return []
+
+    def opus_stop_commands(self):
+        """The commands that stop this opus."""
+        return [('stop',), ('clear',)]
+
+    def opus_play(self):
+        self.send_commands(self.opus_play_commands())
+
+    def opus_stop(self):
+        self.send_commands(self.opus_stop_commands())
+
+    def opus_transition(self, previous):
+        if isinstance(previous, MPDOpus):
+            self.send_commands(previous.opus_stop_commands() + self.opus_play_commands())
+        else:
+            super().opus_transition(previous)
+
+    def opus_pause(self):
+        self.send_commands([('pause', 1)])
+
+    def opus_unpause(self):
+        self.send_commands([('pause', 0)])
+
+    def send_commands(self, commands):
+        asyncio.run_coroutine_threadsafe(self._send_commands(commands), self.loop)
+
+    async def _send_commands(self, commands):
+        try:
+            await self.pool.command_list(commands)
+        except Exception as e:
+            logger.error("Command list for {} failed: {}".format(self, e))
+
+
 class Command(MenuNode):
     """Parent class for system commands."""
 
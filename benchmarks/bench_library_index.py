@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark: building the Library index at startup.
+
+We run a stand-in mpd daemon with a fixed delay on every response and a generated collection, and time building
+the genre/artist/album index two ways. The "per tag" case replays the old behaviour: a 'list' query for every
+genre, every artist in every genre, and every artist, one after the other. The "bulk" cases are the current
+LibraryIndex.fetch, which reads the tracks a page at a time and works everything else out in memory, with one
+query at a time and then with several pages in flight over the pool's connections.
+
+Usage: python benchmarks/bench_library_index.py [--latency SECONDS] [--tracks N] [--concurrency N]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from mpdpool import MPDPool
+from components.libraryindex import LibraryIndex
+from tests.fake_mpd import FakeMPD, make_track
+
+GENRES = 12
+ARTISTS = 200
+ALBUM_LENGTH = 10
+
+
+def build_tracks(count):
+    tracks = []
+    for n in range(count):
+        album = n // ALBUM_LENGTH
+        artist = album % ARTISTS
+        tracks.append(make_track("music/{}/{}/{:02}.flac".format(artist, album, n % ALBUM_LENGTH),
+                                 genre="Genre {}".format(artist % GENRES), artist="Artist {}".format(artist),
+                                 album="Album {}".format(album), title="Track {}".format(n)))
+    return tracks
+
+
+def values(results, tag):
+    return [r[tag] if isinstance(r, dict) else r for r in results]
+
+
+async def per_tag_index(pool):
+    await pool.run('listplaylists')
+    for genre in values(await pool.run('list', 'genre'), 'genre'):
+        await pool.run('list', 'album', 'genre', genre)
+        for artist in values(await pool.run('list', 'artist', 'genre', genre), 'artist'):
+            await pool.run('list', 'album', 'artist', artist, 'genre', genre)
+    for artist in values(await pool.run('list', 'artist'), 'artist'):
+        await pool.run('list', 'album', 'artist', artist)
+    await pool.run('list', 'album')
+
+
+def bulk_index(concurrency):
+    async def build(pool):
+        await LibraryIndex.fetch(pool, concurrency)
+    return build
+
+
+async def measure(name, fake, pool, build):
+    sent = len(fake.commands_seen)
+    start = time.perf_counter()
+    await build(pool)
+    elapsed = time.perf_counter() - start
+    print("{:<10} {:6d} queries   {:8.1f} ms".format(name, len(fake.commands_seen) - sent, elapsed * 1000))
+
+
+async def main(latency, count, concurrency):
+    fake = FakeMPD(build_tracks(count), latency=latency)
+    port = await fake.start()
+
+    pool = MPDPool('127.0.0.1', port, size=concurrency)
+    await pool.connect()
+
+    print("Library index build, {} tracks, {:.1f} ms per mpd response".format(count, latency * 1000))
+    await measure("per tag", fake, pool, per_tag_index)
+    await measure("bulk x1", fake, pool, bulk_index(1))
+    await measure("bulk x{}".format(concurrency), fake, pool, bulk_index(concurrency))
+
+    pool.disconnect()
+    await fake.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Library index benchmark")
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--tracks", type=int, default=6000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.latency, args.tracks, args.concurrency))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark: select-to-audio latency for an opus transition.
+
+We run a stand-in mpd daemon with a fixed delay on every response (to stand in for a real daemon on a busy SBC),
+start one library slice playing, and then time how long it takes from selecting a second slice until the
+stand-in reports that it is playing the new queue. The "sequential" case replays the old behaviour, awaiting
+stop, clear, findadd, random, repeat and play one at a time; the "command list" case is the current
+opus_transition, which sends the whole transition to mpd in one list.
+
+Usage: python benchmarks/bench_opus_transition.py [--latency SECONDS] [--runs N]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from mpdpool import MPDPool
+from components.library import SliceOpus
+from tests.fake_mpd import FakeMPD, make_track
+
+
+def build_tracks():
+    tracks = []
+    for genre in ("Rock", "Jazz"):
+        for album in range(10):
+            for track in range(12):
+                tracks.append(make_track("{}/album{}/{:02}.flac".format(genre, album, track),
+                                         genre=genre, album="{} {}".format(genre, album),
+                                         artist="Artist {}".format(album), title="Track {}".format(track)))
+    return tracks
+
+
+async def wait_for_audio(fake, first_file):
+    """Wait until the stand-in is playing a queue that starts with the given file."""
+    while not (fake.state == 'play' and fake.queue and fake.queue[0]['track']['file'] == first_file):
+        await asyncio.sleep(0.0005)
+
+
+async def sequential_transition(pool, previous, opus):
+    async with pool.control() as mpdc:
+        await mpdc.stop()
+        await mpdc.clear()
+    async with pool.control() as mpdc:
+        await mpdc.clear()
+        await mpdc.findadd(*opus.find_terms)
+        await mpdc.random(opus.shuffle)
+        await mpdc.repeat(opus.repeat)
+        await mpdc.play()
+
+
+async def batched_transition(pool, previous, opus):
+    opus.opus_transition(previous)
+
+
+async def measure(fake, pool, transition, runs):
+    rock = SliceOpus("Rock", pool, ['genre', 'Rock'])
+    jazz = SliceOpus("Jazz", pool, ['genre', 'Jazz'])
+    first_file = {rock: "Rock/album0/00.flac", jazz: "Jazz/album0/00.flac"}
+
+    samples = []
+    previous, current = rock, jazz
+    await pool.command_list(rock.opus_play_commands())
+    for _ in range(runs):
+        start = time.perf_counter()
+        await transition(pool, previous, current)
+        await wait_for_audio(fake, first_file[current])
+        samples.append(time.perf_counter() - start)
+        previous, current = current, previous
+
+    return samples
+
+
+def report(name, samples):
+    print("{:<16} median {:7.2f} ms   mean {:7.2f} ms   max {:7.2f} ms".format(
+        name,
+        statistics.median(samples) * 1000,
+        statistics.mean(samples) * 1000,
+        max(samples) * 1000))
+
+
+async def main(latency, runs):
+    fake = FakeMPD(build_tracks(), latency=latency)
+    port = await fake.start()
+
+    pool = MPDPool('127.0.0.1', port)
+    await pool.connect()
+
+    print("Select-to-audio latency, {} runs, {:.1f} ms per mpd response".format(runs, latency * 1000))
+    report("sequential", await measure(fake, pool, sequential_transition, runs))
+    report("command list", await measure(fake, pool, batched_transition, runs))
+
+    pool.disconnect()
+    await fake.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Opus transition benchmark")
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.latency, args.runs))
@@ -0,0 +1,76 @@
+"""
+Where each opus was when it was last left, so that playing it again picks up from there.
+
+A bookmark holds the position in the queue, how far into that track we'd got, and the opus' repeat and shuffle
+settings. Bookmarks change with every track and every pause, so they are written with the same coalescing as the
+radio state, and kept as short lists rather than dicts to keep the file small.
+"""
+
+from persistence import CoalescingWriter, read_json
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+BOOKMARKS_FILE = "saved/bookmarks.json"
+# How many operai we remember; the ones left longest ago are forgotten first
+BOOKMARK_LIMIT = 200
+# How long to gather changes before writing them (seconds)
+BOOKMARK_DELAY = 5.0
+
+
+class Bookmark:
+    """One opus' place, as it's kept on disk: [position, elapsed, repeat, shuffle, version]."""
+
+    __slots__ = ('position', 'elapsed', 'repeat', 'shuffle', 'version')
+
+    def __init__(self, position, elapsed, repeat=0, shuffle=0, version=None):
+        self.position = position
+        self.elapsed = elapsed
+        self.repeat = repeat
+        self.shuffle = shuffle
+        # Whatever the opus needs to tell if its queue would still come out the same (say, the database version)
+        self.version = version
+
+    def as_list(self):
+        return [self.position, self.elapsed, self.repeat, self.shuffle, self.version]
+
+
+class BookmarkStore:
+    """
+    Bookmarks by opus key, most recently left last.
+    """
+
+    def __init__(self, path=BOOKMARKS_FILE, limit=BOOKMARK_LIMIT, delay=BOOKMARK_DELAY):
+        self.limit = limit
+        self.writer = CoalescingWriter(path, self.compose, delay)
+        self.bookmarks = {}
+        for key, saved in (read_json(path, default={}) or {}).items():
+            try:
+                self.bookmarks[key] = Bookmark(*saved)
+            except TypeError:
+                logger.error("Ignoring damaged bookmark for {}: {}".format(key, saved))
+        # The opus whose queue mpd is playing, if it's one that keeps bookmarks
+        self.active = None
+
+    def compose(self):
+        return {key: bookmark.as_list() for key, bookmark in self.bookmarks.items()}
+
+    def get(self, key):
+        return self.bookmarks.get(key)
+
+    def record(self, key, bookmark):
+        self.bookmarks.pop(key, None)
+        self.bookmarks[key] = bookmark
+        while len(self.bookmarks) > self.limit:
+            del self.bookmarks[next(iter(self.bookmarks))]
+        self.writer.mark_dirty()
+
+    def forget(self, key):
+        if self.bookmarks.pop(key, None) is not None:
+            self.writer.mark_dirty()
+
+    def flush(self):
+        """Write any changes still waiting."""
+        if self.writer.pending is not None:
+            self.writer.flush()
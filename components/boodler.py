@@ -1,7 +1,13 @@
 
 from base_classes import Opus, MenuList, AudioComponent
+from probes import BinaryProbe
 import subprocess
 import json
+import os
+
+import logging
+
+logger = logging.getLogger(__name__)
 
 """
 Opuscule boodler component: play generated soundscapes.
@@ -9,6 +15,9 @@ Opuscule boodler component: play generated soundscapes.
 This component requires boodler to generate the soundscapes.
 """
 
+# Where boodler keeps the soundscape packages it has installed
+BOODLER_COLLECTION = os.environ.get('BOODLER_COLLECTION', os.path.expanduser("~/.boodler/Collection"))
+
 class BoodlerComponent(AudioComponent):
     def __init__(self, sfavs):
 
@@ -41,10 +50,13 @@ class BoodlerComponent(AudioComponent):
     def requirements_met(self):
         return True
 
+    def requirement_probes(self):
+        return [BinaryProbe('boodler')]
+
     def save_favorites(self):
         favs = []
         for fav in self.favorites_node.children:
-            favs.append(fav.get_metadata())
+            favs.append(fav.opus_get_metadata())
 
         json_favs = json.dumps(favs)
 
@@ -56,7 +68,7 @@ class BoodlerComponent(AudioComponent):
             with open(self.favs_save_file, mode='r', encoding='utf-8') as the_file:
                 favs = json.loads(the_file.read())
                 for fav in favs:
-                    this_opus = BoodlerOpus(fav['name'], fav['comment'], fav['package'], fav['agent'])
+                    this_opus = self.opus_from_metadata(fav)
                     self.favorites_node.add_child(this_opus)
                 self.sfavs.update_one_favorite_menu(self)
         except json.JSONDecodeError:
@@ -64,6 +76,9 @@ class BoodlerComponent(AudioComponent):
         except FileNotFoundError:
             pass
 
+    def opus_from_metadata(self, md):
+        return BoodlerOpus(md['name'], md['comment'], md['package'], md['agent'])
+
 
 class BoodlerMenuList(MenuList):
     def __init__(self, name, short_name, comment):
@@ -83,8 +98,19 @@ class BoodlerOpus(Opus):
         self.component = "boodler"
         self.boo = None
         self.command = "boodler {}/{}".format(self.package, self.agent)
+        # Whether the package is installed, once we've looked
+        self.installed = None
+
+    async def opus_prepare(self):
+        if self.installed is None:
+            self.installed = os.path.isdir(os.path.join(BOODLER_COLLECTION, self.package))
+
+    def opus_unprepare(self):
+        self.installed = None
 
     def opus_play(self):
+        if self.installed is False:
+            logger.error("Boodler package {} isn't installed in {}".format(self.package, BOODLER_COLLECTION))
         self.boo = subprocess.Popen(self.command, shell=True)
 
     def opus_stop(self):
@@ -1,7 +1,20 @@
-from base_classes import Opus, AudioComponent, MenuList
+from base_classes import MPDOpus, AudioComponent, MenuList
+from bookmarks import Bookmark, BookmarkStore
+from components.libraryfolders import FolderBrowser, placeholder
+from components.libraryindex import LibraryIndex, CONCURRENCY
+from components.libraryqueue import QueueView
+from components.librarysearch import SearchIndex
+from components.playhistory import PlayHistory
+from components.smartplaylists import SmartPlaylists, load_playlists, SMART_PLAYLISTS_FILE
+from components.queuefeeder import QueueFeeder, WINDOWED_THRESHOLD
+from prestage import PRESTAGE_MAX_TRACKS
+from persistence import read_pickle, write_pickle
+from probes import TCPProbe
 import json
 import asyncio
-from mpd.asyncio import MPDClient
+import os
+import time
+import weakref
 
 import logging
 
@@ -14,57 +27,141 @@ This component requires mpd to play audio.
 """
 
 class LibraryComponent(AudioComponent):
-    def __init__(self, sfavs):
+    def __init__(self, sfavs, mpd_pool, concurrency=CONCURRENCY, smart_file=SMART_PLAYLISTS_FILE):
         # Do Startup tasks
         super().__init__("Library", "Lib", "Locally Stored Audio")
         self.sfavs = sfavs
 
-        self.mpdc = MPDClient()
+        # Shared connections to mpd
+        self.pool = mpd_pool
         self.loop = asyncio.get_event_loop()
         self.REQ_MET_MPD = False
 
-        self.start_client()
-
         # This is part of the Streaming hierarchy
         self.component = "library"
-        # Local pointers into the radio state and the streaming client
-        # Zero the client state on startup
-        self.clear_client()
 
         # Setup the menu items
+        # Every opus in the Library, by what it plays, so that the same album (say) reached through different
+        # menus is the one shared object; weak, so an opus goes when the last menu (or favorite) holding it does
+        self.operai = weakref.WeakValueDictionary()
+        # Where each of them was left
+        self.bookmarks = BookmarkStore("saved/{}_bookmarks.json".format(self.component))
+
+        # What has been played, and the smart playlists worked out from it and the index
+        self.history = PlayHistory("saved/{}_history.json".format(self.component))
+        self.history.add_listener(self.history_changed)
+        self.smart = SmartPlaylists(load_playlists(smart_file), self.history)
+        self.smart_operai = {playlist.name: SmartOpus(playlist, self.pool, self.bookmarks, self.resolve_smart)
+                             for playlist in self.smart.playlists}
+        # The song mpd was last playing, so each is counted as played once, as it starts
+        self.playing_songid = None
+        self.heard_player = False
+
         self.favs_save_file = "saved/{}_favorites.json".format(self.component)
         self.favorites_node.menu_labels['comment'] = "Library Favorites"
         self.favorites_node.component = self.component
         self.load_favorites()
 
+        self.queue_node = QueueView(self.pool, on_change=self.notify_changed)
+        self.add_child(self.queue_node)
         self.playlists_node = LibraryMenuList("Playlists", "Pls", "My playlists.")
         self.add_child(self.playlists_node)
+        self.smart_node = LibraryMenuList("Smart", "Smt", "Smart playlists")
+        self.smart_node.replace_children(list(self.smart_operai.values()))
+        self.add_child(self.smart_node)
         self.genres_node = LibraryMenuList("Genres", "Gnr", "Library By Genre")
         self.add_child(self.genres_node)
         self.artists_node = LibraryMenuList("Artists", "Art", "Library By Artist")
         self.add_child(self.artists_node)
         self.albums_node = LibraryMenuList("Albums", "Alb", "Library By Album")
         self.add_child(self.albums_node)
-
-        # Populate the Library
-        asyncio.run_coroutine_threadsafe(self.refresh_library(), self.loop)
-
-    def start_client(self):
-        return self.loop.run_until_complete(self.__async__start_client())
-
-    async def __async__start_client(self):
-        try:
-            await self.mpdc.connect('localhost', 6600)
-        except Exception as e:
-            print("Connection failed:", e)
-            self.REQ_MET_MPD = False
-        await self.mpdc.consume(0)
-
-    def clear_client(self):
-        return self.loop.run_until_complete(self._clear_client())
-
-    async def _clear_client(self):
-        await self.mpdc.clear()
+        # Folders are listed from mpd as they're entered, rather than built from the index
+        self.folder_browser = FolderBrowser(self.pool, self.slice_opus, on_change=self.notify_changed)
+        self.add_child(self.folder_browser.root)
+        self.search_node = LibraryMenuList("Search", "Srch", "Search results")
+        self.add_child(self.search_node)
+
+        # The Library is populated (from the cache if we have one) and kept up to date once we start
+        self.library_index = LibraryIndex()
+        self.search_index = SearchIndex()
+        # The index's tracks the search index was built from (None until the first is ready), and the task building
+        # the next one
+        self.searched_tracks = None
+        self.search_task = None
+        self.index_cache_file = "saved/{}_index.cache".format(self.component)
+        # How many queries we keep going with mpd at once while reading the database: at least one command connection
+        # is left for the controls, so a refresh never holds up the player
+        self.concurrency = max(1, min(concurrency, len(mpd_pool.command_clients) - 1))
+        if self.concurrency != concurrency:
+            logger.debug("LIBRARY: reading the database %d queries at a time, to leave a connection free",
+                        self.concurrency)
+        # How long (in seconds) each part of the last refresh took
+        self.refresh_timings = {}
+        self.pending_changes = set()
+        self.refresh_task = None
+        # The tracks of the albums that have been opened, in order, by AlbumKey
+        self.album_tracks = {}
+
+    def requirement_probes(self):
+        return [TCPProbe(self.pool.host, self.pool.port)]
+
+    async def start(self):
+        """
+        Show the cached Library, and start following mpd's database.
+
+        The mirror tells us about every subsystem when it first connects (and reconnects), which covers checking
+        that the cache is current; if it has already done so, we ask for the check ourselves. If it hasn't, we read
+        the database version now rather than wait, so that what's restored from the last session can be played from
+        the cached index.
+        """
+        await self.load_index_cache()
+        self.pool.mirror.add_listener(self.library_changed, ('database', 'stored_playlist'))
+        if self.pool.mirror.stats:
+            self.library_changed(['database', 'stored_playlist'])
+        elif self.pool.up.is_set():
+            try:
+                await self.pool.mirror.refresh(['stats'])
+            except Exception as e:
+                logger.warning("LIBRARY: could not read the database version: %s", e)
+        self.pool.mirror.add_listener(self.player_changed, ('player', 'options'))
+        self.queue_node.start()
+
+    async def stop(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+        if self.search_task is not None:
+            self.search_task.cancel()
+        self.queue_node.stop()
+        self.bookmarks.flush()
+        self.history.flush()
+
+    def player_changed(self, changed):
+        """Keep whichever of our operai is playing up to date as mpd moves from track to track."""
+        if self.bookmarks.active is not None:
+            self.bookmarks.active.opus_player_changed()
+        self.count_play()
+
+    def count_play(self):
+        """Add a song to the play history as mpd starts playing it (but not one already playing when we start)."""
+        status = self.pool.mirror.status
+        if status.get('state') == 'stop':
+            self.playing_songid = None
+        elif status.get('state') == 'play' and status.get('songid') != self.playing_songid:
+            self.playing_songid = status.get('songid')
+            file = self.pool.mirror.currentsong.get('file', '')
+            if self.heard_player and file and '://' not in file:
+                self.history.record(file)
+        self.heard_player = True
+
+    def history_changed(self, files):
+        changed = self.smart.history_changed(files)
+        if changed:
+            self.show_smart_totals(changed)
+            self.notify_changed()
+
+    def show_smart_totals(self, playlists):
+        for playlist in playlists:
+            self.smart_operai[playlist.name].menu_labels['comment'] = describe_totals(playlist.totals(), albums=False)
 
     def save_favorites(self):
         favs = []
@@ -81,11 +178,8 @@ class LibraryComponent(AudioComponent):
             with open(self.favs_save_file, mode='r', encoding='utf-8') as the_file:
                 favs = json.loads(the_file.read())
                 for fav in favs:
-                    if fav['type'] == 'playlist':
-                        this_opus = PlaylistOpus(fav['name'], self.mpdc)
-                        self.favorites_node.add_child(this_opus)
-                    elif fav['type'] == 'slice':
-                        this_opus = SliceOpus(fav['name'], self.mpdc, fav['terms'])
+                    this_opus = self.opus_from_metadata(fav)
+                    if this_opus:
                         self.favorites_node.add_child(this_opus)
                 self.sfavs.update_one_favorite_menu(self)
         except json.JSONDecodeError:
@@ -93,141 +187,553 @@ class LibraryComponent(AudioComponent):
         except FileNotFoundError:
             pass  # log an error message
 
+    def opus_from_metadata(self, md):
+        if md['type'] == 'playlist':
+            return self.playlist_opus(md['name'])
+        elif md['type'] == 'slice':
+            return self.slice_opus(md['name'], md['terms'])
+        elif md['type'] == 'smart':
+            return self.smart_operai.get(md['name'])
+
+    def index_current(self):
+        """Whether the index is up to date with mpd's database."""
+        return self.library_index.db_update is not None and \
+            self.library_index.db_update == self.pool.mirror.stats.get('db_update')
+
+    def resolve_slice(self, find_terms):
+        """
+        The tracks in a slice of the library, from the index, if the index is up to date with mpd's database.
+
+        :return: the index's list of tracks, and the positions in it of the slice's tracks; or None
+        """
+        if not self.index_current():
+            return None
+        ids = self.library_index.match_ids(find_terms)
+        return None if ids is None else (self.library_index.tracks, ids)
+
+    def resolve_smart(self, playlist):
+        """The tracks of a smart playlist, as resolve_slice gives them."""
+        if not self.index_current():
+            return None
+        return self.smart.resolve(playlist)
+
+    def playlist_opus(self, name):
+        """The one opus for a stored playlist."""
+        key = ('playlist', name)
+        opus = self.operai.get(key)
+        if opus is None:
+            opus = self.operai[key] = PlaylistOpus(name, self.pool, self.bookmarks)
+        return opus
+
+    def slice_opus(self, name, find_terms):
+        """The one opus for a slice of the library, whichever order its find terms come in."""
+        key = ('slice',) + canonical_terms(find_terms)
+        opus = self.operai.get(key)
+        if opus is None:
+            opus = self.operai[key] = SliceOpus(name, self.pool, find_terms, self.bookmarks, self.resolve_slice)
+        return opus
+
+    async def load_index_cache(self):
+        start = time.perf_counter()
+        cached = await self.loop.run_in_executor(None, read_pickle, self.index_cache_file)
+        index = LibraryIndex.from_cache(cached)
+        if index is not None:
+            self.apply_index(index)
+            logger.info("LIBRARY: loaded %d tracks from the cache in %.1f ms", len(index.tracks),
+                        (time.perf_counter() - start) * 1000)
+
+    async def save_index_cache(self):
+        try:
+            await self.loop.run_in_executor(None, write_pickle, self.index_cache_file, self.library_index.to_cache())
+        except OSError as e:
+            logger.error("LIBRARY: could not save the index cache: %s", e)
+
+    def library_changed(self, changed):
+        """
+        Hear about changes to the mpd database or stored playlists, and bring the menus up to date.
+
+        Changes that arrive while we're already refreshing are gathered up and handled in one go afterwards.
+        """
+        self.pending_changes.update(changed)
+        if 'database' in changed:
+            self.folder_browser.database_changed()
+            self.album_tracks = {}
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.ensure_future(self.refresh_library())
+
     async def refresh_library(self):
-        await self.refresh_playlists()
-        await self.refresh_genres()
-        await self.refresh_artists()
-        await self.refresh_albums()
+        """
+        Fetch a new index of the library, and patch the menu branches that differ from the last one.
+
+        Branches are built off to the side and swapped in whole, so if mpd goes away part way through, the menus
+        carry on serving the last tree we managed to build.
+        """
+        while self.pending_changes:
+            changed, self.pending_changes = self.pending_changes, set()
+            timings = {}
+            start = time.perf_counter()
+            # Only read the database if its version has moved on from the one our index (perhaps from the cache)
+            # was read from
+            db_update = self.pool.mirror.stats.get('db_update')
+            read_tracks = 'database' in changed and (db_update is None or db_update != self.library_index.db_update)
+            try:
+                if read_tracks:
+                    index = await LibraryIndex.fetch(self.pool, self.concurrency, timings)
+                else:
+                    index = self.library_index.with_playlists(await LibraryIndex.fetch_playlists(self.pool))
+            except Exception as e:
+                logger.error("LIBRARY: refresh failed, keeping the last known tree: %s", e)
+                # Try again with the next change (mpd tells us about everything when it comes back)
+                self.pending_changes |= changed
+                return
+
+            diff = self.apply_index(index, timings)
+            if read_tracks or diff['playlists']:
+                await self.save_index_cache()
+
+            timings['total'] = time.perf_counter() - start
+            self.refresh_timings = {branch: round(seconds * 1000, 2) for branch, seconds in timings.items()}
+            logger.info("LIBRARY: refresh took (ms) %s", self.refresh_timings)
+
+    def apply_index(self, index, timings=None):
+        """
+        Patch the menus to match a new index.
+
+        :param timings: if given, a dict to record how long (in seconds) each branch took to patch
+        :return: the diff between the old index and the new
+        """
+        if timings is None:
+            timings = {}
+
+        diff = self.library_index.diff(index)
+        old, self.library_index = self.library_index, index
+
+        # Track tags the menus don't show (like titles) can change without touching any branch
+        smart_changed = []
+        if index.tracks is not old.tracks:
+            self.index_search(index.tracks)
+
+            start = time.perf_counter()
+            smart_changed = self.smart.index_changed(index)
+            self.show_smart_totals(smart_changed)
+            timings['smart'] = time.perf_counter() - start
+
+        if not any(diff.values()):
+            logger.debug("LIBRARY: no changes")
+            # Menus work out their totals as they're shown, so tracks changing within the same menus only need showing
+            if smart_changed or index.tracks is not old.tracks:
+                self.notify_changed()
+            return diff
+
+        logger.debug("LIBRARY: patching %s", {branch: len(keys) for branch, keys in diff.items()})
+
+        branches = {
+            'playlists': lambda: self.patch_children(self.playlists_node,
+                                                     sorted(index.playlists, key=index.sort_key), (),
+                                                     self.playlist_opus),
+            'genres': lambda: self.patch_children(self.genres_node, sorted(index.genres, key=index.sort_key),
+                                                  diff['genres'], self.build_genre,
+                                                  lambda node, genre: self.fill_genre(node, genre, old)),
+            'artists': lambda: self.patch_children(self.artists_node, sorted(index.artists, key=index.sort_key),
+                                                   diff['artists'], self.build_artist,
+                                                   lambda node, artist: self.fill_artist(node, artist)),
+            'albums': lambda: self.patch_children(self.albums_node, index.sorted_albums(index.albums), (),
+                                                  self.build_album),
+        }
+
+        for branch, patch in branches.items():
+            if diff[branch]:
+                start = time.perf_counter()
+                patch()
+                timings['patch_' + branch] = time.perf_counter() - start
+
+        self.notify_changed()
+
+        return diff
+
+    @staticmethod
+    def patch_children(node, names, changed, build, refill=None):
+        """
+        Bring the children of a menu list in line with a list of names (or, for albums, AlbumKeys).
+
+        Menu lists whose names are not in changed are kept as they are; changed ones are refilled in place (so
+        anyone browsing inside one stays there), and anything new is built. Operai are always "built": the Library
+        hands back the one it already has.
+        """
+        existing = {child.index_key: child for child in node.children if isinstance(child, LibraryMenuList)}
+        children = []
+        for name in names:
+            child = existing.get(name)
+            if child is None:
+                child = build(name)
+            elif name in changed and refill:
+                refill(child, name)
+            children.append(child)
+        node.replace_children(children)
+
+    def totals_comment(self, key):
+        """What a menu holds, as its comment shows it: "3 albums, 36 tracks, 2h 41m"."""
+        totals = self.library_index.totals.get(key)
+        if key[0] == 'album':
+            caption = album_caption(key[1])
+            return ' - '.join((caption, describe_totals(totals, albums=False))) if caption and totals else caption
+        return describe_totals(totals) if totals else ""
+
+    # Building the branches
+
+    def build_genre(self, genre):
+        this_genre = LibraryMenuList(genre, "", "", self, ('genre', genre))
+        this_genre.add_child(self.slice_opus("All songs in {}".format(genre), ['genre', genre]))
+        this_genre.add_child(LibraryMenuList("By Album", "", ""))
+        this_genre.add_child(LibraryMenuList("By Artist", "", ""))
+        self.fill_genre(this_genre, genre, LibraryIndex())
+        return this_genre
+
+    def fill_genre(self, this_genre, genre, old):
+        by_album, by_artist = this_genre.children[1], this_genre.children[2]
+        contents = self.library_index.genres[genre]
+        old_artists = old.genres.get(genre, {}).get('artists', {})
+
+        self.patch_children(by_album, self.library_index.sorted_albums(contents['albums']), (),
+                            self.build_album)
+
+        self.patch_children(by_artist, sorted(contents['artists'], key=self.library_index.sort_key),
+                            {a for a in contents['artists'] if contents['artists'][a] != old_artists.get(a)},
+                            lambda artist: self.build_artist(artist, genre),
+                            lambda node, artist: self.fill_artist(node, artist, genre))
+
+    def build_artist(self, artist, genre=None):
+        this_artist = LibraryMenuList(artist, "", "", self, ('genre', genre, artist) if genre else ('artist', artist))
+        terms = ['artist', artist] + (['genre', genre] if genre else [])
+        this_artist.add_child(self.slice_opus("All songs by {}".format(artist), terms))
+        this_artist.add_child(LibraryMenuList("By Album", "", ""))
+        self.fill_artist(this_artist, artist, genre)
+        return this_artist
+
+    def fill_artist(self, this_artist, artist, genre=None):
+        if genre:
+            albums = self.library_index.genres[genre]['artists'][artist]
+        else:
+            albums = self.library_index.artists[artist]
+
+        self.patch_children(this_artist.children[1], self.library_index.sorted_albums(albums), (),
+                            self.build_album)
+
+    def build_album(self, album):
+        """
+        An album's menu in one of the views. Each view has its own, so that whoever is browsing one stays in the view
+        they came through when the branches around it are patched; the opus and the tracks are shared.
+        """
+        node = AlbumMenuList(self, album)
+        node.replace_children([self.album_opus(album)])
+        return node
+
+    async def list_album(self, node):
+        """Read an album's tracks from mpd, in disc and track order, and fill in its menu."""
+        try:
+            songs = await self.pool.run('find', *album_terms(node.album))
+        except Exception as e:
+            logger.error("LIBRARY: could not read the tracks of {}: {}".format(node.album, e))
+            if node.songs is None:
+                node.replace_children(node.children[:1] + [placeholder("Couldn't read this album", str(e))])
+        else:
+            songs.sort(key=track_order)
+            self.album_tracks[node.album] = songs
+            node.fill(songs)
+        self.notify_changed()
+
+    def album_opus(self, album):
+        """
+        An album plays the whole album (and only that one, of the albums with its name), whichever menu it's reached
+        through, so every menu shares the one opus.
+
+        :param album: an AlbumKey
+        """
+        opus = self.slice_opus(album.album, album_terms(album))
+        opus.menu_labels['comment'] = album_caption(album)
+        return opus
+
+    def index_search(self, tracks):
+        """
+        Build the search index for a new list of tracks in the background; until it's ready, searches go on using
+        the last one.
+        """
+        if self.search_task is not None:
+            self.search_task.cancel()
+        self.search_task = asyncio.ensure_future(self.build_search_index(tracks))
+
+    async def build_search_index(self, tracks):
+        start = time.perf_counter()
+        # Off the event loop: it takes a good while for a big library, and the menus and player carry on meanwhile
+        search_index = await self.loop.run_in_executor(None, SearchIndex, tracks)
+        self.search_index, self.searched_tracks = search_index, tracks
+        logger.debug("LIBRARY: built the search index in %.1f ms", (time.perf_counter() - start) * 1000)
+
+    def search(self, query):
+        """
+        Fill the Search menu with the tracks best matching a query.
+
+        :return: how many tracks matched, or None if there's no search index yet
+        """
+        if self.searched_tracks is None:
+            return None
+        self.search_node.replace_children([self.track_opus(track) for track in self.search_index.search(query)])
+        self.search_node.index = 0
+        self.search_node.menu_labels['comment'] = "Search results for '{}'".format(query)
+        return len(self.search_node.children)
+
+    def track_opus(self, track):
+        title = ', '.join(track.values('title')) or os.path.basename(track.file)
+        opus = self.slice_opus(title, ['file', track.file])
+        opus.menu_labels['comment'] = ' - '.join(', '.join(track.values(tag)) for tag in ('artist', 'album')
+                                                 if track.values(tag))
+        return opus
 
-    async def refresh_playlists(self):
-        logger.debug("LIBRARY: checking for playlists")
+    def requirements_met(self):
+        return True
 
-        available_playlists = await self.mpdc.listplaylists()
 
-        self.playlists_node.reset_children()
+def canonical_terms(find_terms):
+    """The (tag, value) pairs of a list of find terms, in a fixed order, to tell slices of the library apart."""
+    return tuple(sorted(zip(find_terms[0::2], find_terms[1::2])))
 
-        for playlist in available_playlists:
-            # Add a Playlist opera to the playlist menu
-            playlist_name = playlist['playlist']
-            logger.debug("LIBRARY: found playlist " + playlist_name)
-            self.playlists_node.add_child(PlaylistOpus(playlist_name, self.mpdc))
 
-        logger.debug("LIBRARY: playlist check complete")
+def album_terms(album):
+    """The find terms for an AlbumKey's tracks, and no one else's."""
+    terms = ['album', album.album]
+    if album.albumartist:
+        terms = ['albumartist', album.albumartist] + terms
+    if album.date:
+        terms += ['date', album.date]
+    return terms
 
-    async def refresh_genres(self):
 
-        logger.debug("LIBRARY: building genre list")
+def album_caption(album):
+    """What tells an album apart from others of the same name: its artist and date."""
+    return ', '.join(value for value in (album.albumartist, album.date) if value)
 
-        self.genres_node.reset_children()
 
-        genres = await self.mpdc.list('genre')
+def describe_totals(totals, albums=True):
+    """Totals as people read them: "12 albums, 143 tracks, 9h 42m"."""
 
-        for genre in genres:
-            this_genre = LibraryMenuList(genre, "", "")
-            self.genres_node.add_child(this_genre)
-            this_genre.add_child(SliceOpus("All songs in {}".format(genre), self.mpdc, ['genre', genre]))
+    def counted(number, noun):
+        return "{} {}{}".format(number, noun, "" if number == 1 else "s")
 
-            # By Album
+    minutes = int(totals.duration + 30) // 60
+    length = "{}h {:02}m".format(minutes // 60, minutes % 60) if minutes >= 60 else "{}m".format(minutes)
+    parts = [counted(totals.albums, "album")] if albums else []
+    return ', '.join(parts + [counted(totals.tracks, "track"), length])
 
-            by_album = LibraryMenuList("By Album", "", "")
-            this_genre.add_child(by_album)
 
-            albums = await self.mpdc.list('album', 'genre', genre)
-            for album in albums:
-                by_album.add_child(SliceOpus(album, self.mpdc, ['genre', genre, 'album', album]))
+def track_order(song):
+    """Sort an album's songs by disc, then track ("3/12" is track 3), then file."""
 
-            # By Artist
+    def number(tag):
+        value = song.get(tag, '')
+        if isinstance(value, list):
+            value = value[0]
+        try:
+            return int(value.split('/')[0])
+        except ValueError:
+            return 0
+
+    return number('disc'), number('track'), song['file']
+
+
+class LibraryMenuList(MenuList):
+    """
+    A menu of the Library. Given a totals key, its comment shows what it holds, worked out from the Library's index
+    when the menu is shown (and again once the index has changed), rather than for every menu as the tree is built.
+    """
 
-            by_artist = LibraryMenuList("By Artist", "", "")
-            this_genre.add_child(by_artist)
+    def __init__(self, name, short_name, comment, library=None, totals_key=None):
+        self.library = library
+        self.totals_key = totals_key
+        # The index totals our comment was worked out from
+        self.described = None
+        super().__init__(name, short_name, comment)
+        self.component = "library"
+        # What the node stands for in the index, to find it again when the menus are patched
+        self.index_key = name
 
-            artists = await self.mpdc.list('artist', 'genre', genre)
-            for artist in artists:
-                this_artist = LibraryMenuList(artist, "", "")
-                by_artist.add_child(this_artist)
-                this_artist.add_child(SliceOpus("All songs by {}".format(artist), self.mpdc,
-                                                ['artist', artist, 'genre', genre]))
-                this_artist_albums = LibraryMenuList("By Album", "", "")
-                this_artist.add_child(this_artist_albums)
-                artist_albums = await self.mpdc.list('album', 'artist', artist, 'genre', genre)
-                for artist_album in artist_albums:
-                    this_artist_albums.add_child(SliceOpus(artist_album,
-                                                           self.mpdc, ['album', artist_album, 'artist', artist,
-                                                                       'genre', genre]))
+    @property
+    def menu_labels(self):
+        if self.totals_key is not None and self.described is not self.library.library_index.totals:
+            self.described = self.library.library_index.totals
+            self.labels['comment'] = self.library.totals_comment(self.totals_key)
+        return self.labels
 
-        logger.debug("LIBRARY: genre list complete")
+    @menu_labels.setter
+    def menu_labels(self, labels):
+        self.labels = labels
 
-    async def refresh_artists(self):
 
-        logger.debug("LIBRARY: building artist list")
+class AlbumMenuList(LibraryMenuList):
+    """
+    An album: the whole album to play, then each of its tracks, read from mpd when the album is first entered.
 
-        self.artists_node.reset_children()
+    The tracks are kept by the Library, so each view of the album (by genre, by artist...) reads them only once,
+    until the database changes.
+    """
 
-        artists = await self.mpdc.list('artist')
+    def __init__(self, library, album):
+        super().__init__(album.album, "", album_caption(album), library, ('album', album))
+        self.album = album
+        self.index_key = album
+        # The songs our children were made from
+        self.songs = None
+        self.listing = None
+
+    def menu_enter(self):
+        songs = self.library.album_tracks.get(self.album)
+        if songs is not None:
+            if songs is not self.songs:
+                self.fill(songs)
+            return
+        if self.listing is not None and not self.listing.done():
+            return
+        if self.songs is None:
+            self.replace_children(self.children[:1] + [placeholder("Loading...", self.album.album)])
+        self.listing = asyncio.ensure_future(self.library.list_album(self))
+
+    def fill(self, songs):
+        files = [song['file'] for song in songs]
+        tracks = [TrackOpus(song, self.library.pool, files, position) for position, song in enumerate(songs)]
+        self.songs = songs
+        self.replace_children([self.library.album_opus(self.album)] + tracks)
+
+
+class LibraryOpus(MPDOpus):
+    """
+    An opus that plays a queue of tracks from the Library, and picks up where it was left when it's played again.
+    """
 
-        for artist in artists:
-            this_artist = LibraryMenuList(artist, "", "")
-            self.artists_node.add_child(this_artist)
-            this_artist.add_child(SliceOpus("All songs by {}".format(artist), self.mpdc,
-                                            ['artist', artist]))
-            this_artist_albums = LibraryMenuList("By Album", "", "")
-            this_artist.add_child(this_artist_albums)
-            artist_albums = await self.mpdc.list('album', 'artist', artist)
-            for artist_album in artist_albums:
-                this_artist_albums.add_child(SliceOpus(artist_album,
-                                                       self.mpdc, ['album', artist_album, 'artist', artist]))
+    def __init__(self, name, mpd_pool, bookmarks=None):
+        super().__init__(name, "", "", mpd_pool)
 
-        logger.debug("LIBRARY: artist list complete")
+        self.component = "library"
+        self.bookmarks = bookmarks
+
+    def opus_bookmark_key(self):
+        """What the opus' bookmark is kept under."""
+        return None
+
+    def opus_load_commands(self, start=None):
+        """
+        The commands that fill mpd's (cleared) queue with the opus' tracks.
+
+        :param start: the track (counting through the opus in order) we'll start from, if not the top
+        :return: the commands, and the queue position that track ends up in
+        """
+        return [], start or 0
+
+    def opus_mode_commands(self):
+        """The commands that set mpd's shuffle and repeat to the opus' own."""
+        commands = []
+        if self.shuffle_support:
+            commands.append(('random', self.shuffle))
+        if self.repeat_support:
+            commands.append(('repeat', self.repeat))
+        return commands
+
+    def queue_track(self, song):
+        """Which track of the opus (counting through it in order) is at a position in mpd's queue."""
+        return song
+
+    def queue_version(self):
+        # The queue only comes out the same, and a saved position means the same track, while the database does
+        return self.pool.mirror.stats.get('db_update')
+
+    def opus_play_commands(self):
+        """Load the queue, and pick up from the bookmark, if there is one, in the same command list."""
+        bookmark = None
+        if self.bookmarks is not None:
+            bookmark = self.bookmarks.get(self.opus_bookmark_key())
+            if bookmark is not None and bookmark.version != self.queue_version():
+                bookmark = None
+            self.bookmarks.active = self
+
+        if bookmark is not None:
+            if self.repeat_support:
+                self.repeat = bookmark.repeat
+            if self.shuffle_support:
+                self.shuffle = bookmark.shuffle
+
+        load, position = self.opus_load_commands(bookmark.position if bookmark is not None else None)
+        commands = [('clear',)] + load + self.opus_mode_commands()
+        if bookmark is not None:
+            commands.append(('seek', position, bookmark.elapsed))
+        elif position:
+            commands.append(('play', position))
+        else:
+            commands.append(('play',))
+        return commands
 
-    async def refresh_albums(self):
+    def opus_stop_commands(self):
+        """Note where we were before we leave."""
+        self.save_bookmark()
+        if self.bookmarks is not None and self.bookmarks.active is self:
+            self.bookmarks.active = None
+        return super().opus_stop_commands()
 
-        logger.debug("LIBRARY: building album list")
+    def opus_player_changed(self):
+        """mpd has moved on (to another track, say) while playing our queue."""
+        self.save_bookmark()
 
-        self.albums_node.reset_children()
+    def opus_adopt(self):
+        # The queue mpd kept playing through the restart is ours; keep following it
+        if self.bookmarks is not None:
+            self.bookmarks.active = self
 
-        albums = await self.mpdc.list('album')
-        for album in albums:
-            self.albums_node.add_child(SliceOpus(album, self.mpdc,
-                                                 ['album', album]))
+    def opus_next(self):
+        if self.pool.mirror.has_next():
+            self.send_commands([('next',)])
 
-        logger.debug("LIBRARY: ablum list complete")
+    def opus_previous(self):
+        # if we find more than 5 seconds into the track, previous restarts the track; elsewise,
+        # we go to the previous track in the playlist
+        if 'time' in self.pool.mirror.status:
+            if self.pool.mirror.elapsed() > 5:
+                self.send_commands([('seekcur', 0)])
+            else:
+                self.send_commands([('previous',)])
 
-    def requirements_met(self):
-        return True
+    def save_bookmark(self, status=None):
+        """
+        Remember where mpd is in our queue; once it has played to the end, there's nothing to come back to.
 
+        Only while the queue is ours: once we've been stopped, mpd's position has nothing to do with us.
 
-class LibraryMenuList(MenuList):
-    def __init__(self, name, short_name, comment):
-        super().__init__(name, short_name, comment)
-        self.component = "library"
+        :param status: mpd's status, if we've just asked for it; otherwise we go by the mirror's
+        """
+        if self.bookmarks is None or self.bookmarks.active is not self:
+            return
+        if status is None:
+            status, elapsed = self.pool.mirror.status, self.pool.mirror.elapsed()
+        else:
+            elapsed = float(status.get('elapsed', 0))
+        track = self.queue_track(int(status['song'])) if 'song' in status else None
+        if track is not None:
+            self.bookmarks.record(self.opus_bookmark_key(),
+                                  Bookmark(track, round(elapsed, 1), self.repeat, self.shuffle, self.queue_version()))
+        else:
+            self.bookmarks.forget(self.opus_bookmark_key())
 
 
-class PlaylistOpus(Opus):
-    def __init__(self, name, mpd_client):
-        super().__init__(name, "", "")
+class PlaylistOpus(LibraryOpus):
+    def __init__(self, name, mpd_pool, bookmarks=None):
+        super().__init__(name, mpd_pool, bookmarks)
 
-        self.mpdc = mpd_client
-        self.component = "library"
         # Initial play preferences
         self.random = "none"
         self.repeat = "none"
         self.playlist_name = name
-        self.pause_support = True
 
-    def opus_play(self):
-        self.mpdc.clear()
-        self.mpdc.load(self.playlist_name)
-        self.mpdc.play()
+    def opus_bookmark_key(self):
+        return "playlist:{}".format(self.playlist_name)
 
-    def opus_stop(self):
-        self.mpdc.stop()
-        self.mpdc.clear()
-
-    def opus_pause(self):
-        self.mpdc.pause(1)
-
-    def opus_unpause(self):
-        self.mpdc.pause(0)
+    def opus_load_commands(self, start=None):
+        return [('load', self.playlist_name)], start or 0
 
     def opus_get_metadata(self):
         md = {'component': self.component,
@@ -237,97 +743,271 @@ class PlaylistOpus(Opus):
         return md
 
 
-class SliceOpus(Opus):
+class SliceOpus(LibraryOpus):
     """A library collection.
 
     """
 
-    def __init__(self, name, mpd_client, find_terms):
-        super().__init__(name, "", "")
+    def __init__(self, name, mpd_pool, find_terms, bookmarks=None, resolve=None):
+        super().__init__(name, mpd_pool, bookmarks)
 
         self.find_terms = find_terms
-        self.component = "library"
-        self.mpdc = mpd_client
-        self.loop = asyncio.get_event_loop()
-        self.pause_support = True
         self.repeat_support = True
         self.shuffle_support = True
+        # The files the find terms matched when we were last prepared, and the database version they came from
+        self.staged_files = None
+        self.staged_version = None
+        # Looks up the tracks the find terms match, without asking mpd (None if it can't)
+        self.resolve = resolve
+        # While we're playing a big slice, what keeps mpd's queue topped up; top-ups go one at a time
+        self.feeder = None
+        self.feed_lock = asyncio.Lock()
+
+    def opus_bookmark_key(self):
+        return "slice:{}".format(json.dumps(canonical_terms(self.find_terms)))
+
+    async def opus_prepare(self):
+        """Look up the files we'd play, if there aren't too many, so that playing needn't search the database."""
+        version = self.pool.mirror.stats.get('db_update')
+        if self.staged_files is not None and version == self.staged_version:
+            return
+        songs = await self.pool.run('find', *self.find_terms, 'window', "0:{}".format(PRESTAGE_MAX_TRACKS + 1))
+        if len(songs) <= PRESTAGE_MAX_TRACKS:
+            self.staged_files, self.staged_version = [song['file'] for song in songs], version
+
+    def opus_unprepare(self):
+        self.staged_files = self.staged_version = None
+
+    def opus_load_commands(self, start=None):
+        """
+        Big slices, and shuffled ones (so that we do the shuffling), are fed to mpd a window at a time; smaller ones
+        played in order are loaded whole.
+        """
+        resolved = self.fed_tracks()
+        if resolved is not None:
+            tracks, ids = resolved
+            if start is not None and start >= len(ids):
+                start = None
+            self.feeder = QueueFeeder(tracks, ids, start, self.shuffle, self.repeat)
+            return self.feeder.start_commands(), 0
+
+        self.feeder = None
+        if self.staged_files and self.staged_version == self.pool.mirror.stats.get('db_update'):
+            return [('add', file) for file in self.staged_files], start or 0
+        return [('findadd',) + tuple(self.find_terms)], start or 0
+
+    def fed_tracks(self):
+        """Our tracks, as resolve gives them, if they're fed to mpd a window at a time; otherwise None."""
+        resolved = self.resolve(self.find_terms) if self.resolve is not None else None
+        if resolved is not None and resolved[1] and (self.shuffle or len(resolved[1]) > WINDOWED_THRESHOLD):
+            return resolved
+        return None
+
+    def opus_adopt(self):
+        """
+        The server we took over from was feeding us to mpd a window at a time, and mpd will stop at the end of the
+        window unless we carry on; start feeding again from the track it's playing.
+        """
+        super().opus_adopt()
+        resolved = self.fed_tracks()
+        if resolved is not None:
+            self.feeder = QueueFeeder(*resolved, shuffle=self.shuffle, repeat=self.repeat)
+            asyncio.run_coroutine_threadsafe(self.take_over(self.feeder), self.loop)
+
+    async def take_over(self, feeder):
+        """Make the window the last server left in mpd's queue our own."""
+        async with self.feed_lock:
+            if feeder is not self.feeder:
+                return
+            try:
+                status, current = await self.pool.command_list([('status',), ('currentsong',)], control=False)
+                position = feeder.position_of(current.get('file'))
+                if 'song' not in status or position is None:
+                    logger.warning("LIBRARY: mpd isn't playing {} any more; not taking it over".format(self))
+                    self.feeder = None
+                    return
+                await self.pool.command_list(feeder.take_over_commands(int(status['song']),
+                                                                       int(status['playlistlength']), position))
+            except Exception as e:
+                logger.error("LIBRARY: could not take over the queue for {}: {}".format(self, e))
+
+    def opus_mode_commands(self):
+        if self.feeder is not None:
+            # The order we feed the tracks in does the shuffling and repeating; mpd only ever sees the window
+            return [('random', 0), ('repeat', 0)]
+        return super().opus_mode_commands()
+
+    def queue_track(self, song):
+        if self.feeder is not None:
+            return self.feeder.index_at(song)
+        return song
+
+    def opus_stop_commands(self):
+        commands = super().opus_stop_commands()
+        self.feeder = None
+        return commands
+
+    def opus_player_changed(self):
+        if self.feeder is None:
+            super().opus_player_changed()
+        else:
+            asyncio.run_coroutine_threadsafe(self.refeed(self.feeder, self.feeder.top_up_commands), self.loop)
+
+    async def refeed(self, feeder, compose):
+        """
+        Bring mpd's queue in line with the feeder, from where mpd actually is now.
+
+        :param compose: makes the commands, given the queue position mpd is playing
+        """
+        async with self.feed_lock:
+            if feeder is not self.feeder:
+                return
+            try:
+                # The mirror has just refreshed the status, if a player event brought us here
+                status = self.pool.mirror.status
+                if 'song' not in status:
+                    return
+                self.save_bookmark(status)
+                commands = compose(int(status['song']))
+                if commands:
+                    await self.pool.command_list(commands)
+                    # Trimming the queue moves mpd's position; make sure the next refeed doesn't start from the old one
+                    await self.pool.mirror.refresh(['status'])
+            except Exception as e:
+                logger.error("LIBRARY: could not top up the queue for {}: {}".format(self, e))
+
+    def opus_enqueue(self):
+        self.send_commands([('findadd',) + tuple(self.find_terms)])
 
-    def opus_play(self):
-        asyncio.run_coroutine_threadsafe(self._opus_play(), self.loop)
+    def opus_update_shuffle(self):
+        if self.feeder is None and self.shuffle and self.resolve is not None:
+            # Take over the queue mpd has, which is the whole slice in order, so that we can do the shuffling
+            resolved = self.resolve(self.find_terms)
+            if resolved is not None:
+                self.feeder = QueueFeeder(*resolved, repeat=self.repeat)
+                self.feeder.adopt()
 
-    async def _opus_play(self):
-        await self.mpdc.clear()
-        await self.mpdc.findadd(*self.find_terms)
-        await self.mpdc.random(self.shuffle)
-        await self.mpdc.repeat(self.repeat)
-        await self.mpdc.play()
+        if self.feeder is not None:
+            feeder = self.feeder
 
-    def opus_stop(self):
-        asyncio.run_coroutine_threadsafe(self._opus_stop(), self.loop)
+            def reorder(song):
+                return self.opus_mode_commands() + feeder.reorder_commands(song, self.shuffle)
 
-    async def _opus_stop(self):
-        await self.mpdc.stop()
-        await self.mpdc.clear()
+            asyncio.run_coroutine_threadsafe(self.refeed(feeder, reorder), self.loop)
+        else:
+            self.send_commands([('random', self.shuffle)])
 
-    def opus_pause(self):
-        asyncio.run_coroutine_threadsafe(self._opus_pause(), self.loop)
+    def opus_update_repeat(self):
+        if self.feeder is not None:
+            self.feeder.repeat = self.repeat
+            asyncio.run_coroutine_threadsafe(self.refeed(self.feeder, self.feeder.top_up_commands), self.loop)
+        else:
+            self.send_commands([('repeat', self.repeat)])
 
-    async def _opus_pause(self):
-        await self.mpdc.pause(1)
+    def opus_get_metadata(self):
+        md = {'component': self.component,
+              'type': 'slice',
+              'name': self.menu_labels['name'],
+              'terms': self.find_terms,
+              }
+        return md
 
-    def opus_unpause(self):
-        asyncio.run_coroutine_threadsafe(self._opus_unpause(), self.loop)
 
-    async def _opus_unpause(self):
-        await self.mpdc.pause(0)
+class TrackOpus(LibraryOpus):
+    """
+    One track of an album: plays the whole album, from that track on.
 
-    def opus_next(self):
-        asyncio.run_coroutine_threadsafe(self._opus_next(), self.loop)
+    As a favorite it's saved as the one-track slice it names, since the album around it may not be there next time.
+    """
 
-    async def _opus_next(self):
-        curr_status = {}
-        try:
-            curr_status = await self.mpdc.status()
-        except Exception as e:
-            logger.error("Status error: %s", e)
-        else:
-            logger.debug("Status success!")
+    def __init__(self, song, mpd_pool, files, position):
+        def tag(key):
+            value = song.get(key, "")
+            return ', '.join(value) if isinstance(value, list) else value
 
-        if 'nextsong' in curr_status:
-            await self.mpdc.next()
+        super().__init__(tag('title') or os.path.basename(song['file']), mpd_pool)
+        self.menu_labels['shortname'] = tag('track').split('/')[0]
+        self.menu_labels['comment'] = tag('artist')
+        self.repeat_support = True
+        self.file = song['file']
+        # The album's files, which we all share, and where we come in them
+        self.files = files
+        self.position = position
 
-    def opus_previous(self):
-        asyncio.run_coroutine_threadsafe(self._opus_previous(), self.loop)
+    def opus_load_commands(self, start=None):
+        return [('add', file) for file in self.files], self.position if start is None else start
 
-    async def _opus_previous(self):
-        # if we find more than 5 seconds into the track, previous restarts the track; elsewise,
-        # we go to the previous track in the playlist
-        curr_status = {}
-        try:
-            curr_status = await self.mpdc.status()
-        except Exception as e:
-            logger.error("Status error: %s", e)
-        else:
-            logger.debug("Status success!")
+    def opus_enqueue(self):
+        self.send_commands([('add', self.file)])
 
-        if 'time' in curr_status:
-            elapsed_secs = curr_status['time'].split(':')[0]
-            if int(elapsed_secs) > 5:
-                await self.mpdc.seekcur(0)
-            else:
-                await self.mpdc.previous()
+    def opus_get_metadata(self):
+        md = {'component': self.component,
+              'type': 'slice',
+              'name': self.menu_labels['name'],
+              'terms': ['file', self.file],
+              }
+        return md
 
-    def opus_update_shuffle(self):
-        self.mpdc.random(self.shuffle)
 
-    def opus_update_repeat(self):
-        self.mpdc.repeat(self.repeat)
+class SmartOpus(SliceOpus):
+    """
+    A smart playlist: the tracks of the Library that meet its rule, as the Library last worked them out.
+
+    It plays like a slice, but its tracks come from the playlist rather than a find, so it can only play while the
+    index is up to date with mpd's database.
+    """
+
+    def __init__(self, playlist, mpd_pool, bookmarks=None, resolve=None):
+        super().__init__(playlist.name, mpd_pool, [], bookmarks, lambda find_terms: resolve(playlist))
+        self.menu_labels['comment'] = playlist.rule.text
+        self.playlist = playlist
+        # Which version of the playlist's tracks we loaded into mpd
+        self.loaded_generation = None
+
+    def opus_bookmark_key(self):
+        return "smart:{}".format(self.playlist.name)
+
+    def queue_version(self):
+        # Plays and time move tracks in and out of the playlist, as well as the database; a position only means the
+        # same track while the playlist is as it was when we loaded it
+        if self.bookmarks is not None and self.bookmarks.active is self:
+            generation = self.loaded_generation
+        else:
+            generation = self.playlist.generation
+        return "{}:{}".format(super().queue_version(), generation)
+
+    async def opus_prepare(self):
+        # Our tracks are already worked out
+        pass
+
+    def opus_adopt(self):
+        # The tracks mpd has are those of the playlist as it is now, as near as we can tell
+        self.loaded_generation = self.playlist.generation
+        super().opus_adopt()
+
+    def opus_load_commands(self, start=None):
+        self.feeder = None
+        resolved = self.resolve(None)
+        if resolved is None:
+            logger.error("LIBRARY: can't play {} until the index catches up with the database".format(self))
+            return [], 0
+        self.loaded_generation = self.playlist.generation
+        tracks, ids = resolved
+        if not ids:
+            return [], 0
+        if self.shuffle or len(ids) > WINDOWED_THRESHOLD:
+            return super().opus_load_commands(start)
+        return [('add', tracks[n].file) for n in ids], start if start is not None and start < len(ids) else 0
+
+    def opus_enqueue(self):
+        resolved = self.resolve(None)
+        if resolved is not None:
+            tracks, ids = resolved
+            self.send_commands([('add', tracks[n].file) for n in ids])
 
     def opus_get_metadata(self):
         md = {'component': self.component,
-              'type': 'slice',
+              'type': 'smart',
               'name': self.menu_labels['name'],
-              'terms': self.find_terms,
               }
         return md
@@ -0,0 +1,136 @@
+"""
+The Library by folder, as the files lie in mpd's music directory.
+
+Untagged material (live recordings, field audio) never makes it into the Genres, Artists and Albums menus, which are
+built from tags; here it can be found where it lies. Each folder is listed with lsinfo the first time it's entered,
+and the listing kept until mpd's database changes. A folder with a great many entries is split into pages, so that
+no menu frame has to carry thousands of names.
+"""
+
+import asyncio
+import os
+import weakref
+
+from base_classes import Command, MenuList
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The most entries a folder's menu shows at once; bigger folders are split into pages of this many
+FOLDER_PAGE = 100
+
+
+def placeholder(name, comment=""):
+    """A menu entry that stands in for a folder's contents while there aren't any to show."""
+    node = Command(name, "", comment)
+    node.component = "library"
+    return node
+
+
+class FolderMenuList(MenuList):
+    """
+    A folder in the music directory, filled in when it's first entered.
+    """
+
+    def __init__(self, browser, path, name, short_name="", comment=None):
+        super().__init__(name, short_name, path if comment is None else comment)
+        self.component = "library"
+        self.browser = browser
+        self.path = path
+        # Whether our children are a listing that is still current
+        self.listed = False
+        self.listing = None
+
+    def menu_enter(self):
+        if self.listed or (self.listing is not None and not self.listing.done()):
+            return
+        if not self.children:
+            self.replace_children([placeholder("Loading...", self.path)])
+        self.listing = asyncio.ensure_future(self.browser.list(self))
+
+
+class FolderBrowser:
+    """
+    The Folders menu, and the listings of the folders under it.
+    """
+
+    def __init__(self, pool, slice_opus, on_change=None, page=FOLDER_PAGE):
+        self.pool = pool
+        # Makes (or finds) the Library's opus for a slice, given its name and find terms
+        self.slice_opus = slice_opus
+        # Called when a listing arrives
+        self.on_change = on_change
+        self.page = page
+        self.root = FolderMenuList(self, "", "Folders", "Fld", "Library By Folder")
+        # The folders holding a listing, so a database change can let go of them
+        self.listed = weakref.WeakSet()
+
+    def database_changed(self):
+        """The music directory may have changed; folders are listed again when they're next entered."""
+        for folder in self.listed:
+            folder.listed = False
+        self.listed = weakref.WeakSet()
+
+    async def list(self, folder):
+        try:
+            entries = await self.pool.run('lsinfo', folder.path)
+        except Exception as e:
+            logger.error("LIBRARY: could not list folder '{}': {}".format(folder.path, e))
+            if not folder.listed:
+                folder.replace_children([placeholder("Couldn't read this folder", str(e))])
+        else:
+            folder.replace_children(self.build(folder, entries))
+            folder.listed = True
+            self.listed.add(folder)
+        if self.on_change is not None:
+            self.on_change()
+
+    def build(self, folder, entries):
+        """
+        The children of a folder: the whole folder to play, then its folders and files, a page at a time if there are
+        too many. Folders we already have are kept, so anyone inside one stays there.
+        """
+        existing = {child.path: child for child in self.children_of(folder) if isinstance(child, FolderMenuList)}
+        items = []
+        for entry in entries:
+            if 'directory' in entry:
+                path = entry['directory']
+                child = existing.get(path) or FolderMenuList(self, path, os.path.basename(path))
+                items.append(child)
+            elif 'file' in entry:
+                items.append(self.file_opus(entry))
+
+        if len(items) > self.page:
+            pages = [items[start:start + self.page] for start in range(0, len(items), self.page)]
+            items = [self.page_of(number, page) for number, page in enumerate(pages)]
+
+        if folder.path:
+            items.insert(0, self.slice_opus("All of {}".format(folder.menu_labels['name']), ['base', folder.path]))
+        return items
+
+    @staticmethod
+    def children_of(folder):
+        """Everything in a folder's menu, looking inside its pages."""
+        for child in folder.children:
+            if isinstance(child, MenuList) and not isinstance(child, FolderMenuList):
+                yield from child.children
+            else:
+                yield child
+
+    @staticmethod
+    def page_of(number, items):
+        first, last = items[0].menu_labels['name'], items[-1].menu_labels['name']
+        page = MenuList("{} - {}".format(first, last), "p{}".format(number + 1), "{} entries".format(len(items)))
+        page.component = "library"
+        page.replace_children(items)
+        return page
+
+    def file_opus(self, song):
+        def tag(key):
+            value = song.get(key, "")
+            return ', '.join(value) if isinstance(value, list) else value
+
+        opus = self.slice_opus(tag('title') or os.path.basename(song['file']), ['file', song['file']])
+        opus.menu_labels['comment'] = ' - '.join(value for value in (tag('artist'), tag('album')) if value)
+        return opus
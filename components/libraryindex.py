@@ -0,0 +1,354 @@
+"""
+An index of the tracks in the mpd database, and the tags the Library menus are built from.
+
+The whole database is read in a handful of bulk queries (a page of tracks at a time), and everything the menus need
+is worked out from that in memory, rather than asking mpd about every genre, artist and album in turn.
+
+Keeping the index from the last refresh lets us work out what a database change actually touched, so that only
+those branches of the Library menus need to be rebuilt. The index is also cached on disk, labelled with mpd's
+database version, so that when the database hasn't changed between runs we don't have to read it at all.
+"""
+
+from array import array
+from collections import namedtuple
+from datetime import datetime
+import asyncio
+import itertools
+import locale
+import re
+import time
+
+from components.librarysearch import fold
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The tags we keep for each track
+TRACK_TAGS = ('title', 'artist', 'albumartist', 'album', 'genre', 'composer', 'date', 'track', 'disc')
+
+# A filter matching every song in the database
+ALL_SONGS = "(modified-since '0')"
+
+# How many tracks to ask mpd for at a time; mpd won't send more than fits in its output buffer in one answer
+PAGE_SIZE = 5000
+
+# How many queries to have outstanding with mpd at once while reading the database
+CONCURRENCY = 2
+
+# Albums of the same name by the same artist are told apart by their date (an album and its reissue, say)
+ALBUM_DATES = True
+
+# Leading words names are sorted without ("The Beatles" sorts under B)
+SORT_ARTICLES = re.compile(r'^(the|a|an)\s+', re.IGNORECASE)
+
+# Bump when the cached form of the index changes, so old caches are ignored
+CACHE_FORMAT = 3
+
+
+# Which album a track is on: "Greatest Hits" by one artist isn't "Greatest Hits" by another
+AlbumKey = namedtuple('AlbumKey', ('albumartist', 'album', 'date'))
+
+# How much music a genre, artist or album holds: its number of albums and tracks, and their length in seconds
+Totals = namedtuple('Totals', ('albums', 'tracks', 'duration'))
+
+
+def collation_key(text):
+    """A key that sorts names the way people expect: by the locale's rules, ignoring case, accents, and a leading
+    article."""
+    return locale.strxfrm(fold(SORT_ARTICLES.sub('', text.strip()) or text)), text
+
+
+def timestamp(text):
+    """Seconds since the epoch of one of mpd's ISO 8601 times ("2024-05-01T12:00:00Z"); 0 if there isn't one."""
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+async def run_limited(pool, limit, command, *args):
+    """Run an mpd command once the semaphore lets another query go."""
+    async with limit:
+        return await pool.run(command, *args)
+
+
+class Track:
+    """
+    One song in the database: its file, duration, when it was added (as mpd saw it), and tags. Tags that mpd reports
+    more than once are lists.
+    """
+
+    __slots__ = ('file', 'duration', 'modified') + TRACK_TAGS
+
+    def __init__(self, song):
+        self.file = song['file']
+        try:
+            self.duration = float(song.get('duration', song.get('time', 0)))
+        except ValueError:
+            self.duration = 0.0
+        # mpd only says when a song was added from 0.24; before then, its file's time is the best we have
+        self.modified = timestamp(song.get('added', song.get('last-modified')))
+        for tag in TRACK_TAGS:
+            setattr(self, tag, song.get(tag, ''))
+
+    @classmethod
+    def from_tuple(cls, values):
+        """Rebuild a track from its as_tuple() form."""
+        track = cls.__new__(cls)
+        for slot, value in zip(cls.__slots__, values):
+            setattr(track, slot, value)
+        return track
+
+    def as_tuple(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def values(self, tag):
+        """All of the non-empty values of a tag, as a list."""
+        value = getattr(self, tag)
+        if isinstance(value, list):
+            return [v for v in value if v]
+        return [value] if value else []
+
+    def album_artists(self):
+        """The artists of the track's album; as with mpd, the track's own artists if it doesn't say."""
+        return self.values('albumartist') or self.values('artist')
+
+    def album_keys(self):
+        """The albums the track is on (usually just the one)."""
+        artists = self.album_artists()
+        dates = self.values('date') if ALBUM_DATES else []
+        return [AlbumKey(artists[0] if artists else '', album, dates[0] if dates else '')
+                for album in self.values('album')]
+
+
+class LibraryIndex:
+    """
+    The tracks and playlists in the mpd database, and the genres, artists and albums they make up.
+
+    genres maps each genre to {'albums': set of albums, 'artists': {artist: set of albums}}; artists maps each
+    artist to the set of their albums. Albums are AlbumKeys.
+
+    totals holds the Totals of everything the menus show, keyed by ('genre', genre), ('artist', artist),
+    ('genre', genre, artist) for an artist within a genre, and ('album', album). They're added up the first time
+    they're asked for, since only the menus being shown need them.
+    """
+
+    def __init__(self, playlists=(), tracks=(), db_update=None):
+        self.playlists = set(playlists)
+        self.tracks = list(tracks)
+        # The version of the mpd database (its last update time) the tracks were read from
+        self.db_update = db_update
+        self.genres = {}
+        self.artists = {}
+        self.albums = set()
+        # Collation keys of the names in the menus, worked out once per name
+        self.sort_keys = {}
+        self.summed_totals = None
+
+        for track in self.tracks:
+            albums = track.album_keys()
+            artists = track.values('artist')
+            self.albums.update(albums)
+            for artist in artists:
+                self.artists.setdefault(artist, set()).update(albums)
+            for genre in track.values('genre'):
+                this_genre = self.genres.setdefault(genre, {'albums': set(), 'artists': {}})
+                this_genre['albums'].update(albums)
+                for artist in artists:
+                    this_genre['artists'].setdefault(artist, set()).update(albums)
+
+    @property
+    def totals(self):
+        if self.summed_totals is None:
+            self.summed_totals = self.sum_totals()
+        return self.summed_totals
+
+    def sum_totals(self):
+        """Add up the track counts and durations of everything the menus show, in one pass over the tracks."""
+        sums = {}
+
+        def count(key, duration):
+            tally = sums.get(key)
+            if tally is None:
+                sums[key] = [1, duration]
+            else:
+                tally[0] += 1
+                tally[1] += duration
+
+        for track in self.tracks:
+            artists = track.values('artist')
+            for album in track.album_keys():
+                count(('album', album), track.duration)
+            for artist in artists:
+                count(('artist', artist), track.duration)
+            for genre in track.values('genre'):
+                count(('genre', genre), track.duration)
+                for artist in artists:
+                    count(('genre', genre, artist), track.duration)
+
+        return {key: Totals(self.album_count(key), tracks, round(duration, 3))
+                for key, (tracks, duration) in sums.items()}
+
+    def with_playlists(self, playlists):
+        """A copy of this index with a different set of stored playlists."""
+        index = LibraryIndex(playlists, db_update=self.db_update)
+        index.tracks, index.genres, index.artists, index.albums = self.tracks, self.genres, self.artists, self.albums
+        index.sort_keys = self.sort_keys
+        index.summed_totals = self.summed_totals
+        return index
+
+    def album_count(self, key):
+        """How many albums a totals key covers."""
+        if key[0] == 'album':
+            return 1
+        if key[0] == 'artist':
+            return len(self.artists[key[1]])
+        if len(key) == 2:
+            return len(self.genres[key[1]]['albums'])
+        return len(self.genres[key[1]]['artists'][key[2]])
+
+    def sort_key(self, name):
+        """The collation key of a genre's, artist's or playlist's name."""
+        key = self.sort_keys.get(name)
+        if key is None:
+            key = self.sort_keys[name] = collation_key(name)
+        return key
+
+    def album_sort_key(self, album):
+        """Albums sort by title, then artist, then date."""
+        return self.sort_key(album.album), self.sort_key(album.albumartist), album.date
+
+    def sorted_albums(self, albums):
+        """Albums in album_sort_key order, working out their artists' keys only for albums that share a title."""
+        ordered = []
+        for _, group in itertools.groupby(sorted(albums, key=lambda album: self.sort_key(album.album)),
+                                          key=lambda album: self.sort_key(album.album)):
+            group = list(group)
+            if len(group) > 1:
+                group.sort(key=lambda album: (self.sort_key(album.albumartist), album.date))
+            ordered += group
+        return ordered
+
+    @staticmethod
+    async def fetch_playlists(pool, limit=None):
+        """
+        :param limit: a semaphore bounding how many queries we keep going with mpd at once, if we're one of several
+        """
+        playlists = await run_limited(pool, limit or asyncio.Semaphore(), 'listplaylists')
+        return {p['playlist'] for p in playlists}
+
+    @staticmethod
+    async def fetch_tracks(pool, songs, concurrency=CONCURRENCY, limit=None):
+        """
+        Read every track in the database, a page at a time, with several pages in flight at once.
+
+        :param songs: how many songs the database stats say there are, so we can ask for every page up front
+        :param limit: a semaphore bounding how many queries are in flight, if it's shared with other queries;
+                      otherwise at most concurrency are
+        """
+        limit = limit or asyncio.Semaphore(concurrency)
+
+        def fetch_page(n):
+            return run_limited(pool, limit, 'find', ALL_SONGS, 'window',
+                               "{}:{}".format(n * PAGE_SIZE, (n + 1) * PAGE_SIZE))
+
+        pages = list(await asyncio.gather(*(fetch_page(n) for n in range(max(1, -(-songs // PAGE_SIZE))))))
+
+        # If the database grew since the stats were taken, carry on until we see the end of it
+        while len(pages[-1]) == PAGE_SIZE:
+            pages.append(await fetch_page(len(pages)))
+
+        return [Track(song) for page in pages for song in page]
+
+    @classmethod
+    async def fetch(cls, pool, concurrency=CONCURRENCY, timings=None):
+        """
+        Build an index of everything in the database.
+
+        :param timings: if given, a dict to record how long (in seconds) the playlists and tracks took to read
+        """
+        if timings is None:
+            timings = {}
+
+        async def timed(branch, fetch):
+            start = time.perf_counter()
+            result = await fetch
+            timings[branch] = time.perf_counter() - start
+            return result
+
+        # Every query of the refresh counts towards the one limit, so the connections it leaves free stay free
+        limit = asyncio.Semaphore(concurrency)
+
+        async def read_tracks():
+            # Take the version before reading, so that if the database changes while we read, we err towards
+            # reading it again next time
+            stats = await run_limited(pool, limit, 'stats')
+            return stats.get('db_update'), await cls.fetch_tracks(pool, int(stats.get('songs', 0)), limit=limit)
+
+        playlists, (db_update, tracks) = await asyncio.gather(timed('playlists', cls.fetch_playlists(pool, limit)),
+                                                              timed('tracks', read_tracks()))
+        logger.debug("LIBRARY: indexed %d tracks", len(tracks))
+        return cls(playlists, tracks, db_update)
+
+    def match_ids(self, find_terms):
+        """
+        Where the tracks an mpd 'find' with these terms would give are in our list of tracks, in the same order,
+        without asking mpd.
+
+        :return: a compact array of positions in self.tracks, or None if the terms use a tag we don't keep
+        """
+        tests = []
+        for tag, value in zip(find_terms[0::2], find_terms[1::2]):
+            if tag == 'file':
+                tests.append(lambda track, value=value: track.file == value)
+            elif tag == 'albumartist':
+                tests.append(lambda track, value=value: value in track.album_artists())
+            elif tag == 'base':
+                tests.append(lambda track, prefix=value.rstrip('/') + '/': track.file.startswith(prefix))
+            elif tag in TRACK_TAGS:
+                tests.append(lambda track, tag=tag, value=value: value in track.values(tag))
+            else:
+                return None
+        return array('I', (n for n, track in enumerate(self.tracks) if all(test(track) for test in tests)))
+
+    def match(self, find_terms):
+        """The tracks an mpd 'find' with these terms would give, or None if we can't tell."""
+        ids = self.match_ids(find_terms)
+        return None if ids is None else [self.tracks[n] for n in ids]
+
+    # Caching the index on disk
+
+    def to_cache(self):
+        return {'format': CACHE_FORMAT,
+                'db_update': self.db_update,
+                'playlists': sorted(self.playlists),
+                'tracks': [track.as_tuple() for track in self.tracks],
+                }
+
+    @classmethod
+    def from_cache(cls, cached):
+        """
+        Rebuild an index from its to_cache() form; None if there's no usable cache.
+        """
+        if not isinstance(cached, dict) or cached.get('format') != CACHE_FORMAT:
+            return None
+        return cls(cached['playlists'], [Track.from_tuple(t) for t in cached['tracks']], cached['db_update'])
+
+    def diff(self, other):
+        """
+        What changed between this index and a newer one.
+
+        :return: for each branch (playlists, genres, artists, albums), the set of keys that were added, removed,
+                 or (for genres and artists) now have different contents
+        """
+        return {'playlists': self.playlists ^ other.playlists,
+                'genres': changed_keys(self.genres, other.genres),
+                'artists': changed_keys(self.artists, other.artists),
+                'albums': self.albums ^ other.albums,
+                }
+
+
+def changed_keys(old, new):
+    """The keys of two dicts that are only in one of them, or that map to different values."""
+    return {key for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
@@ -0,0 +1,165 @@
+"""
+What's in mpd's queue, around the track playing.
+
+The Queue menu keeps its own copy of mpd's queue, brought up to date with plchanges: mpd numbers each version of the
+queue, and can tell us just the positions that changed since the version we last saw, so a change to a long queue
+costs a few entries rather than a re-read of the whole thing. The menu itself shows a window of the queue around the
+track playing, and selecting an entry jumps playback to it.
+"""
+
+import asyncio
+import os
+
+from base_classes import Command, MenuList
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How many entries the menu shows before and after the track playing
+QUEUE_VIEW_BEHIND = 5
+QUEUE_VIEW_AHEAD = 30
+
+
+def describe(song):
+    """The (id, name, comment) we keep for a queue entry, from mpd's description of it."""
+
+    def tag(key):
+        value = song.get(key, "")
+        return ', '.join(value) if isinstance(value, list) else value
+
+    name = tag('title') or tag('name') or os.path.basename(song.get('file', "").rstrip('/'))
+    comment = ' - '.join(value for value in (tag('artist'), tag('album')) if value)
+    return int(song['id']), name, comment
+
+
+class QueueEntry(Command):
+    """One track in the queue; selecting it plays it."""
+
+    def __init__(self, view, songid, name, comment):
+        super().__init__(name, "", comment)
+        self.component = "library"
+        self.view = view
+        self.songid = songid
+
+    def command_execute(self):
+        self.view.play(self.songid)
+
+
+class QueueView(MenuList):
+    """
+    A window onto mpd's queue.
+
+    songs holds (id, name, comment) for every position in the queue, as of the queue version in version.
+    """
+
+    def __init__(self, pool, on_change=None, behind=QUEUE_VIEW_BEHIND, ahead=QUEUE_VIEW_AHEAD):
+        super().__init__("Queue", "Que", "What's queued")
+        self.component = "library"
+        self.pool = pool
+        # Called when the entries shown change on their own (not in answer to the user)
+        self.on_change = on_change
+        self.behind = behind
+        self.ahead = ahead
+
+        self.songs = []
+        self.version = None
+        # The entries shown, by id, and where each is in the queue
+        self.entries = {}
+        self.shown = ()
+        self.stale = False
+        self.refresh_task = None
+
+    def start(self):
+        self.pool.mirror.add_listener(self.queue_changed, ('playlist', 'player'))
+        if self.pool.mirror.status:
+            self.queue_changed(['playlist'])
+
+    def stop(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+
+    def queue_changed(self, changed):
+        """
+        Hear about changes to the queue, or to which track is playing.
+
+        Queue changes that arrive while we're already catching up are gathered into the next plchanges.
+        """
+        if 'playlist' not in changed:
+            self.show()
+            return
+        self.stale = True
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.ensure_future(self.refresh())
+
+    async def refresh(self):
+        while self.stale:
+            self.stale = False
+            status = self.pool.mirror.status
+            version = int(status.get('playlist', 0))
+            length = int(status.get('playlistlength', 0))
+            # A restarted mpd starts counting versions again, and then we have to start again too
+            since = self.version if self.version is not None and self.version <= version else 0
+            try:
+                changes = await self.pool.run('plchanges', since)
+            except Exception as e:
+                logger.error("Could not read the changes to the queue: {}".format(e))
+                # Try again with the next change (mpd tells us about everything when it comes back)
+                return
+            self.apply(changes, length, version)
+            self.show()
+
+    def apply(self, changes, length, version):
+        """
+        Patch our copy of the queue.
+
+        The status we had the length from can be a little behind plchanges; anything it missed comes round
+        again with the next change.
+        """
+        del self.songs[length:]
+        for song in changes:
+            pos = int(song['pos'])
+            while len(self.songs) <= pos:
+                self.songs.append(None)
+            self.songs[pos] = describe(song)
+        self.version = version
+
+    def show(self):
+        """Bring the entries shown into line with the queue and the track playing."""
+        song = self.pool.mirror.status.get('song')
+        current = int(song) if song is not None else 0
+        start = max(0, current - self.behind)
+        end = min(len(self.songs), current + self.ahead + 1)
+
+        shown = tuple((pos, self.songs[pos]) for pos in range(start, end) if self.songs[pos] is not None)
+        if song is not None:
+            self.menu_labels['comment'] = "Playing {} of {}".format(current + 1, len(self.songs))
+        else:
+            self.menu_labels['comment'] = "{} queued".format(len(self.songs))
+        if shown == self.shown:
+            return
+
+        entries = {}
+        children = []
+        for pos, (songid, name, comment) in shown:
+            entry = self.entries.get(songid)
+            if entry is None:
+                entry = QueueEntry(self, songid, name, comment)
+            entry.menu_labels['shortname'] = str(pos + 1)
+            entries[songid] = entry
+            children.append(entry)
+        self.entries = entries
+        self.shown = shown
+        self.replace_children(children)
+
+        if self.on_change is not None:
+            self.on_change()
+
+    def play(self, songid):
+        asyncio.ensure_future(self.send([('playid', songid)]))
+
+    async def send(self, commands):
+        try:
+            await self.pool.command_list(commands)
+        except Exception as e:
+            logger.error("Could not jump to a track in the queue: {}".format(e))
@@ -0,0 +1,90 @@
+"""
+Full text search over the tags of the tracks in the Library.
+
+An inverted index maps every word in the searchable tags to the tracks it appears in, so a query is answered from
+memory, without asking mpd. Words are accent-folded and case-folded both in the index and in the query, so "bjork"
+finds Björk. Every word of the query has to match a word in the track, as the start of that word, so results narrow
+as the query is typed.
+"""
+
+import bisect
+import re
+import unicodedata
+
+# The tags we search, and how much a match in each counts towards a track's rank
+FIELD_WEIGHTS = {'title': 4, 'artist': 3, 'albumartist': 3, 'album': 2, 'composer': 2, 'genre': 1}
+
+# How much less a word counts when the query only matches its start
+PREFIX_FACTOR = 0.25
+
+# The most results a search returns
+SEARCH_LIMIT = 50
+
+WORD = re.compile(r'\w+')
+
+
+def fold(text):
+    """Lower case, with accents and other combining marks taken off."""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def tokenize(text):
+    return WORD.findall(fold(text))
+
+
+class SearchIndex:
+    """
+    Words in the tracks' tags, mapped to the tracks they're in.
+
+    postings maps each word to {track number: weight}, the weight being that of the heaviest tag the word is in.
+    """
+
+    def __init__(self, tracks=()):
+        self.tracks = list(tracks)
+        self.postings = {}
+
+        for n, track in enumerate(self.tracks):
+            for tag, weight in FIELD_WEIGHTS.items():
+                for value in track.values(tag):
+                    for word in tokenize(value):
+                        posting = self.postings.setdefault(word, {})
+                        if posting.get(n, 0) < weight:
+                            posting[n] = weight
+
+        # The vocabulary in order, to find every word starting with a prefix
+        self.words = sorted(self.postings)
+
+    def matches(self, prefix):
+        """{track number: score} for the tracks with a word that starts with prefix."""
+        scores = {}
+        start = bisect.bisect_left(self.words, prefix)
+        for word in self.words[start:]:
+            if not word.startswith(prefix):
+                break
+            factor = 1 if word == prefix else PREFIX_FACTOR
+            for n, weight in self.postings[word].items():
+                if scores.get(n, 0) < weight * factor:
+                    scores[n] = weight * factor
+        return scores
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        The tracks matching every word of a query, best first.
+
+        :return: a list of Tracks, ranked by the weight of the tags they matched in, then in database order
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+
+        # Start from the rarest word, so the candidates only shrink
+        scored = sorted((self.matches(word) for word in set(words)), key=len)
+        totals = dict(scored[0])
+        for scores in scored[1:]:
+            totals = {n: total + scores[n] for n, total in totals.items() if n in scores}
+            if not totals:
+                return []
+
+        ranked = sorted(totals, key=lambda n: (-totals[n], n))
+        return [self.tracks[n] for n in ranked[:limit]]
@@ -0,0 +1,63 @@
+"""
+What the Library has played: how many times each file has been played, and when it last was.
+
+Smart playlists like "never played" or "played within 7 days" are worked out from this. A play is counted when mpd
+starts playing a song; the history is written with the same coalescing as the bookmarks, and kept as short lists
+rather than dicts to keep the file small.
+"""
+
+import time
+
+from persistence import CoalescingWriter, read_json
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FILE = "saved/library_history.json"
+# How long to gather plays before writing them (seconds)
+HISTORY_DELAY = 5.0
+
+
+class PlayHistory:
+    """
+    The plays of each file, as [times played, last played (seconds since the epoch)].
+    """
+
+    def __init__(self, path=HISTORY_FILE, delay=HISTORY_DELAY):
+        self.writer = CoalescingWriter(path, self.compose, delay)
+        self.played = {}
+        for file, saved in (read_json(path, default={}) or {}).items():
+            if isinstance(saved, list) and len(saved) == 2:
+                self.played[file] = saved
+            else:
+                logger.error("Ignoring damaged play history for {}: {}".format(file, saved))
+        # Called with the set of files whose history changed
+        self.listeners = []
+
+    def compose(self):
+        return self.played
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def record(self, file, when=None):
+        """Count a play of a file, now unless we say when."""
+        when = time.time() if when is None else when
+        plays = self.played.get(file, [0, 0])
+        self.played[file] = [plays[0] + 1, round(when)]
+        self.writer.mark_dirty()
+        for callback in self.listeners:
+            callback({file})
+
+    def plays(self, file):
+        return self.played.get(file, (0, 0))[0]
+
+    def last_played(self, file):
+        """When the file was last played; 0 if it never was."""
+        return self.played.get(file, (0, 0))[1]
+
+    def flush(self):
+        """Write any plays still waiting."""
+        if self.writer.pending is not None:
+            self.writer.flush()
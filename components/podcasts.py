@@ -9,16 +9,14 @@ import logging
 
 
 class PodcastsComponent(AudioComponent):
-    def __init__(self, mpd_client):
+    def __init__(self, mpd_pool):
         # Do Startup tasks
         super().__init__("Podcasts", "Pod", "Serialized Audio")
 
         # Our hierarchy
         self.component = "podcasts"
-        # Local pointers into the radio state and the streaming client
-        self.mpdc = mpd_client
-        # Zero the client state on startup
-        self.mpdc.clear()
+        # Shared connections to mpd
+        self.pool = mpd_pool
         # Set up the areas of the component
 
         self.favorites_node.menu_labels['comment'] = "Podcast Favorites"
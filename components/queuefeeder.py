@@ -0,0 +1,153 @@
+"""
+Feeding a slice of the Library to mpd a few tracks at a time.
+
+Adding "All songs in Rock" to mpd's queue in one go means tens of thousands of tracks added before the first one
+plays, and mpd holding all of them in memory for as long as they play. Instead we keep the slice ourselves (as a
+compact array of positions in the Library index), give mpd a short window of it to start with, and top the window up
+(and trim what has been played) as mpd moves through it.
+
+The order we feed the tracks in stands in for mpd's own shuffle and repeat, which would only ever see the window:
+shuffled, the whole slice is played in a spread-out random order (see shuffle.py) before any of it comes round
+again, and on repeat we start the slice over when we reach its end.
+"""
+
+from array import array
+import itertools
+
+from components.shuffle import shuffled
+
+# Slices with more tracks than this are fed to mpd a window at a time, even when they're played in order
+WINDOWED_THRESHOLD = 1000
+# How many tracks we keep queued ahead of the one playing
+QUEUE_WINDOW = 50
+# Top up once fewer than this many are left ahead
+QUEUE_LOW_WATER = 20
+# How many played tracks we leave in the queue, for 'previous'
+QUEUE_BEHIND = 10
+
+
+class QueueFeeder:
+    """
+    Keep mpd's queue a window onto a slice of the Library.
+
+    The slice is ids, positions in the Library index's list of tracks. queued holds the position in the slice of
+    each track we've put in mpd's queue (and not yet trimmed), so queue position n holds the slice's queued[n]'th
+    track; upcoming gives the positions still to be fed.
+    """
+
+    def __init__(self, tracks, ids, start=None, shuffle=0, repeat=0, window=QUEUE_WINDOW, low_water=QUEUE_LOW_WATER):
+        self.tracks = tracks
+        self.ids = ids
+        self.shuffle = shuffle
+        self.repeat = repeat
+        self.window = window
+        self.low_water = low_water
+        self.queued = array('I')
+        self.upcoming = self.passes(start)
+
+    def key_of(self, position):
+        """The artist and album of a track of the slice, to spread them out when shuffling."""
+        track = self.tracks[self.ids[position]]
+        return track.artist, track.album
+
+    def cycle(self, first=None):
+        """One pass through the slice, starting from its first'th track if we say."""
+        if self.shuffle:
+            return shuffled(len(self.ids), self.key_of, first)
+        return iter(range(first or 0, len(self.ids)))
+
+    def passes(self, first=None):
+        """This pass, and then (on repeat, which can be switched on and off as we go) more."""
+        yield from self.cycle(first)
+        while self.repeat and self.ids:
+            yield from self.cycle()
+
+    def feed(self, count):
+        """The commands that add the next count tracks to the queue."""
+        positions = list(itertools.islice(self.upcoming, count))
+        if len(positions) < count and self.repeat and self.ids:
+            # Repeat was switched on after we'd come to the end
+            self.upcoming = self.passes()
+            positions += itertools.islice(self.upcoming, count - len(positions))
+        self.queued.extend(positions)
+        return [('add', self.tracks[self.ids[position]].file) for position in positions]
+
+    def start_commands(self):
+        """The commands that fill the (cleared) queue with the first window; the first track goes in position 0."""
+        return self.feed(self.window)
+
+    def adopt(self):
+        """Take over a queue that already holds the whole slice, in order, and nothing more."""
+        self.queued = array('I', range(len(self.ids)))
+        self.upcoming = iter(())
+
+    def position_of(self, file):
+        """Where a file is in the slice, or None."""
+        for position, n in enumerate(self.ids):
+            if self.tracks[n].file == file:
+                return position
+        return None
+
+    def take_over_commands(self, song, length, current):
+        """
+        The commands that take over a queue fed by someone else (the server we took over from, say): the slice's
+        current'th track, at queue position song, is kept playing, and everything around it makes way for the
+        window from there on.
+
+        :param length: how many tracks the queue holds
+        """
+        commands = []
+        if length > song + 1:
+            commands.append(('delete', "{}:{}".format(song + 1, length)))
+        if song > 0:
+            commands.append(('delete', "0:{}".format(song)))
+        self.queued = array('I', [current])
+        self.upcoming = self.passes(current)
+        # The track playing comes first, and it's already queued
+        next(self.upcoming)
+        return commands + self.feed(self.window - 1)
+
+    def index_at(self, song):
+        """Which track of the slice is at a queue position."""
+        try:
+            return self.queued[song]
+        except IndexError:
+            return None
+
+    def top_up_commands(self, song):
+        """
+        The commands that bring the window back up to size around the track mpd is playing, if it needs it.
+
+        :param song: the queue position mpd is playing
+        """
+        commands = []
+        behind = song - QUEUE_BEHIND
+        if behind >= QUEUE_BEHIND:
+            commands.append(('delete', "0:{}".format(behind)))
+            del self.queued[:behind]
+            song -= behind
+
+        ahead = len(self.queued) - song - 1
+        if ahead < self.low_water:
+            commands += self.feed(self.window - ahead)
+        return commands
+
+    def reorder_commands(self, song, shuffle):
+        """
+        The commands that refill everything after the track playing, after shuffle has been switched on or off.
+
+        Switching shuffle on starts a shuffled pass over the whole slice; switching it off carries on through the
+        slice in order from the track playing.
+        """
+        self.shuffle = shuffle
+        current = self.index_at(song)
+        if current is None:
+            return []
+        commands = []
+        if len(self.queued) > song + 1:
+            commands.append(('delete', "{}:{}".format(song + 1, len(self.queued))))
+            del self.queued[song + 1:]
+        self.upcoming = self.passes(current)
+        # The track playing comes first in the new order, and it's already queued
+        next(self.upcoming)
+        return commands + self.feed(self.window)
@@ -1,10 +1,15 @@
 from base_classes import Opus, MenuList, AudioComponent
+from probes import BinaryProbe, USBDeviceProbe
 import subprocess
 import logging
 import asyncio
 import os
 import json
 
+# USB ids of the RTL2832U dongles rtl_fm drives
+RTL_SDR_VENDOR = '0bda'
+RTL_SDR_PRODUCT = '2838'
+
 
 async def play_fm_station(freq, kill=0):
     logging.debug('creating rtlfm_pipe')
@@ -50,13 +55,15 @@ class FmRadioComponent(AudioComponent):
             self.custom_node.add_child(item)
 
     def requirements_met(self):
-        # figure out where the rtl_fm and play utilities live
         return True
 
+    def requirement_probes(self):
+        return [BinaryProbe('rtl_fm'), BinaryProbe('play'), USBDeviceProbe(RTL_SDR_VENDOR, RTL_SDR_PRODUCT)]
+
     def save_favorites(self):
         favs = []
         for fav in self.favorites_node.children:
-            favs.append(fav.export_metadata())
+            favs.append(fav.opus_export_metadata())
 
         json_favs = json.dumps(favs)
 
@@ -68,7 +75,7 @@ class FmRadioComponent(AudioComponent):
             with open(self.favs_save_file, mode='r', encoding='utf-8') as the_file:
                 favs = json.loads(the_file.read())
                 for fav in favs:
-                    this_opus = FmOpus(fav['name'], fav['comment'], fav['freq'])
+                    this_opus = self.opus_from_metadata(fav)
                     self.favorites_node.add_child(this_opus)
                 self.sfavs.update_one_favorite_menu(self)
         except json.JSONDecodeError:
@@ -76,6 +83,9 @@ class FmRadioComponent(AudioComponent):
         except FileNotFoundError:
             pass
 
+    def opus_from_metadata(self, md):
+        return FmOpus(md['name'], md['comment'], md['freq'])
+
 
 class FmRadioMenuList(MenuList):
     def __init__(self, name, short_name, comment):
@@ -127,6 +137,9 @@ class SdrOpus(Opus):
     def opus_pause(self):
         self.stop()
 
+    def opus_get_metadata(self):
+        return self.opus_export_metadata()
+
     def opus_export_metadata(self):
         md = {'component': self.component,
               'type': 'sdr',
@@ -202,6 +215,11 @@ class FmOpus(Opus):
     def opus_pause(self):
         self.stop()
 
+    def opus_get_metadata(self):
+        # What the component needs to build us again (see opus_from_metadata), so a station that was playing is
+        # restored with the rest of the state
+        return self.opus_export_metadata()
+
     def opus_export_metadata(self):
         md = {'component': self.component,
               'type': 'fmradio',
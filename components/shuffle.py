@@ -0,0 +1,120 @@
+"""
+Shuffling a slice of the Library ourselves, a few tracks at a time.
+
+mpd's random mode needs the whole slice in its queue, and is happy to play one artist three times running. Here a
+pass through a slice is a seeded pseudo-random permutation of its positions, worked out a position at a time, so a
+50,000 track slice costs no more to start shuffling than a ten track one, and takes no memory beyond a few numbers.
+A short look-ahead then holds back any track whose artist or album we've just heard, so they come spread out (as far
+as they can be: an artist with half of a slice's tracks will still often be heard twice running).
+"""
+
+from collections import deque
+import random
+
+# How many upcoming tracks we look at to find one that doesn't repeat a recent artist or album
+SPREAD_LOOKAHEAD = 8
+# How many of the last tracks' artists and albums we try not to repeat
+SPREAD_MEMORY = 3
+
+FEISTEL_ROUNDS = 4
+
+
+class Permutation:
+    """
+    A pseudo-random ordering of range(count), computed one position at a time.
+
+    A small Feistel network shuffles the bits of a position over the smallest even-width power of two that holds
+    count; positions that land outside range(count) are put through again until they land inside ("cycle walking"),
+    which keeps the whole thing a permutation of range(count).
+    """
+
+    def __init__(self, count, seed):
+        self.count = count
+        self.half = max(1, ((count - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(32) for _ in range(FEISTEL_ROUNDS)]
+
+    def round(self, value, key):
+        value = ((value ^ key) * 0x9E3779B1) & 0xFFFFFFFF
+        value ^= value >> 15
+        return value & self.mask
+
+    def __getitem__(self, position):
+        value = position
+        while True:
+            left, right = value >> self.half, value & self.mask
+            for key in self.keys:
+                left, right = right, left ^ self.round(right, key)
+            value = (left << self.half) | right
+            if value < self.count:
+                return value
+
+    def __len__(self):
+        return self.count
+
+
+def shuffled(count, key_of, first=None, seed=None, lookahead=SPREAD_LOOKAHEAD, memory=SPREAD_MEMORY):
+    """
+    Yield every one of range(count) once, in a shuffled order with artists and albums spread out.
+
+    :param key_of: gives the (artist, album) of a position
+    :param first: a position to give first (the track already playing, say), and not again
+    :param seed: the seed for the permutation; a random one if not given
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    order = Permutation(count, seed)
+    recent_artists = deque(maxlen=memory)
+    recent_albums = deque(maxlen=memory)
+
+    def heard(position):
+        artist, album = key_of(position)
+        # Tracks without the tags don't count as repeats of each other
+        if artist:
+            recent_artists.append(artist)
+        if album:
+            recent_albums.append(album)
+
+    if first is not None:
+        heard(first)
+        yield first
+
+    waiting = []
+    upcoming = (order[n] for n in range(count))
+    for position in upcoming:
+        if position == first:
+            continue
+        waiting.append(position)
+        if len(waiting) < lookahead:
+            continue
+        yield pick(waiting, key_of, recent_artists, recent_albums, heard)
+
+    while waiting:
+        yield pick(waiting, key_of, recent_artists, recent_albums, heard)
+
+
+def pick(waiting, key_of, recent_artists, recent_albums, heard):
+    """
+    Take the first waiting position that doesn't repeat a recent artist or album; if none will do, the one whose
+    artist and album we heard longest ago.
+    """
+    chosen, best = 0, -1
+    for n, position in enumerate(waiting):
+        artist, album = key_of(position)
+        staleness = min(since(recent_artists, artist), since(recent_albums, album))
+        if staleness > best:
+            chosen, best = n, staleness
+            if staleness == recent_artists.maxlen:
+                break
+    position = waiting.pop(chosen)
+    heard(position)
+    return position
+
+
+def since(recent, key):
+    """How many others we've heard since we last heard key (as many as we remember, if we haven't)."""
+    for n, heard in enumerate(reversed(recent)):
+        if heard == key:
+            return n
+    return recent.maxlen
@@ -0,0 +1,377 @@
+"""
+Smart playlists: collections of the Library made by rules, like "genre is Jazz and date < 1965" or "never played".
+
+The playlists are defined in a config file, one section each, named for the playlist:
+
+    [Early Jazz]
+    rule = genre is Jazz and date < 1965
+
+    [Unheard]
+    rule = never played and not genre is Spoken
+
+A rule tests one track at a time. It can compare any of the tags the Library index keeps (or file, duration, and
+plays, the number of times the track has been played): "is" and "contains" ignore case and accents, while <, <=, >
+and >= compare numbers where the value is one (so "date < 1965" works with dates like 1964-03-01) and names
+otherwise. "added within 30 days", "played within 7 days", "recently added", "recently played" and "never played"
+look at when tracks were added to the database and the play history. Rules are combined with and, or, not, and
+parentheses; quote values that have and or or in them ("Rock and Roll").
+
+Rules are worked out here, against the Library index and the play history, rather than by mpd. Each playlist keeps
+the files that meet its rule, and when the database or the history changes only the tracks that changed are tested
+again.
+"""
+
+from array import array
+from configparser import ConfigParser, Error as ConfigError
+import operator
+import re
+import time
+
+from components.libraryindex import TRACK_TAGS, Totals
+from components.librarysearch import fold
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SMART_PLAYLISTS_FILE = "smart-playlists.ini"
+# How far back "recently" reaches (days)
+RECENT_DAYS = 30
+# Rules that depend on the time of day (like "added within 30 days") are worked out again from scratch when played,
+# if they were last worked out longer ago than this (seconds)
+CLOCK_SLACK = 3600
+
+DAY = 24 * 60 * 60
+
+# What rules can test, besides the tags
+FIELDS = TRACK_TAGS + ('file', 'duration', 'plays')
+
+TOKENS = re.compile(r'\s*(?:"([^"]*)"|(<=|>=|!=|[()<>=])|([^\s()<>=!"]+))')
+NUMBER = re.compile(r'^\s*(\d+(?:\.\d+)?)')
+
+ORDERINGS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+class RuleError(ValueError):
+    pass
+
+
+def number(text):
+    """The number a value starts with ("1964-03-01" is 1964), or None."""
+    match = NUMBER.match(str(text))
+    return float(match.group(1)) if match else None
+
+
+class Rule:
+    """
+    A smart playlist's rule, compiled to a test of one track.
+
+    uses says what, besides the track, the rule looks at: 'history' (the play history) and 'clock' (the time now).
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.uses = set()
+        self.tokens = []
+        position = 0
+        text = text.strip()
+        while position < len(text):
+            match = TOKENS.match(text, position)
+            if match is None or match.end() == position:
+                raise RuleError("can't read '{}'".format(text[position:]))
+            quoted, symbol, word = match.groups()
+            if quoted is not None:
+                self.tokens.append(('value', quoted))
+            elif symbol is not None:
+                self.tokens.append(('symbol', symbol))
+            else:
+                self.tokens.append(('word', word))
+            position = match.end()
+        if not self.tokens:
+            raise RuleError("the rule is empty")
+
+        self.test = self.parse_or()
+        if self.tokens:
+            raise RuleError("unexpected '{}'".format(self.tokens[0][1]))
+
+    def matches(self, track, history, now):
+        return self.test(track, history, now)
+
+    # Parsing
+
+    def peek(self, *words):
+        """Whether the next token is one of these words (or symbols)."""
+        return bool(self.tokens) and self.tokens[0][0] != 'value' and self.tokens[0][1].casefold() in words
+
+    def take(self, *words):
+        if not self.peek(*words):
+            found = "'{}'".format(self.tokens[0][1]) if self.tokens else "the end"
+            raise RuleError("expected {} but found {}".format(" or ".join(words), found))
+        return self.tokens.pop(0)[1].casefold()
+
+    def parse_or(self):
+        tests = [self.parse_and()]
+        while self.peek('or'):
+            self.take('or')
+            tests.append(self.parse_and())
+        if len(tests) == 1:
+            return tests[0]
+        return lambda track, history, now: any(test(track, history, now) for test in tests)
+
+    def parse_and(self):
+        tests = [self.parse_not()]
+        while self.peek('and'):
+            self.take('and')
+            tests.append(self.parse_not())
+        if len(tests) == 1:
+            return tests[0]
+        return lambda track, history, now: all(test(track, history, now) for test in tests)
+
+    def parse_not(self):
+        if self.peek('not'):
+            self.take('not')
+            test = self.parse_not()
+            return lambda track, history, now: not test(track, history, now)
+        if self.peek('('):
+            self.take('(')
+            test = self.parse_or()
+            self.take(')')
+            return test
+        return self.parse_phrase()
+
+    def parse_phrase(self):
+        if self.peek('never'):
+            self.take('never')
+            self.take('played')
+            self.uses.add('history')
+            return lambda track, history, now: history.plays(track.file) == 0
+        if self.peek('recently'):
+            self.take('recently')
+            return self.within(self.take('added', 'played'), RECENT_DAYS)
+        if self.peek('added', 'played') and len(self.tokens) > 1 and self.tokens[1][1].casefold() == 'within':
+            what = self.take('added', 'played')
+            self.take('within')
+            days = number(self.tokens.pop(0)[1]) if self.tokens else None
+            if days is None:
+                raise RuleError("expected a number of days after 'within'")
+            self.take('days', 'day')
+            return self.within(what, days)
+        return self.parse_comparison()
+
+    def within(self, what, days):
+        self.uses.add('clock')
+        if what == 'added':
+            return lambda track, history, now: track.modified > now - days * DAY
+        self.uses.add('history')
+        return lambda track, history, now: history.last_played(track.file) > now - days * DAY
+
+    def parse_comparison(self):
+        if not self.peek(*FIELDS):
+            found = "'{}'".format(self.tokens[0][1]) if self.tokens else "the end"
+            raise RuleError("expected something to test ({}) but found {}".format(", ".join(FIELDS), found))
+        field = self.take(*FIELDS)
+        if field == 'plays':
+            self.uses.add('history')
+        if self.peek('is'):
+            self.take('is')
+            negated = self.peek('not')
+            if negated:
+                self.take('not')
+            op = '!=' if negated else '='
+        elif self.peek('contains'):
+            op = self.take('contains')
+        else:
+            op = self.take('=', '!=', '<', '<=', '>', '>=')
+        value = self.value()
+
+        def values(track, history):
+            if field == 'plays':
+                return [history.plays(track.file)]
+            if field == 'duration':
+                return [track.duration]
+            if field == 'file':
+                return [track.file]
+            return track.values(field)
+
+        if op in ('=', '!='):
+            wanted = number(value) if field in ('plays', 'duration') else fold(value)
+
+            def equal(track, history):
+                if field in ('plays', 'duration'):
+                    return any(v == wanted for v in values(track, history))
+                return any(fold(v) == wanted for v in values(track, history))
+
+            if op == '!=':
+                return lambda track, history, now: not equal(track, history)
+            return lambda track, history, now: equal(track, history)
+
+        if op == 'contains':
+            wanted = fold(value)
+            return lambda track, history, now: any(wanted in fold(str(v)) for v in values(track, history))
+
+        compare, limit = ORDERINGS[op], number(value)
+        if limit is not None:
+            def ordered(track, history, now):
+                found = [number(v) for v in values(track, history)]
+                return any(n is not None and compare(n, limit) for n in found)
+        else:
+            limit = fold(value)
+
+            def ordered(track, history, now):
+                return any(compare(fold(str(v)), limit) for v in values(track, history))
+        return ordered
+
+    def value(self):
+        """A quoted value, or the words up to the next and, or, or parenthesis."""
+        if self.tokens and self.tokens[0][0] == 'value':
+            return self.tokens.pop(0)[1]
+        words = []
+        while self.tokens and self.tokens[0][0] == 'word' and not self.peek('and', 'or'):
+            words.append(self.tokens.pop(0)[1])
+        if not words:
+            raise RuleError("expected a value")
+        return ' '.join(words)
+
+
+class SmartPlaylist:
+    """
+    A named rule, and the files in the Library that meet it.
+    """
+
+    def __init__(self, name, rule):
+        self.name = name
+        self.rule = rule
+        self.files = set()
+        # How long the files take to play (seconds)
+        self.duration = 0.0
+        # Counts changes to the files, to tell if a position in them still means the same track
+        self.generation = 0
+        # When the rule was last worked out over the whole Library
+        self.evaluated = 0
+        self.cached_ids = (None, None, None)
+
+    def totals(self):
+        return Totals(0, len(self.files), self.duration)
+
+    def evaluate(self, tracks, history, now):
+        """Work the rule out over every track."""
+        matched = [track for track in tracks if self.rule.matches(track, history, now)]
+        files = {track.file for track in matched}
+        if files != self.files:
+            self.generation += 1
+        self.files, self.duration = files, sum(track.duration for track in matched)
+        self.evaluated = now
+
+    def retest(self, tracks, history, now, gone=()):
+        """
+        Test some tracks again.
+
+        :param gone: tracks that have left the Library, or the old versions of tracks that changed
+        :return: whether the files changed
+        """
+        changed = False
+        for track in gone:
+            if track.file in self.files:
+                self.files.discard(track.file)
+                self.duration -= track.duration
+                changed = True
+        for track in tracks:
+            if self.rule.matches(track, history, now):
+                if track.file not in self.files:
+                    self.files.add(track.file)
+                    self.duration += track.duration
+                    changed = True
+            elif track.file in self.files:
+                self.files.discard(track.file)
+                self.duration -= track.duration
+                changed = True
+        if changed:
+            self.generation += 1
+        return changed
+
+    def ids(self, tracks):
+        """Where our files are in a list of tracks, in its order, as a compact array."""
+        cached_tracks, generation, ids = self.cached_ids
+        if cached_tracks is not tracks or generation != self.generation:
+            ids = array('I', (n for n, track in enumerate(tracks) if track.file in self.files))
+            self.cached_ids = (tracks, self.generation, ids)
+        return ids
+
+
+class SmartPlaylists:
+    """
+    The smart playlists, kept up to date with the Library index and the play history.
+    """
+
+    def __init__(self, playlists, history):
+        self.playlists = playlists
+        self.history = history
+        # The tracks of the index we last saw, and the same by file
+        self.tracks = []
+        self.by_file = {}
+
+    def index_changed(self, index, now=None):
+        """
+        Bring the playlists up to date with a new index, testing only the tracks that are new or changed.
+
+        :return: the playlists whose files changed
+        """
+        now = time.time() if now is None else now
+        old, self.tracks = self.by_file, index.tracks
+        self.by_file = {track.file: track for track in index.tracks}
+        if not old:
+            for playlist in self.playlists:
+                playlist.evaluate(self.tracks, self.history, now)
+            return list(self.playlists)
+
+        changed = []
+        gone = []
+        for track in self.tracks:
+            before = old.get(track.file)
+            if before is None:
+                changed.append(track)
+            elif before.as_tuple() != track.as_tuple():
+                changed.append(track)
+                gone.append(before)
+        gone += [track for file, track in old.items() if file not in self.by_file]
+        return [playlist for playlist in self.playlists
+                if playlist.retest(changed, self.history, now, gone)]
+
+    def history_changed(self, files, now=None):
+        """
+        Test the tracks that have just been played again, against the rules that look at the history.
+
+        :return: the playlists whose files changed
+        """
+        now = time.time() if now is None else now
+        tracks = [self.by_file[file] for file in files if file in self.by_file]
+        return [playlist for playlist in self.playlists
+                if 'history' in playlist.rule.uses and playlist.retest(tracks, self.history, now)]
+
+    def resolve(self, playlist, now=None):
+        """
+        The index's tracks, and where a playlist's tracks are in them; rules that depend on the time are worked out
+        again first, if it has moved on.
+        """
+        now = time.time() if now is None else now
+        if 'clock' in playlist.rule.uses and now - playlist.evaluated > CLOCK_SLACK:
+            playlist.evaluate(self.tracks, self.history, now)
+        return self.tracks, playlist.ids(self.tracks)
+
+
+def load_playlists(path=SMART_PLAYLISTS_FILE):
+    """The smart playlists defined in a config file, in the order they're given; those with bad rules are left out."""
+    parser = ConfigParser(interpolation=None)
+    try:
+        parser.read(path, encoding='utf-8')
+    except ConfigError as e:
+        logger.error("LIBRARY: could not read the smart playlists in {}: {}".format(path, e))
+        return []
+
+    playlists = []
+    for name in parser.sections():
+        try:
+            playlists.append(SmartPlaylist(name, Rule(parser.get(name, 'rule', fallback=''))))
+        except RuleError as e:
+            logger.error("LIBRARY: ignoring smart playlist '{}': {}".format(name, e))
+    return playlists
@@ -1,7 +1,9 @@
-from base_classes import Opus, MenuList, AudioComponent
+from base_classes import MPDOpus, MenuList, AudioComponent
+from probes import TCPProbe
 import json
 import asyncio
-from mpd.asyncio import MPDClient
+import urllib.parse
+import urllib.request
 
 import logging
 
@@ -17,16 +19,14 @@ way...).
 """
 
 class StreamingComponent(AudioComponent):
-    def __init__(self, sfavs, cpo):
+    def __init__(self, sfavs, cpo, mpd_pool):
         # Do Startup tasks
         super().__init__("Streaming", "Str", "Streaming Audio Services")
 
-        # We have our own mpd client
-        self.mpdc = MPDClient()
+        # Shared connections to mpd
+        self.pool = mpd_pool
         self.loop = asyncio.get_event_loop()
         self.REQ_MET_MPD = False
-        # Use a return value here to set up fitness?
-        self.start_client()
 
         # Features
         self.enable_dirble = False
@@ -35,8 +35,6 @@ class StreamingComponent(AudioComponent):
         self.component = "streaming"
         # Config parser object
         self.cpo = cpo
-        # Zero the client state on startup
-        self.mpdc.clear()
         # Super favorites
         self.sfavs = sfavs
 
@@ -59,11 +57,11 @@ class StreamingComponent(AudioComponent):
         # Testing purposes, set up custom stations (backed from where?)
         custom_stations = [
             StreamingOpus("AncientFM", "Early music.",
-                          "http://5.152.208.98:8058/", self.mpdc, genre="Classical", subgenre="Early"),
+                          "http://5.152.208.98:8058/", self.pool, genre="Classical", subgenre="Early"),
             StreamingOpus("Venice Classsic Radio", "Beautiful classical music.",
-                          "http://174.36.206.197:8000/stream", self.mpdc, genre="Classical"),
+                          "http://174.36.206.197:8000/stream", self.pool, genre="Classical"),
             StreamingOpus("Bartok Radio", "Hungarian classical radio.",
-                          "http://mr-stream.mediaconnect.hu/4741/mr3.mp3", self.mpdc, genre="Classical"),
+                          "http://mr-stream.mediaconnect.hu/4741/mr3.mp3", self.pool, genre="Classical"),
         ]
         # Populate the custom menu
         for station in custom_stations:
@@ -71,25 +69,12 @@ class StreamingComponent(AudioComponent):
 
         # When we add an opus to a collection, we want to keep track of the genre/subgenre structure?
 
-    def start_client(self):
-        return self.loop.run_until_complete(self.__async__start_client())
-
-    async def __async__start_client(self):
-        try:
-            await self.mpdc.connect('localhost', 6600)
-        except Exception as e:
-            print("Connection failed:", e)
-            self.REQ_MET_MPD = False
-        self.mpdc.consume(0)
-
     def requirements_met(self):
-        # req_met = True
-        #
-        # if not self.REQ_MET_MPD:
-        #     req_met = False
-
         return True
 
+    def requirement_probes(self):
+        return [TCPProbe(self.pool.host, self.pool.port)]
+
     def save_favorites(self):
         favs = []
         for fav in self.favorites_node.children:
@@ -105,8 +90,7 @@ class StreamingComponent(AudioComponent):
             with open(self.favs_save_file, mode='r', encoding='utf-8') as the_file:
                 favs = json.loads(the_file.read())
                 for fav in favs:
-                    this_opus = StreamingOpus(fav['name'], fav['comment'], fav['url'],
-                                              self.mpdc, fav['genre'], fav['subgenre'])
+                    this_opus = self.opus_from_metadata(fav)
                     self.favorites_node.add_child(this_opus)
                 self.sfavs.update_one_favorite_menu(self)
         except json.JSONDecodeError:
@@ -114,6 +98,30 @@ class StreamingComponent(AudioComponent):
         except FileNotFoundError:
             pass
 
+    def opus_from_metadata(self, md):
+        return StreamingOpus(md['name'], md['comment'], md['url'], self.pool, md['genre'], md['subgenre'])
+
+
+# Stations that give us a playlist rather than the stream itself
+PLAYLIST_SUFFIXES = ('.pls', '.m3u')
+# How long to wait for a station's playlist (seconds)
+PLAYLIST_TIMEOUT = 3.0
+
+
+def read_stream_playlist(url):
+    """
+    Fetch a .pls or .m3u playlist, and return the first stream in it (or None if there isn't one).
+    """
+    with urllib.request.urlopen(url, timeout=PLAYLIST_TIMEOUT) as response:
+        text = response.read(65536).decode('utf-8', errors='replace')
+    for line in text.splitlines():
+        line = line.strip()
+        if line.lower().startswith('file') and '=' in line:
+            line = line.split('=', 1)[1].strip()
+        if line.startswith(('http://', 'https://')):
+            return line
+    return None
+
 
 class StreamingMenuList(MenuList):
     def __init__(self, name, short_name, comment):
@@ -121,46 +129,46 @@ class StreamingMenuList(MenuList):
         self.component = "streaming"
 
 
-class StreamingOpus(Opus):
+class StreamingOpus(MPDOpus):
     """A piece of streaming media.
     
     """
 
     playlist_name = "opus_streaming_playlist"
 
-    def __init__(self, name, comment, url, mpd_client, genre="", subgenre=""):
+    def __init__(self, name, comment, url, mpd_pool, genre="", subgenre=""):
         self.url = url
 
         if not name:
             name = self.url
 
-        super().__init__(name, "", comment)
+        super().__init__(name, "", comment, mpd_pool)
 
-        self.mpdc = mpd_client
         self.genre = genre
         self.subgenre = subgenre
         self.component = "streaming"
-        self.loop = asyncio.get_event_loop()
+        # There's nothing meaningful to come back to when pausing a live stream
+        self.pause_support = False
         self.file = ""
         self.title = ""
         self.name = ""
         self.pos = ""
         self.id = ""
+        # Where a playlist station's stream actually is, once we've looked
+        self.stream_url = None
 
-    def opus_play(self):
-        asyncio.run_coroutine_threadsafe(self._opus_play(), self.loop)
-
-    async def _opus_play(self):
-        await self.mpdc.clear()
-        await self.mpdc.add(self.url)
-        await self.mpdc.play()
+    async def opus_prepare(self):
+        """If the station gives us a playlist, find the stream in it, so mpd needn't fetch the playlist itself."""
+        if self.stream_url is None and urllib.parse.urlparse(self.url).path.lower().endswith(PLAYLIST_SUFFIXES):
+            self.stream_url = await self.loop.run_in_executor(None, read_stream_playlist, self.url)
 
-    def opus_stop(self):
-        asyncio.run_coroutine_threadsafe(self._opus_stop(), self.loop)
+    def opus_unprepare(self):
+        self.stream_url = None
 
-    async def _opus_stop(self):
-        await self.mpdc.stop()
-        await self.mpdc.clear()
+    def opus_play_commands(self):
+        return [('clear',),
+                ('add', self.stream_url or self.url),
+                ('play',)]
 
     def opus_get_metadata(self):
         opus_metadata = {'component': self.component,
@@ -0,0 +1,127 @@
+"""
+A local mirror of the mpd player state.
+
+Rather than asking mpd for its status every time we need to know something, we keep a copy of the status,
+current song and database stats, and bring it up to date when mpd tells us (over the idle connection) that
+something changed. Each subsystem only causes a fetch of the records it can affect, and all of the records
+needed for one change arrive in a single command list.
+
+Other parts of opuscule register listeners to hear about changes once the mirror has caught up.
+"""
+
+import asyncio
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The mpd subsystems we follow
+SUBSYSTEMS = ('player', 'mixer', 'options', 'playlist', 'database', 'stored_playlist')
+
+# The records we keep, each fetched with the mpd command of the same name
+RECORDS = ('status', 'currentsong', 'stats')
+
+# The records each subsystem can change
+AFFECTED_RECORDS = {
+    'player': ('status', 'currentsong'),
+    'mixer': ('status',),
+    'options': ('status',),
+    'playlist': ('status', 'currentsong'),
+    'database': ('stats',),
+    'stored_playlist': (),
+}
+
+# How long to wait before trying again after losing track of mpd (seconds); the pool's supervisor looks after
+# reconnecting, so this only spaces out retries that fail for other reasons
+RETRY_DELAY = 1.0
+
+
+class MPDMirror:
+    """
+    An in-memory copy of mpd's status, current song, and database stats.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.status = {}
+        self.currentsong = {}
+        self.stats = {}
+        # When the status was fetched, so we can tell how far playback has moved on since
+        self.status_time = None
+        self.listeners = []
+
+    def add_listener(self, callback, subsystems=SUBSYSTEMS):
+        """
+        Call back with the list of changed subsystems whenever any of the given subsystems change.
+        """
+        self.listeners.append((set(subsystems), callback))
+
+    def notify(self, changed):
+        for subsystems, callback in self.listeners:
+            relevant = [s for s in changed if s in subsystems]
+            if relevant:
+                try:
+                    callback(relevant)
+                except Exception as e:
+                    logger.error("Listener for mpd changes failed: %s", e)
+
+    async def refresh(self, records):
+        """
+        Fetch the given records from mpd in a single command list.
+        """
+        records = [r for r in RECORDS if r in records]
+        if not records:
+            return
+
+        results = await self.pool.command_list([(r,) for r in records], control=False)
+
+        for record, result in zip(records, results):
+            setattr(self, record, result)
+            if record == 'status':
+                self.status_time = time.monotonic()
+
+    async def run(self):
+        """
+        Follow mpd's changes for as long as the server runs.
+        """
+        while True:
+            # Nothing to follow until we're connected
+            await self.pool.up.wait()
+            try:
+                await self.refresh(RECORDS)
+                self.notify(SUBSYSTEMS)
+
+                async for changed in self.pool.idle(SUBSYSTEMS):
+                    logger.debug("Idle change in %s", changed)
+                    records = set()
+                    for subsystem in changed:
+                        records.update(AFFECTED_RECORDS.get(subsystem, ()))
+                    await self.refresh(records)
+                    self.notify(changed)
+            except Exception as e:
+                logger.error("Lost track of mpd: %r", e)
+                await asyncio.sleep(RETRY_DELAY)
+
+    # Reading the mirror
+
+    @property
+    def state(self):
+        return self.status.get('state', 'stop')
+
+    def elapsed(self):
+        """
+        Seconds into the current song, allowing for the time that has passed since we last heard from mpd.
+        """
+        try:
+            elapsed = float(self.status['elapsed'])
+        except (KeyError, ValueError):
+            return 0.0
+
+        if self.state == 'play' and self.status_time is not None:
+            elapsed += time.monotonic() - self.status_time
+
+        return elapsed
+
+    def has_next(self):
+        return 'nextsong' in self.status
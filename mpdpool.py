@@ -0,0 +1,332 @@
+"""
+Shared connections to the mpd daemon.
+
+Every mpd-backed part of opuscule (the library and streaming components, their operai, and the monitor that
+watches the player) shares a single MPDPool. The pool keeps one connection dedicated to idle monitoring, and a
+small number of command connections that are borrowed for the length of a command, or a short sequence of
+commands, and then handed back.
+
+Sequences of commands that don't depend on each other's answers (like everything it takes to load and start an
+opus) can be sent as a single command list, costing one round trip instead of one per command.
+
+If mpd goes away, the pool stops handing out connections (callers get MPDUnavailable straight away rather than a
+dead client) and a supervisor reconnects in the background, backing off between attempts. Listeners hear about
+the connection going down and coming back.
+"""
+
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+
+from mpd.asyncio import MPDClient as AsyncMPDClient
+from mpd.base import ConnectionError
+
+from mpdmirror import MPDMirror
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MPD_HOST = 'localhost'
+MPD_PORT = 6600
+
+# How many connections we keep for commands (the idle connection is extra)
+COMMAND_CONNECTIONS = 3
+# How long a caller will wait for a free command connection (seconds)
+BORROW_TIMEOUT = 2.0
+# How long we wait for mpd to answer a new connection (seconds)
+CONNECT_TIMEOUT = 5.0
+# Weight of the newest sample in the smoothed round trip latency
+LATENCY_SMOOTHING = 0.2
+# Delays between attempts to reconnect to mpd (seconds); each attempt doubles the delay, up to the maximum
+BACKOFF_INITIAL = 0.5
+BACKOFF_MAX = 30.0
+# Each delay is varied by up to this fraction, so we don't fall into step with anything else retrying
+BACKOFF_JITTER = 0.25
+
+
+class MPDUnavailable(Exception):
+    """Raised when no connection to mpd can be had in time."""
+    pass
+
+
+class CommandListResult(asyncio.Future):
+    """
+    The pending answer to a command list sent with command_list_ok_begin.
+
+    The result is a list with one entry per command: a dict of whatever key/value pairs that command returned
+    (empty for most player commands; keys that repeat, like multiple artist tags, collect into a list). If any
+    command fails, mpd abandons the rest of the list and the error is raised from the whole result.
+    """
+
+    async def _feed_from(self, mpdclient):
+        results = []
+        pairs = {}
+        while True:
+            # Raises CommandError when mpd answers ACK, and returns None on the final OK
+            line = await mpdclient._read_line()
+            if line is None:
+                break
+            if line == "list_OK":
+                results.append(pairs)
+                pairs = {}
+            else:
+                key, value = mpdclient._parse_pair(line, ": ")
+                key = key.lower()
+                if key not in pairs:
+                    pairs[key] = value
+                elif isinstance(pairs[key], list):
+                    pairs[key].append(value)
+                else:
+                    pairs[key] = [pairs[key], value]
+
+        if not self.cancelled():
+            self.set_result(results)
+
+    def _feed_error(self, error):
+        if not self.done():
+            self.set_exception(error)
+
+
+class MPDClient(AsyncMPDClient):
+    """
+    The asyncio mpd client, with support for command lists.
+    """
+
+    async def command_list(self, commands):
+        """
+        Send a list of commands to mpd in one go, and return the list of their results.
+
+        :param commands: a list of tuples, each a command name followed by its arguments
+        """
+        # Not supported by mpd.asyncio itself, so we queue our own result processor on the client's command queue
+        command_queue = self._MPDClient__command_queue
+        if command_queue is None:
+            raise ConnectionError("Can not send command list to disconnected client")
+
+        result = CommandListResult()
+        command_queue.put_nowait(result)
+        self._end_idle()
+        # Careful: there can't be any await points between queueing the result and writing the commands
+        self._write_line("command_list_ok_begin")
+        for command in commands:
+            self._write_command(command[0], command[1:])
+        self._write_line("command_list_end")
+
+        return await result
+
+
+class MPDPool:
+    """
+    A dedicated idle connection plus a small pool of command connections to mpd.
+    """
+
+    def __init__(self, host=MPD_HOST, port=MPD_PORT, size=COMMAND_CONNECTIONS, borrow_timeout=BORROW_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.borrow_timeout = borrow_timeout
+        self.idle_client = MPDClient()
+        self.command_clients = [MPDClient() for _ in range(size)]
+        self.available = asyncio.Queue()
+        for client in self.command_clients:
+            self.available.put_nowait(client)
+        # Set while the connections are up; while it's clear, no connections are handed out
+        self.up = asyncio.Event()
+        # Set when the connections have been lost, to wake the supervisor
+        self.lost = asyncio.Event()
+        self.connection_listeners = []
+        # Sequences of commands that drive the player have to reach mpd in the order they were issued
+        self.control_lock = asyncio.Lock()
+        # Our local copy of the player state, kept current from the idle connection
+        self.mirror = MPDMirror(self)
+
+        # Health reporting
+        self.latency = None
+        self.last_latency = None
+        self.borrows = 0
+        self.errors = 0
+        self.reconnects = 0
+
+    def add_connection_listener(self, callback):
+        """
+        Call back with True when the connections to mpd come up, and False when they are lost.
+        """
+        self.connection_listeners.append(callback)
+
+    def notify_connection(self, up):
+        for callback in self.connection_listeners:
+            try:
+                callback(up)
+            except Exception as e:
+                logger.error("Listener for the mpd connection failed: %s", e)
+
+    async def connect(self):
+        """
+        Make the first connection to mpd. If mpd isn't there, the supervisor keeps trying.
+        """
+        try:
+            await self.open_connections()
+        except Exception as e:
+            self.connection_lost(e)
+
+    async def open_connections(self):
+        """
+        Open all of the connections, and make sure mpd isn't in consume mode (we want to be able to reverse
+        through our playlists).
+        """
+        for client in [self.idle_client] + self.command_clients:
+            if not client.connected:
+                await asyncio.wait_for(client.connect(self.host, self.port), CONNECT_TIMEOUT)
+
+        await self.command_clients[0].consume(0)
+
+        self.lost.clear()
+        self.up.set()
+        logger.info("Connected to mpd at %s:%s", self.host, self.port)
+        self.notify_connection(True)
+
+    def connection_lost(self, error):
+        """
+        Stop handing out connections, and leave it to the supervisor to get them back.
+        """
+        if self.lost.is_set():
+            return
+
+        self.errors += 1
+        logger.error("Connection to mpd lost: %r", error)
+        self.up.clear()
+        self.lost.set()
+        # Whatever is left of the connections is no use; start again from scratch
+        self.disconnect()
+        self.notify_connection(False)
+
+    async def supervise(self):
+        """
+        Reconnect whenever the connections are lost, backing off between failed attempts.
+        """
+        while True:
+            await self.lost.wait()
+
+            delay = BACKOFF_INITIAL
+            while True:
+                await asyncio.sleep(delay * random.uniform(1 - BACKOFF_JITTER, 1 + BACKOFF_JITTER))
+                try:
+                    await self.open_connections()
+                    break
+                except Exception as e:
+                    logger.debug("Reconnecting to mpd failed: %s", e)
+                    self.disconnect()
+                    delay = min(delay * 2, BACKOFF_MAX)
+
+            self.reconnects += 1
+
+    def disconnect(self):
+        for client in [self.idle_client] + self.command_clients:
+            client.disconnect()
+
+    @asynccontextmanager
+    async def borrow(self):
+        """
+        Borrow a command connection, waiting a bounded time for one to come free.
+
+        The time the connection is held is recorded as the round trip latency of the commands sent on it.
+        """
+        if not self.up.is_set():
+            raise MPDUnavailable("Not connected to mpd")
+
+        try:
+            client = await asyncio.wait_for(self.available.get(), self.borrow_timeout)
+        except asyncio.TimeoutError:
+            self.errors += 1
+            raise MPDUnavailable("No mpd connection came free within {}s".format(self.borrow_timeout))
+
+        start = time.monotonic()
+        try:
+            yield client
+        except (ConnectionError, OSError) as e:
+            self.connection_lost(e)
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.record_latency(time.monotonic() - start)
+            self.available.put_nowait(client)
+
+    @asynccontextmanager
+    async def control(self):
+        """
+        Borrow a command connection for a sequence of commands that changes the player or the queue.
+
+        These sequences are serialized, so stopping one opus and playing the next reach mpd in that order even
+        though they run as separate tasks on separate connections.
+        """
+        async with self.control_lock:
+            async with self.borrow() as client:
+                yield client
+
+    async def run(self, command, *args):
+        """
+        Run a single mpd command on a borrowed connection, and return its result.
+        """
+        async with self.borrow() as client:
+            return await getattr(client, command)(*args)
+
+    async def command_list(self, commands, control=True):
+        """
+        Send a sequence of commands as a single command list.
+
+        Lists that change the player or the queue are kept in order with other control sequences; pass
+        control=False for lists that only ask questions.
+        """
+        if control:
+            async with self.control() as client:
+                return await client.command_list(commands)
+        else:
+            async with self.borrow() as client:
+                return await client.command_list(commands)
+
+    async def idle(self, subsystems=()):
+        """
+        Iterate over changes in the given mpd subsystems, using the dedicated idle connection.
+        """
+        if not self.up.is_set():
+            raise MPDUnavailable("Not connected to mpd")
+
+        try:
+            async for changed in self.idle_client.idle(subsystems):
+                yield changed
+        except (ConnectionError, OSError) as e:
+            self.connection_lost(e)
+            raise
+
+    def record_latency(self, elapsed):
+        self.borrows += 1
+        self.last_latency = elapsed
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += LATENCY_SMOOTHING * (elapsed - self.latency)
+
+    def health(self):
+        """
+        Report on the state of the connections and how quickly mpd is answering.
+        """
+
+        def as_ms(seconds):
+            if seconds is None:
+                return None
+            return round(seconds * 1000, 2)
+
+        return {'up': self.up.is_set(),
+                'idle_connected': self.idle_client.connected,
+                'command_connected': sum(1 for c in self.command_clients if c.connected),
+                'command_connections': len(self.command_clients),
+                'available': self.available.qsize(),
+                'latency_ms': as_ms(self.latency),
+                'last_latency_ms': as_ms(self.last_latency),
+                'borrows': self.borrows,
+                'errors': self.errors,
+                'reconnects': self.reconnects,
+                }
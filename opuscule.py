@@ -14,14 +14,29 @@ from base_classes import Opus, MenuList, Command, AudioComponent
 import argparse
 
 # For the server
+import base64
 import json
 import asyncio
 
-# For mpd updates
-from mpd.asyncio import MPDClient
+# Sorting menus by the system's language
+import locale
+
+# For restarting in place
+import os
+import sys
+import socket
+
+# Shared connections to mpd
+from mpdpool import MPDPool, MPDUnavailable, COMMAND_CONNECTIONS
+from probes import Prober
+
+# Cover art for the clients
+from artwork import ArtworkCache, ARTWORK_SIZES, ARTWORK_LIMIT
 
 # Opuscule Audio Components
 from components.library import LibraryComponent
+from components.libraryindex import CONCURRENCY
+from components.smartplaylists import SMART_PLAYLISTS_FILE
 from components.streaming import StreamingComponent
 # from components.podcasts import PodcastsComponent
 from components.sdr import FmRadioComponent, WxRadioComponent
@@ -47,6 +62,14 @@ logger = logging.getLogger(__name__)
 
 # HEARTBEAT_RATE = 1
 
+# Where we keep the appliance state between sessions
+STATE_FILE = "saved/radio_state.json"
+
+# On restart, how long connected clients should wait before reconnecting, and how long we give their
+# transports to drain before re-executing (seconds)
+RECONNECT_DELAY = 0.25
+RESTART_DRAIN_TIME = 0.1
+
 # TODO:
 #
 # ## Extend command set
@@ -75,9 +98,12 @@ logger = logging.getLogger(__name__)
 class OpusculeController:
     """Control object for the audio device; a singleton that manages all device functions."""
 
-    def __init__(self, cpo):
+    def __init__(self, cpo, mpd_pool, handoff=False):
         """
 
+        :param cpo: configuration parser object
+        :param mpd_pool: shared connections to mpd
+        :param handoff: True if we are taking over from a restarting server
         :return: an opuscule_controller object.
         """
 
@@ -99,14 +125,31 @@ class OpusculeController:
             'softer': self.do_softer,
             'mute': self.do_mute,
             'refresh': self.do_refresh,
+            'health': self.do_health,
+            'enqueue': self.do_enqueue,
+        }
+        # Commands that take the text the client sends along with them
+        self.message_commands = {
+            'search': self.do_search,
+            'artwork': self.do_artwork,
         }
 
         # Do Startup tasks
 
         # Configuration Parser object for those that need it
         self.cpo = cpo
+        # If the previous server handed over to us, mpd is still playing; don't disturb it
+        self.handoff = handoff
+        # Connections to mpd, shared by every component that needs one
+        self.mpd_pool = mpd_pool
         # Radio state object
-        self.rs = RadioState()
+        self.rs = RadioState(STATE_FILE)
+        # Thumbnails of the artwork of what's played
+        sizes = self.cpo.get('artwork', 'sizes', fallback=None)
+        cache_mb = self.cpo.getint('artwork', 'cache_mb', fallback=ARTWORK_LIMIT // (1024 * 1024))
+        self.artwork = ArtworkCache(self.mpd_pool,
+                                    sizes=[int(s) for s in sizes.split(',')] if sizes else ARTWORK_SIZES,
+                                    limit=cache_mb * 1024 * 1024)
 
         # Components
         self.registered_components = []
@@ -116,50 +159,179 @@ class OpusculeController:
         self.rs.menu.current_node.add_child(self.sfavs)
         self.rs.menu.selected_node = self.sfavs
 
-        # Attempt to register the remainder of the available components
-        self.register_component(LibraryComponent(self.sfavs))
-
-        # self.register_component(PodcastsComponent(self.sfavs))
+        # The remainder of the components, in menu order; each is registered once its requirements check out (see
+        # start_components)
+        self.library = LibraryComponent(self.sfavs, self.mpd_pool,
+                                        self.cpo.getint('library', 'concurrency', fallback=CONCURRENCY),
+                                        self.cpo.get('library', 'smart_playlists', fallback=SMART_PLAYLISTS_FILE))
+        self.components = [
+            self.library,
+            # PodcastsComponent(self.sfavs),
+            StreamingComponent(self.sfavs, self.cpo, self.mpd_pool),
+            BoodlerComponent(self.sfavs),
+            FmRadioComponent(self.sfavs),
+            WxRadioComponent(self.sfavs),
+            SettingsComponent(),
+            SystemComponent(restart_action=self.do_restart),
+        ]
+
+        # Requirement checks, with results remembered from the last boot
+        self.prober = Prober()
+
+        # Let everyone know when we lose (and regain) mpd
+        self.mpd_lost = False
+        self.mpd_pool.add_connection_listener(self.mpd_connection_changed)
+
+    async def start_components(self, ready=None):
+        """
+        Check component dependancies, add the components to the UI, and start them.
 
-        self.register_component(StreamingComponent(self.sfavs, self.cpo))
+        With each component, we need to make sure it reports that all requirements are fulfilled (hardware is available
+        for things like SDR, software subsystems are available for things like MPD and Boodler, etc.). The probes
+        for all of the components run at once, and any we checked on the last boot aren't waited for; they are
+        checked again in the background afterwards. The components then start side by side, and once they have,
+        the last session's state is restored.
 
-        self.register_component(BoodlerComponent(self.sfavs))
+        :param ready: if given, awaited before the state is restored (connecting to mpd, say)
+        :return:
+        """
+        probes = [probe for component in self.components for probe in component.requirement_probes()]
+        results = await self.prober.check(probes)
+
+        for component in self.components:
+            if self.requirements_met(component, results):
+                self.register_component(component)
+
+        await asyncio.gather(*(self.start_component(c) for c in self.registered_components))
+        if ready is not None:
+            await ready
+
+        # Now that the components have their menus and what they need to play (the Library its index), we can pick
+        # up where the last session left off
+        self.restore_state()
+        self.rs.schedule_state_update()
+
+        # Bring the probe results up to date for next time; a component that has only now become usable can
+        # join in straight away
+        changed = await self.prober.verify(probes)
+        if changed:
+            logger.info("Requirements changed since the last boot: {}".format(sorted(changed)))
+            results = await self.prober.check(probes)
+            for component in self.components:
+                if component not in self.registered_components and self.requirements_met(component, results):
+                    self.register_component(component)
+                    await self.start_component(component)
+            self.rs.schedule_state_update()
 
-        self.register_component(FmRadioComponent(self.sfavs))
+    @staticmethod
+    def requirements_met(component, results):
+        return component.requirements_met() and all(results[p.key] for p in component.requirement_probes())
 
-        self.register_component(WxRadioComponent(self.sfavs))
+    async def start_component(self, component):
+        """
+        Start one component, giving up on it if it takes longer than its start_timeout.
 
-        self.register_component(SettingsComponent())
+        :param component:
+        :return:
+        """
+        try:
+            await asyncio.wait_for(component.start(), component.start_timeout)
+        except asyncio.TimeoutError:
+            logger.error("{} component took too long to start.".format(component.component))
+            self.rs.messages.queue_message('FAULT', "{} didn't start in time.".format(component.menu_labels['name']))
+            self.rs.schedule_state_update()
+        except Exception as e:
+            logger.error("{} component failed to start: {}".format(component.component, e))
+            self.rs.messages.queue_message('FAULT', "{} failed to start.".format(component.menu_labels['name']))
+            self.rs.schedule_state_update()
 
-        self.register_component(SystemComponent())
+    async def stop_components(self):
+        await asyncio.gather(*(c.stop() for c in self.registered_components), return_exceptions=True)
 
     def register_component(self, component):
         """
-        Check component dependancies, and add component to the UI.
-
-        With each component, we need to make sure it reports that all requirements are fulfilled (hardware is available
-        for things like SDR, software subsystems are available for things like MPD and Boodler, etc.).
+        Add a component to the UI, keeping the components in the order they were declared.
 
         :param component:
         :return:
         """
-        if component.requirements_met():
-            logger.info("Requirements for {} component met; loading component.".format(component.component))
-            self.registered_components.append(component)
-            self.rs.menu.current_node.add_child(component)
-            if isinstance(component, AudioComponent):
-                self.sfavs.add_child_menu(component.favorites_node)
+        logger.info("Requirements for {} component met; loading component.".format(component.component))
+        position = self.components.index(component)
+        later = [c for c in self.registered_components if self.components.index(c) > position]
+        self.registered_components.append(component)
+        if later:
+            root = self.rs.menu.tree
+            root.children.insert(root.children.index(later[0]), component)
+            component.parent = root
+        else:
+            self.rs.menu.tree.add_child(component)
+        if isinstance(component, AudioComponent):
+            self.sfavs.add_child_menu(component.favorites_node)
+            component.add_change_listener(self.component_changed)
+
+    def component_changed(self, component):
+        """
+        A component has changed its menus (say, after the mpd database was updated); make sure we aren't left in
+        a part of the tree that has gone, and show everyone the new menus.
+
+        :param component: the component that changed
+        :return:
+        """
+        logger.debug("Menus changed in {}".format(component.component))
+        self.rs.menu.resync()
+        self.rs.schedule_state_update()
+
+    def mpd_connection_changed(self, up):
+        """
+        Tell the clients when mpd goes away or comes back.
+
+        :param up: True if the connection to mpd is up
+        :return:
+        """
+        if up:
+            if not self.mpd_lost:
+                return
+            self.rs.messages.queue_message('INFO', "Reconnected to the music player.")
+        else:
+            self.rs.messages.queue_message('FAULT', "Lost connection to the music player; retrying.")
+        self.mpd_lost = not up
+        self.rs.schedule_state_update()
+
+    def opus_from_metadata(self, md):
+        """
+        Ask the component that owns a saved opus to rebuild it.
+
+        :param md: opus metadata, as returned by opus_get_metadata
+        :return: the rebuilt opus, or None if no registered component claims it
+        """
+        for comp in self.registered_components:
+            if isinstance(comp, AudioComponent) and comp.component == md.get('component'):
+                return comp.opus_from_metadata(md)
+
+        logger.error("No component available to restore opus {}".format(md))
+        return None
 
-    def handle(self, command):
+    def restore_state(self):
+        """
+        Pick up where the previous session left off: menu position, volume, and whatever was playing.
+        """
+        self.rs.restore_state(self.opus_from_metadata, handoff=self.handoff)
+
+    def handle(self, command, message=""):
         """Handle incoming commands.
 
         We have a simple guard to sanity check the input, and then run the function associated with the command.
         """
 
         logger.debug("[Opuscule] Got command {}".format(command))
-        if command in self.commands:
+        if command in self.commands or command in self.message_commands:
             # change state
-            self.commands[command]()
+            if command in self.message_commands:
+                result = self.message_commands[command](message)
+            else:
+                result = self.commands[command]()
+            if result:
+                return result
             return {"response": "OK", "text": "Command accepted."}
         else:
             return {"response": "ERROR", "text": "Unknown command."}
@@ -261,6 +433,76 @@ class OpusculeController:
         else:
             return {"response": "ERROR", "text": "Only operai can be added as favorites."}
 
+    def do_enqueue(self):
+        """
+        Add the selected opus to the end of what's playing, rather than playing it in place of what's playing.
+        """
+        if isinstance(self.rs.menu.selected_node, Opus):
+            self.rs.menu.selected_node.opus_enqueue()
+        else:
+            return {"response": "ERROR", "text": "Only operai can be queued."}
+
+    def do_search(self, query):
+        """
+        Search the Library's tags, and go to the results.
+
+        :param query: the words to look for
+        """
+        if self.library not in self.registered_components:
+            return {"response": "ERROR", "text": "The Library isn't available."}
+        matched = self.library.search(query)
+        if matched is None:
+            return {"response": "ERROR", "text": "The Library is still getting ready to search; try again shortly."}
+        if not matched:
+            return {"response": "ERROR", "text": "Nothing in the Library matches '{}'.".format(query)}
+        self.rs.menu.jump(self.library.search_node)
+
+    def do_artwork(self, request):
+        """
+        Send the requesting client an image from the artwork cache.
+
+        :param request: the image's key (from now_playing), and optionally the size the client shows it at, in pixels
+        """
+        key, _, size = request.partition(' ')
+        try:
+            size = int(size) if size else None
+        except ValueError:
+            return {"response": "ERROR", "text": "Artwork sizes are in pixels."}
+        found = self.artwork.image(key, size)
+        if found is None:
+            return {"response": "ERROR", "text": "No artwork {}.".format(key)}
+        size, mime, data = found
+        return {"response": "OK", "text": "Artwork.",
+                "data": {'key': key, 'size': size, 'type': mime, 'image': base64.b64encode(data).decode('ascii')}}
+
+    def show_artwork(self, file):
+        """
+        Put the key of the playing track's artwork in the now playing frames, reading the artwork from mpd first if
+        the track is new to us.
+
+        :param file: the playing track's URI
+        """
+        if not file or '://' in file:
+            # Streams have no artwork in mpd
+            return
+        key = self.artwork.key_for(file)
+        if key is None:
+            asyncio.ensure_future(self.fetch_artwork(file))
+        else:
+            self.rs.now_playing.set_art(key)
+
+    async def fetch_artwork(self, file):
+        try:
+            key = await self.artwork.art_for(file)
+        except MPDUnavailable:
+            return
+        except Exception as e:
+            logger.error("Could not read the artwork for {}: {}".format(file, e))
+            return
+        if key and self.rs.now_playing.data['file'] == file:
+            self.rs.now_playing.set_art(key)
+            self.rs.schedule_state_update()
+
     def do_refresh(self):
         """
         Trigger a refresh for the requesting client
@@ -269,6 +511,16 @@ class OpusculeController:
         """
         pass
 
+    def do_health(self):
+        """
+        Report on the health of the connections to mpd, how quickly mpd is answering, and how long the last
+        Library refresh took.
+
+        :return:
+        """
+        return {"response": "OK", "text": "Health report.",
+                "data": {'mpd': self.mpd_pool.health(), 'library': self.library.refresh_timings}}
+
     def handle_internal(self):
         """
         Future hook for handling internal commands.
@@ -280,6 +532,10 @@ class OpusculeController:
     def do_shutdown():
         loop.stop()
 
+    @staticmethod
+    def do_restart():
+        restart_server()
+
 
 class OpusculeProtocol(asyncio.Protocol):
     """
@@ -314,7 +570,7 @@ class OpusculeProtocol(asyncio.Protocol):
         """
         curr_command = json.loads(data.decode())
 
-        cmd_response = op.handle(curr_command['command'])
+        cmd_response = op.handle(curr_command['command'], curr_command.get('message', ""))
 
         if cmd_response is None:
             cmd_response = [{"response": "OK"}]
@@ -323,9 +579,12 @@ class OpusculeProtocol(asyncio.Protocol):
 
         if cmd_response['response'] == "OK":
             op.rs.schedule_state_update()
+            # Some commands answer with data for the requesting client alone
+            if 'data' in cmd_response:
+                self.transport.write(json.dumps(cmd_response).encode('utf-8'))
         elif cmd_response['response'] == "ERROR":
             lading = json.dumps(cmd_response)
-            self.transport.write(lading)
+            self.transport.write(lading.encode('utf-8'))
 
     def connection_lost(self, ex):
         """
@@ -349,73 +608,157 @@ async def send_state(new_state):
         client.transport.write(lading.encode('utf-8'))
 
 
-def start_mpd_client():
+def restart_server():
+    """
+    Restart the server in place without dropping the listening sockets.
+
+    We stop taking connections, save our state, tell the connected clients to reconnect shortly, and then
+    re-execute ourselves with the listening sockets left open. The kernel keeps queueing new connections on those
+    sockets while the new process starts up, so clients never see a refused connection; the new process picks up
+    the saved state, and adopts any opus mpd has kept playing through the restart (and starts again any that
+    we played ourselves).
+    :return:
+    """
+    asyncio.ensure_future(_restart(op, servers, connected_clients))
+
+
+async def _restart(controller, servers, clients):
+    """
+    Hand over to a new process (see restart_server).
+
+    :param controller: the OpusculeController
+    :param servers: the asyncio servers listening for clients
+    :param clients: the connected clients' protocols
+    """
+    logger.info("Restarting server.")
+
+    # Stop accepting clients we'd only drop at the exec: we keep copies of the listening sockets for the new
+    # process, and close the servers' own, so anyone connecting from now on waits in the kernel's queue
+    listen_fds = []
+    for server in servers:
+        for sock in server.sockets:
+            fd = os.dup(sock.fileno())
+            os.set_inheritable(fd, True)
+            listen_fds.append(str(fd))
+        server.close()
+
+    # Operai we run ourselves won't survive the exec; stop them now and let the new process start them again
+    if not controller.rs.now_playing.current_opus.survives_restart:
+        controller.rs.now_playing.current_opus.opus_stop()
+
+    # The components write out what they'd otherwise only save in a while (like bookmarks), as they do at shutdown
+    await controller.stop_components()
+
+    for comp in controller.registered_components:
+        comp.save_favorites()
+    controller.rs.save_state()
+    controller.artwork.flush()
+
+    hint = json.dumps({'response': "RECONNECT", 'delay': RECONNECT_DELAY})
+    for client in list(clients):
+        client.transport.write(hint.encode('utf-8'))
+        client.transport.close()
+
+    asyncio.get_event_loop().call_later(RESTART_DRAIN_TIME, _reexec_server, listen_fds)
+
+
+def reexec_argv(args, listen_fds):
     """
-    Some of the components need an MPD client; we want to use the asyncio
-    aware version.
+    The command line to re-execute the server with: the one we were started with, handing on the listening sockets.
+
+    :param args: our command line (sys.argv)
+    :param listen_fds: file descriptors of the listening sockets, as strings
+    """
+    argv = [sys.executable, os.path.abspath(args[0])]
+
+    skip_next = False
+    for arg in args[1:]:
+        if skip_next:
+            skip_next = False
+        elif arg == '--listen-fds':
+            skip_next = True
+        elif not arg.startswith('--listen-fds='):
+            argv.append(arg)
+
+    return argv + ['--listen-fds', ','.join(listen_fds)]
+
+
+def _reexec_server(listen_fds):
+    """
+    Replace this process with a fresh copy of the server, passing along the listening sockets.
+    :param listen_fds: file descriptors of the listening sockets, as strings
     :return:
     """
-    return loop.run_until_complete(_start_mpd_client())
+    argv = reexec_argv(sys.argv, listen_fds)
+    logger.info("Re-executing server: {}".format(argv))
+    os.execv(sys.executable, argv)
 
 
-async def _start_mpd_client():
+async def _start_up(handoff):
     """
-    Start the MPD client, and make sure it's not in consume mode (we want
-    to be able to reverse through our playlists.
+    Connect to mpd and start the components, while the server is already accepting clients.
+
+    The components don't wait for mpd (those that use it pick it up when it comes), but the state they restore does.
+
+    :param handoff: True if we are taking over from a restarting server
     :return:
     """
+    await op.start_components(asyncio.ensure_future(_connect_mpd(handoff)))
+
+
+async def _connect_mpd(handoff):
+    """
+    Connect to mpd, and get it ready for the state we restore.
+
+    :param handoff: True if we are taking over from a restarting server
+    """
+    await mpd_pool.connect()
+
     try:
-        await mpdc.connect('localhost', 6600)
-    except Exception as e:
-        logger.error("Connection to mpd process failed:", e)
-    mpdc.consume(0)
+        # Zero the mpd queue on startup, unless we're taking over from a restarting server (mpd may be playing)
+        if not handoff:
+            await mpd_pool.run('clear')
+        # What's restored plays from the Library's index, if that's current with the database
+        await mpd_pool.mirror.refresh(['stats'])
+    except MPDUnavailable:
+        logger.error("mpd is unavailable; starting without it.")
 
 
 async def _monitor_mpd():
     """
-    Look for changes in the MPD subsystem, and update the radio state as
+    Follow the mirror of the mpd player state, and update the radio state as
     necessary.
     :return:
     """
-    curr_song = None
-    curr_status = None
+    changes = asyncio.Queue()
+    mpd_pool.mirror.add_listener(changes.put_nowait, ('player', 'playlist'))
 
-    while True:
-        logger.debug("entering async for loop for mpd monitoring")
+    prev_mpd_state = None
 
-        try:
-            curr_song = await mpdc.currentsong()
-        except Exception as e:
-            logger.error("Current song error: %s", e)
-        else:
-            logger.debug("Current song success!")
-
-        logger.debug("Data from monitor_mpd, mpdc.currentsong: " + str(curr_song))
+    while True:
+        changed = await changes.get()
+        logger.debug("MPD changes in %s", changed)
 
-        op.rs.now_playing.update_data(curr_song)
+        mirror = mpd_pool.mirror
 
-        try:
-            curr_status = await mpdc.status()
-        except Exception as e:
-            logger.error("Status error: %s", e)
-        else:
-            logger.debug("Status success!")
+        logger.debug("Data from monitor_mpd, currentsong: " + str(mirror.currentsong))
 
-        logger.debug("Data from monitor_mpd, mpdc.status: " + str(curr_status))
+        op.rs.now_playing.update_data(mirror.currentsong)
+        op.show_artwork(mirror.currentsong.get('file'))
+        correction = op.rs.now_playing.update_progress(mirror.status, mirror.status_time)
 
-        # If mpd stops the player, we need to inform opuscule
-        if curr_status['state'] == 'stop':
+        # If mpd stops the player, we need to inform opuscule; we only act on the transition, so that an opus
+        # restored at startup isn't stopped before mpd has had a chance to start it.
+        if mirror.state == 'stop' and prev_mpd_state in ('play', 'pause'):
             logger.debug("MPD has requested a stop.")
             op.rs.update('stop')
             logger.debug("Radio state stopped.")
+        prev_mpd_state = mirror.state
 
-        op.rs.schedule_state_update()
-
-        async for subsystem in mpdc.idle():
-            logger.debug("Idle change in %s", subsystem)
-
-            if 'player' in subsystem:
-                break
+        # Clients keep their own count of the position, so a player event that leaves playback where they'd
+        # expect it to be doesn't need a frame
+        if correction or 'playlist' in changed:
+            op.rs.schedule_state_update()
 
 
 async def _monitor_radio_state():
@@ -445,17 +788,30 @@ def shutdown():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Server settings")
     parser.add_argument("--port", type=int)
+    # Used internally when restarting: the listening sockets inherited from the previous process
+    parser.add_argument("--listen-fds", help=argparse.SUPPRESS)
     args = vars(parser.parse_args())
 
     logger.info("Starting up..")
 
+    # Menus are sorted the way the system's language sorts (see the Library's collation keys)
+    try:
+        locale.setlocale(locale.LC_COLLATE, '')
+    except locale.Error as e:
+        logger.error("Could not use the system's collation order: {}".format(e))
+
     cp = ConfigParser()
 
     cp.read('opuscule-config.ini')
 
-    mpdc = MPDClient()
+    handoff = bool(args['listen_fds'])
 
-    op = OpusculeController(cp)
+    loop = asyncio.get_event_loop()
+
+    mpd_pool = MPDPool(cp.get('mpd', 'host', fallback='localhost'),
+                       cp.getint('mpd', 'port', fallback=6600),
+                       cp.getint('mpd', 'connections', fallback=COMMAND_CONNECTIONS))
+    op = OpusculeController(cp, mpd_pool, handoff=handoff)
 
     connected_clients = []
 
@@ -466,18 +822,29 @@ if __name__ == '__main__':
     if args['port']:
         op_port = args['port']
 
-    loop = asyncio.get_event_loop()
-
-    start_mpd_client()
+    if args['listen_fds']:
+        # We were re-executed by a restart; keep serving on the sockets the previous process was listening on
+        servers = []
+        for fd in args['listen_fds'].split(','):
+            opserver = loop.create_server(OpusculeProtocol, sock=socket.socket(fileno=int(fd)))
+            servers.append(loop.run_until_complete(opserver))
+    else:
+        opserver = loop.create_server(OpusculeProtocol, port=op_port)
+        servers = [loop.run_until_complete(opserver)]
 
-    opserver = loop.create_server(OpusculeProtocol, port=op_port)
-    server = loop.run_until_complete(opserver)
+    for server in servers:
+        for sock in server.sockets:
+            logger.info("Serving on {}".format(sock.getsockname()))
 
-    for socket in server.sockets:
-        logger.info("Serving on {}".format(socket.getsockname()))
+    # The server is already taking connections; mpd, the components, and the state they restore follow along
+    startup_task = asyncio.Task(_start_up(handoff))
 
     mpdmon_task = asyncio.Task(_monitor_mpd())
 
+    mirror_task = asyncio.Task(mpd_pool.mirror.run())
+
+    mpd_supervisor_task = asyncio.Task(mpd_pool.supervise())
+
     menumon_task = asyncio.Task(_monitor_radio_state())
 
     # Uncomment the following when debugging asyncio
@@ -487,7 +854,12 @@ if __name__ == '__main__':
     # Comment the following when debugging asyncio
     loop.run_forever()
 
+    loop.run_until_complete(op.stop_components())
+
     for comp in op.registered_components:
         comp.save_favorites()
 
+    op.rs.save_state()
+    op.artwork.flush()
+
     shutdown()
@@ -0,0 +1,85 @@
+"""
+Small helpers for keeping opuscule state on disk.
+
+State changes arrive in bursts (a user scrolling through a menu can generate dozens of updates a second), so
+writes are coalesced: marking a store dirty schedules a single write a short time later, and any further
+changes in that window ride along with it.
+"""
+
+import asyncio
+import json
+import os
+import pickle
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def read_json(path, default=None):
+    """Return the decoded contents of a JSON file, or the default if it is missing or damaged."""
+    try:
+        with open(path, mode='r', encoding='utf-8') as the_file:
+            return json.loads(the_file.read())
+    except FileNotFoundError:
+        return default
+    except (json.JSONDecodeError, OSError) as e:
+        logger.error("Could not read saved state from {}: {}".format(path, e))
+        return default
+
+
+def write_json(path, data):
+    """Atomically replace a JSON file, so a power cut mid-write never leaves a truncated document behind."""
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, mode='w', encoding='utf-8') as the_file:
+        the_file.write(json.dumps(data))
+    os.replace(tmp_path, path)
+
+
+def read_pickle(path, default=None):
+    """Return the unpickled contents of a cache file, or the default if it is missing or damaged."""
+    try:
+        with open(path, mode='rb') as the_file:
+            return pickle.load(the_file)
+    except FileNotFoundError:
+        return default
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, OSError) as e:
+        logger.error("Could not read cache from {}: {}".format(path, e))
+        return default
+
+
+def write_pickle(path, data):
+    """Atomically replace a cache file with a pickle of the data."""
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, mode='wb') as the_file:
+        pickle.dump(data, the_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+class CoalescingWriter:
+    """
+    Write the document produced by a compose function to disk, at most once per delay period.
+    """
+
+    def __init__(self, path, compose, delay=1.0):
+        self.path = path
+        self.compose = compose
+        self.delay = delay
+        self.pending = None
+
+    def mark_dirty(self):
+        """Note that the document has changed; schedule a write if one isn't already pending."""
+        if self.pending is None:
+            loop = asyncio.get_event_loop()
+            self.pending = loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        """Write the document now, cancelling any pending write."""
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+
+        try:
+            write_json(self.path, self.compose())
+        except OSError as e:
+            logger.error("Could not save state to {}: {}".format(self.path, e))
@@ -0,0 +1,86 @@
+"""
+Getting the highlighted opus ready to play before it's selected.
+
+When the cursor rests on an opus for a moment, we give it the chance to do the slow part of starting up (asking mpd
+which tracks it covers, resolving a stream's playlist, checking a soundscape is installed) so that when it is
+selected, playing it only has to commit. Moving on cancels whatever was under way, so scrolling quickly through a
+menu costs nothing, and only the last few operai prepared keep what they found.
+"""
+
+import asyncio
+from collections import deque
+
+from base_classes import Opus
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How long the cursor has to rest on an opus before we prepare it (seconds)
+PRESTAGE_DWELL = 0.4
+# How long an opus gets to prepare before we give up on it (seconds)
+PRESTAGE_TIMEOUT = 5.0
+# How many operai keep their preparations at once
+PRESTAGE_KEEP = 4
+# The most tracks an opus looks up ahead of time; bigger ones are left for mpd to find when they're played
+PRESTAGE_MAX_TRACKS = 500
+
+
+class Prestager:
+    """
+    Prepare the opus under the cursor, one at a time.
+    """
+
+    def __init__(self, dwell=PRESTAGE_DWELL, timeout=PRESTAGE_TIMEOUT, keep=PRESTAGE_KEEP):
+        self.dwell = dwell
+        self.timeout = timeout
+        self.keep = keep
+        # The node we're waiting to prepare, the wait, and the preparation under way
+        self.node = None
+        self.pending = None
+        self.task = None
+        # Operai holding preparations, oldest first
+        self.prepared = deque()
+
+    def rest_on(self, node):
+        """
+        The cursor has moved to node; prepare it if it stays there long enough.
+        """
+        if node is self.node:
+            return
+        self.cancel()
+        self.node = node
+        if isinstance(node, Opus):
+            self.pending = asyncio.get_event_loop().call_later(self.dwell, self.start, node)
+
+    def cancel(self):
+        """Drop any preparation waiting or under way."""
+        self.node = None
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def start(self, opus):
+        self.pending = None
+        self.task = asyncio.ensure_future(self.prepare(opus))
+
+    async def prepare(self, opus):
+        try:
+            await asyncio.wait_for(opus.opus_prepare(), self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug("Preparing {} failed: {}".format(opus, e))
+            return
+        finally:
+            if self.task is asyncio.current_task():
+                self.task = None
+
+        if opus in self.prepared:
+            self.prepared.remove(opus)
+        self.prepared.append(opus)
+        while len(self.prepared) > self.keep:
+            self.prepared.popleft().opus_unprepare()
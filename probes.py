@@ -0,0 +1,135 @@
+"""
+Checks for the things components need before they can be offered: programs on the PATH, a reachable daemon, a USB
+device plugged in.
+
+Some probes are slow (a connection to a daemon that isn't there can take seconds to time out), so they all run at
+once, and their results are cached on disk between boots. At startup a component whose requirements were met last
+time is offered straight away, and the probes are run again in the background to bring the cache up to date.
+"""
+
+import asyncio
+import glob
+import os
+import shutil
+
+from persistence import read_json, write_json
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+PROBE_CACHE_FILE = "saved/probes.json"
+# How long any one probe gets before we count it as failed (seconds)
+PROBE_TIMEOUT = 3.0
+# Where the kernel lists attached USB devices
+USB_DEVICES = "/sys/bus/usb/devices"
+
+
+class Probe:
+    """
+    A single requirement. The key names the requirement uniquely, so that components sharing one share its result.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    async def check(self):
+        """Return True if the requirement is met. Raising counts as not met."""
+        return False
+
+
+class BinaryProbe(Probe):
+    """A program we need to run is on the PATH."""
+
+    def __init__(self, program):
+        super().__init__("binary:{}".format(program))
+        self.program = program
+
+    async def check(self):
+        return shutil.which(self.program) is not None
+
+
+class TCPProbe(Probe):
+    """A daemon we need to talk to (say, mpd) is accepting connections."""
+
+    def __init__(self, host, port):
+        super().__init__("tcp:{}:{}".format(host, port))
+        self.host = host
+        self.port = port
+
+    async def check(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.close()
+        return True
+
+
+class USBDeviceProbe(Probe):
+    """A USB device (say, an SDR dongle) is plugged in, identified by its vendor and product ids."""
+
+    def __init__(self, vendor, product, devices=USB_DEVICES):
+        super().__init__("usb:{}:{}".format(vendor, product))
+        self.vendor = vendor
+        self.product = product
+        self.devices = devices
+
+    def read_id(self, device, name):
+        try:
+            with open(os.path.join(device, name), encoding='utf-8') as the_file:
+                return the_file.read().strip()
+        except OSError:
+            return None
+
+    async def check(self):
+        for device in glob.glob(os.path.join(self.devices, '*')):
+            if self.read_id(device, 'idVendor') == self.vendor and self.read_id(device, 'idProduct') == self.product:
+                return True
+        return False
+
+
+class Prober:
+    """
+    Run probes concurrently, remembering their results on disk for the next boot.
+    """
+
+    def __init__(self, cache_file=PROBE_CACHE_FILE, timeout=PROBE_TIMEOUT):
+        self.cache_file = cache_file
+        self.timeout = timeout
+        self.cached = read_json(cache_file, default={})
+        # Results of probes run in this session
+        self.results = {}
+
+    async def run(self, probe):
+        try:
+            result = bool(await asyncio.wait_for(probe.check(), self.timeout))
+        except Exception as e:
+            logger.debug("Probe %s failed: %r", probe.key, e)
+            result = False
+        self.results[probe.key] = result
+        return result
+
+    async def check(self, probes):
+        """
+        Return a dict of results for the probes, using cached results where we have them and running the rest.
+        """
+        unique = {probe.key: probe for probe in probes}
+        await asyncio.gather(*(self.run(probe) for key, probe in unique.items()
+                               if key not in self.cached and key not in self.results))
+        return {key: self.results.get(key, self.cached.get(key)) for key in unique}
+
+    async def verify(self, probes):
+        """
+        Run the probes afresh and save the results for next time.
+
+        :return: the keys of any cached results that turned out to be out of date
+        """
+        unique = {probe.key: probe for probe in probes}
+        await asyncio.gather(*(self.run(probe) for probe in unique.values()))
+        changed = {key for key in unique if key in self.cached and self.cached[key] != self.results[key]}
+
+        self.cached.update(self.results)
+        try:
+            write_json(self.cache_file, self.cached)
+        except OSError as e:
+            logger.error("Could not save probe results: %s", e)
+
+        return changed
@@ -1,12 +1,21 @@
 # Startup
 from base_classes import Opus, MenuList, Command
 
+# Saving state between sessions
+from persistence import CoalescingWriter, read_json
+
+# Getting the highlighted opus ready to play
+from prestage import Prestager
+
 # To support opus history
 from collections import deque
 
 # Whee!
 import asyncio
 
+# Anchoring playback progress
+import time
+
 # Logging
 import logging
 
@@ -20,6 +29,9 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# How far (seconds) the reported position can drift from where we expected it before we call it a seek
+PROGRESS_TOLERANCE = 1.0
+
 
 class Menu:
     """
@@ -31,19 +43,13 @@ class Menu:
         self.current_node = self.tree
         self.selected_node = None
 
-    def jump(self, requested_component):
-        # """
-        # Move directly to a specified component.
-        # :param requested_component:
-        # :return:
-        # """
-        # for comp in self.registered_components:
-        #     if comp.labels['name'] == requested_component:
-        #         self.current_node = comp
-        #         # Reset selected mode; return to clean state
-        #         self.current_node.index = 0
-        #         self.selected_node = self.current_node.children[self.current_node.index]
-        pass
+    def jump(self, node):
+        """
+        Move directly to a menu list in the tree, with its first item selected.
+        """
+        self.current_node = node
+        node.index = 0
+        self.selected_node = node.selected_node()
 
     def compose_data(self):
 
@@ -68,6 +74,59 @@ class Menu:
 
         return updated_menu_data
 
+    def compose_snapshot(self):
+        """
+        Describe the path from the root to the current node, with the selection index of each node on the way.
+        """
+        path = []
+        node = self.current_node
+        while node is not None:
+            path.insert(0, {'name': node.menu_labels['name'], 'index': node.index})
+            if node is self.tree:
+                break
+            node = node.parent
+
+        return path
+
+    def restore_snapshot(self, path):
+        """
+        Walk down a saved path by name, going as deep as the current menu tree allows.
+        """
+        node = self.tree
+        for depth, entry in enumerate(path):
+            if depth > 0:
+                for child in node.children:
+                    if isinstance(child, MenuList) and child.menu_labels['name'] == entry['name']:
+                        child.parent = node
+                        node = child
+                        break
+                else:
+                    break
+            if node.children:
+                node.index = min(max(entry['index'], 0), len(node.children) - 1)
+
+        self.current_node = node
+        self.selected_node = node.selected_node()
+
+    def resync(self):
+        """
+        Catch up with changes made to the tree behind our back.
+
+        If the node we're in has been taken out of the tree, back out to the nearest ancestor that's still in it.
+        """
+        node = attached = self.current_node
+        while node is not self.tree:
+            parent = node.parent
+            if parent is None:
+                attached = self.tree
+                break
+            if not parent.has_child(node):
+                attached = parent
+            node = parent
+
+        self.current_node = attached
+        self.selected_node = attached.selected_node()
+
 
 class NowPlaying:
     """
@@ -80,6 +139,8 @@ class NowPlaying:
         self.play_history = deque('', 100)
         self.data = {}
         self.reset_data()
+        self.progress = {}
+        self.reset_progress()
 
     def add_to_history(self, opus):
         self.play_history.append(opus)
@@ -120,6 +181,7 @@ class NowPlaying:
                      'comment': "",
                      'url': "",
                      'subgenre': "",
+                     'art': "",
                      }
 
     def update_data(self, song_data):
@@ -144,9 +206,73 @@ class NowPlaying:
             else:
                 logger.error("Key name {} unsupported in now_playing.".format(key))
 
+    def set_art(self, key):
+        """Show the key of the playing track's artwork (see artwork.py)."""
+        self.data['art'] = key
+
     def get_data(self):
         return self.data
 
+    # Playback progress
+    #
+    # Rather than have clients poll for the position, we record where playback was at each mpd player event
+    # (with a monotonic timestamp) and let clients carry on counting from there. A new frame is only needed when
+    # the position stops following the clock: a seek, a pause, or a change of track.
+
+    def reset_progress(self):
+        self.progress = {'state': 'stop',
+                         'songid': None,
+                         'elapsed': 0.0,
+                         'duration': 0.0,
+                         'timestamp': None,
+                         }
+
+    def expected_elapsed(self, when):
+        """Where playback should be at the given monotonic time, if nothing has happened since the last event."""
+        elapsed = self.progress['elapsed']
+        if self.progress['state'] == 'play' and self.progress['timestamp'] is not None:
+            elapsed += when - self.progress['timestamp']
+        return elapsed
+
+    def update_progress(self, status, timestamp):
+        """
+        Record the position from an mpd status taken at the given monotonic time.
+
+        :return: True if this is a correction clients need to hear about, False if it's where they'd expect
+        """
+
+        def seconds(key):
+            try:
+                return float(status[key])
+            except (KeyError, ValueError):
+                return 0.0
+
+        progress = {'state': status.get('state', 'stop'),
+                    'songid': status.get('songid'),
+                    'elapsed': seconds('elapsed'),
+                    'duration': seconds('duration'),
+                    'timestamp': timestamp,
+                    }
+
+        correction = (progress['state'] != self.progress['state'] or
+                      progress['songid'] != self.progress['songid'] or
+                      abs(progress['elapsed'] - self.expected_elapsed(timestamp)) > PROGRESS_TOLERANCE)
+
+        self.progress = progress
+        return correction
+
+    def compose_progress(self):
+        """
+        The last recorded position, with the server's clock at the time of sending, so a client can work out the
+        position from then on.
+        """
+        return {'state': self.progress['state'],
+                'elapsed': self.progress['elapsed'],
+                'duration': self.progress['duration'],
+                'timestamp': self.progress['timestamp'],
+                'clock': time.monotonic(),
+                }
+
 
 class Messages:
     # Keep track of messages, add them to the outgoing state
@@ -195,6 +321,16 @@ class Volume:
             self.mxr = alsaaudio.Mixer('Power Amplifier')
             self.mxr.setvolume(self.level)
 
+    def set_level(self, level):
+        self.level = min(max(level, self.VOL_MIN), self.VOL_MAX)
+
+        if self.mxr and not self.muted:
+            self.mxr.setvolume(self.level)
+
+    def set_muted(self, muted):
+        if muted != self.muted:
+            self.toggle_mute()
+
     def louder(self):
         # Increase volume
         if self.level + self.VOL_STEP > self.VOL_MAX:
@@ -277,7 +413,7 @@ class RadioState:
     Object to handle every aspect of the current state of the radio.
     """
 
-    def __init__(self):
+    def __init__(self, state_file=None):
         self.menu = Menu()
         self.now_playing = NowPlaying()
         self.volume = Volume()
@@ -290,6 +426,14 @@ class RadioState:
 
         self.changes = asyncio.Queue()
 
+        # Prepare whichever opus the cursor rests on
+        self.prestager = Prestager()
+
+        # Snapshot the state to disk so we can come back up where we left off
+        self.state_writer = None
+        if state_file:
+            self.state_writer = CoalescingWriter(state_file, self.compose_snapshot)
+
     # State machine for play state
 
     def update(self, action):
@@ -335,9 +479,11 @@ class RadioState:
 
         self.current_state = 'playing'
         if isinstance(self.menu.selected_node, Opus):
-            self.now_playing.current_opus.opus_stop()
+            # Whatever preparation is done by now is what we play with
+            self.prestager.cancel()
+            previous_opus = self.now_playing.current_opus
             self.now_playing.load(self.menu.selected_node)
-            self.now_playing.current_opus.opus_play()
+            self.now_playing.current_opus.opus_transition(previous_opus)
             self.set_playing_indicators()
 
     def reset_playing(self):
@@ -393,12 +539,16 @@ class RadioState:
 
     def set_playing_indicators(self):
         """
-        In the playing state, only the play indicator should be lit.
+        In the playing state, only the play indicator should be lit; repeat and shuffle show the opus' settings,
+        which it may have picked up from where it was last left.
         """
 
         self.indicators.set_stop(False)
         self.indicators.set_play(True)
         self.indicators.set_pause(False)
+        opus = self.now_playing.current_opus
+        self.indicators.set_repeat(bool(opus.repeat_support and opus.repeat))
+        self.indicators.set_shuffle(bool(opus.shuffle_support and opus.shuffle))
 
     def set_paused_indicators(self):
         """
@@ -468,6 +618,7 @@ class RadioState:
         if self.menu.current_node.index < (len(self.menu.current_node.children) - 1):
             self.menu.current_node.index += 1
             self.menu.selected_node = self.menu.current_node.children[self.menu.current_node.index]
+        self.prestager.rest_on(self.menu.selected_node)
 
     def menu_retreat(self):
         """
@@ -477,16 +628,20 @@ class RadioState:
         if self.menu.current_node.index > 0:
             self.menu.current_node.index -= 1
             self.menu.selected_node = self.menu.current_node.children[self.menu.current_node.index]
+        self.prestager.rest_on(self.menu.selected_node)
 
     def menu_select(self):
         """
         Process node selection.
         """
+        if isinstance(self.menu.selected_node, MenuList):
+            self.menu.selected_node.menu_enter()
         if self.menu.selected_node.children:
             new_parent_node = self.menu.current_node
             self.menu.current_node = self.menu.selected_node
             self.menu.selected_node = self.menu.current_node.children[self.menu.current_node.index]
             self.menu.current_node.parent = new_parent_node
+        self.prestager.rest_on(self.menu.selected_node)
 
     def menu_escape(self):
         """
@@ -495,6 +650,7 @@ class RadioState:
         if self.menu.current_node.parent:
             self.menu.current_node = self.menu.current_node.parent
             self.menu.selected_node = self.menu.current_node.children[self.menu.current_node.index]
+        self.prestager.rest_on(self.menu.selected_node)
 
     def schedule_state_update(self):
         """
@@ -507,12 +663,95 @@ class RadioState:
                    'messages': self.messages.compose_data(),
                    'menu': self.menu.compose_data(),
                    'now_playing': self.now_playing.get_data(),
+                   'progress': self.now_playing.compose_progress(),
                    'volume': self.volume.compose_data(),
                    'indicators': self.indicators.compose_data(),
                    }
 
         self.changes.put_nowait(minimal)
 
+        if self.state_writer:
+            self.state_writer.mark_dirty()
+
+    # Saving and restoring state across restarts
+
+    def compose_snapshot(self):
+        """
+        Returns a dict with everything we need to bring the appliance back up in the same state.
+        """
+
+        co = self.now_playing.current_opus
+
+        snapshot = {'menu': self.menu.compose_snapshot(),
+                    'playstate': self.current_state,
+                    'opus': co.opus_get_metadata(),
+                    'repeat': co.repeat,
+                    'shuffle': co.shuffle,
+                    'volume': self.volume.get_level(),
+                    'muted': self.volume.muted,
+                    }
+
+        return snapshot
+
+    def save_state(self):
+        """
+        Write any pending snapshot to disk right away.
+        """
+        if self.state_writer:
+            self.state_writer.flush()
+
+    def restore_state(self, opus_factory, handoff=False):
+        """
+        Bring back the state saved by a previous session.
+
+        The opus factory takes opus metadata and returns a matching opus (or None if no component can build it).
+        If we were playing when the snapshot was taken, playback resumes immediately. On a handoff from a
+        restarting server, operai that kept playing through the restart are adopted rather than restarted.
+        """
+        if not self.state_writer:
+            return
+
+        snapshot = read_json(self.state_writer.path)
+        if not snapshot:
+            return
+
+        logger.info("Restoring saved radio state.")
+
+        self.volume.set_level(snapshot.get('volume', self.volume.get_level()))
+        self.volume.set_muted(snapshot.get('muted', False))
+        self.indicators.set_mute(self.volume.muted)
+
+        self.menu.restore_snapshot(snapshot.get('menu', []))
+
+        opus = None
+        if snapshot.get('opus'):
+            opus = opus_factory(snapshot['opus'])
+        if opus is None:
+            return
+
+        if opus.repeat_support:
+            opus.repeat = snapshot.get('repeat', 0)
+            self.indicators.set_repeat(bool(opus.repeat))
+        if opus.shuffle_support:
+            opus.shuffle = snapshot.get('shuffle', 0)
+            self.indicators.set_shuffle(bool(opus.shuffle))
+
+        self.now_playing.load(opus)
+
+        adopt = handoff and opus.survives_restart
+
+        if snapshot.get('playstate') == 'playing':
+            self.current_state = 'playing'
+            self.set_playing_indicators()
+            if adopt:
+                opus.opus_adopt()
+            else:
+                opus.opus_play()
+        elif snapshot.get('playstate') == 'paused' and adopt:
+            self.current_state = 'paused'
+            self.set_paused_indicators()
+            opus.opus_adopt()
+
     async def idle(self):
         """
         Support for async not calls.
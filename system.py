@@ -5,7 +5,7 @@ import logging
 
 
 class SystemComponent(MenuComponent):
-    def __init__(self):
+    def __init__(self, restart_action=None):
         # Do Startup tasks
         super().__init__("System", "Sys", "System Commands")
 
@@ -13,7 +13,8 @@ class SystemComponent(MenuComponent):
 
         self.add_child(GenericCommand("Logs", "Log", "Display the logs.", "logging command"))
         self.add_child(SleepCommand())
-        self.add_child(GenericCommand("Restart", "Rst", "Restart the system.", "restart command"))
+        self.add_child(GenericCommand("Restart", "Rst", "Restart the system.", "restart command",
+                                      action=restart_action))
         self.add_child(GenericCommand("Shutdown", "Stdn", "Shutdown the system.", "shutdown command"))
 
     def requirements_met(self):
@@ -22,15 +23,21 @@ class SystemComponent(MenuComponent):
 
 class GenericCommand(Command):
 
-    def __init__(self, name, short_name, comment, command_string):
+    def __init__(self, name, short_name, comment, command_string, action=None):
 
         super().__init__(name, short_name, comment)
         self.cmd = command_string
         self.component = "system"
+        self.action = action
 
     def execute(self):
         logging.debug("System command: {}".format(self.menu_labels['comment']))
 
+    def command_execute(self):
+        self.execute()
+        if self.action:
+            self.action()
+
 
 class SleepCommand(Command):
 
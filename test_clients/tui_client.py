@@ -450,6 +450,7 @@ class ApplianceClientProtocol(asyncio.Protocol):
         super().__init__()
         self.app_client = app_client
         self.transport = None
+        self.reconnect_delay = None
 
     def connection_made(self, transport):
         self.transport = transport
@@ -471,7 +472,10 @@ class ApplianceClientProtocol(asyncio.Protocol):
         try:
             data = json.loads(datas)
 
-            if data['response'] != 'ERROR':
+            if data['response'] == 'RECONNECT':
+                # The server is restarting in place; it will be back on the same port momentarily
+                self.reconnect_delay = data['delay']
+            elif data['response'] != 'ERROR':
                 ac.process_state(data)
             else:
                 logger.debug("Got a error before processing the command.)")
@@ -492,8 +496,17 @@ class ApplianceClientProtocol(asyncio.Protocol):
         logging.debug('Data sent: {!r}'.format(command))
 
     def connection_lost(self, exc):
-        print('The server closed the connection')
-        loop.stop()
+        clients.remove(self)
+        if self.reconnect_delay is not None:
+            logger.debug("Server restarting; reconnecting.")
+            loop.call_later(self.reconnect_delay, reconnect)
+        else:
+            print('The server closed the connection')
+            loop.stop()
+
+
+def reconnect():
+    loop.create_task(loop.create_connection(client_factory, *SERVER_ADDRESS))
 
 
 async def scroll_event_generator(step_duration):
@@ -0,0 +1,586 @@
+"""
+A stand-in for the mpd daemon, for tests and benchmarks.
+
+It speaks enough of the mpd protocol for opuscule: the queue and player commands, tag queries against a small
+in-memory database, stored playlists, idle notification, and command lists. Every response can be delayed to
+simulate the round trip to a real daemon on a busy SBC.
+"""
+
+import asyncio
+import time
+
+PROTOCOL_VERSION = "0.23.0"
+
+
+def parse_arguments(line):
+    """Split an mpd command line into the command and its (possibly quoted) arguments."""
+    args = []
+    i = 0
+    while i < len(line):
+        if line[i] == ' ':
+            i += 1
+        elif line[i] == '"':
+            i += 1
+            arg = []
+            while line[i] != '"':
+                if line[i] == '\\':
+                    i += 1
+                arg.append(line[i])
+                i += 1
+            args.append(''.join(arg))
+            i += 1
+        else:
+            end = line.find(' ', i)
+            if end == -1:
+                end = len(line)
+            args.append(line[i:end])
+            i = end
+    return args[0], args[1:]
+
+
+class MPDError(Exception):
+    def __init__(self, code, command, text):
+        super().__init__(text)
+        self.code = code
+        self.command = command
+        self.text = text
+
+
+def make_track(file, **tags):
+    """A database entry: the file URI, tags as keyword arguments, and a duration (defaulting to 3 minutes)."""
+    track = {'file': file}
+    track.update(tags)
+    track.setdefault('duration', 180.0)
+    return track
+
+
+class FakeMPD:
+    """
+    The state of a pretend mpd daemon, and an asyncio server exposing it.
+    """
+
+    def __init__(self, tracks=(), playlists=None, latency=0.0, db_update=1500000000):
+        self.tracks = list(tracks)
+        self.playlists = dict(playlists or {})
+        self.latency = latency
+        self.db_update = db_update
+        self.art = {}
+
+        self.queue = []
+        self.queue_version = 1
+        self.next_id = 1
+        self.state = 'stop'
+        self.pos = None
+        self.elapsed = 0.0
+        self.started = None
+        self.random = 0
+        self.repeat = 0
+        self.consume = 0
+        self.volume = 80
+
+        self.commands_seen = []
+        self.idlers = []
+        self.connections = set()
+        # Changes that happened while each connection wasn't idling, reported at its next idle (as mpd does)
+        self.missed = {}
+        self.server = None
+        self.port = None
+
+    # Running the server
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        self.server.close()
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def drop_connections(self):
+        """Hang up on every client, as a restarting daemon would."""
+        for task in list(self.connections):
+            task.cancel()
+
+    async def handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        self.missed[task] = set()
+        writer.write("OK MPD {}\n".format(PROTOCOL_VERSION).encode('utf-8'))
+        command_list = None
+        list_ok = False
+        pending_read = None
+        try:
+            while True:
+                if pending_read is not None:
+                    raw, pending_read = await pending_read, None
+                else:
+                    raw = await reader.readline()
+                if not raw:
+                    break
+                line = raw.decode('utf-8').rstrip('\n')
+
+                if line in ('command_list_begin', 'command_list_ok_begin'):
+                    command_list = []
+                    list_ok = line == 'command_list_ok_begin'
+                    continue
+                if command_list is not None and line != 'command_list_end':
+                    command_list.append(line)
+                    continue
+
+                in_list = line == 'command_list_end'
+                if in_list:
+                    lines, command_list = command_list, None
+                elif line == 'noidle':
+                    # A noidle that raced an idle response; mpd ignores these
+                    continue
+                else:
+                    lines = [line]
+
+                command, args = parse_arguments(lines[0])
+                if command == 'idle':
+                    pending_read = await self.wait_idle(reader, writer, args, self.missed[task])
+                    continue
+
+                response = []
+                try:
+                    for n, list_line in enumerate(lines):
+                        command, args = parse_arguments(list_line)
+                        self.commands_seen.append(command)
+                        try:
+                            response.extend(self.execute(command, args))
+                        except MPDError as e:
+                            e.index = n
+                            raise
+                        if in_list and list_ok:
+                            response.append(b"list_OK\n")
+                    response.append(b"OK\n")
+                except MPDError as e:
+                    response.append("ACK [{}@{}] {{{}}} {}\n".format(e.code, e.index, e.command, e.text)
+                                    .encode('utf-8'))
+
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                writer.write(b''.join(response))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task)
+            self.missed.pop(task, None)
+            writer.close()
+
+    async def wait_idle(self, reader, writer, subsystems, missed):
+        """
+        Block in idle until one of the subsystems changes, or the client sends noidle.
+
+        Returns the read of the client's next line if it is still outstanding, for the caller to pick up.
+        """
+        changed = asyncio.get_event_loop().create_future()
+        entry = (set(subsystems), changed)
+        already = [s for s in sorted(missed) if not subsystems or s in subsystems]
+        missed.difference_update(already)
+        if already:
+            changed.set_result(already)
+        self.idlers.append(entry)
+        next_line = asyncio.ensure_future(reader.readline())
+        try:
+            await asyncio.wait([changed, next_line], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.idlers.remove(entry)
+        if changed.done():
+            missed.difference_update(changed.result())
+
+        lines = ["changed: {}\n".format(s) for s in (changed.result() if changed.done() else [])]
+        writer.write((''.join(lines) + "OK\n").encode('utf-8'))
+        await writer.drain()
+
+        if next_line.done() and next_line.result().rstrip(b'\n') == b'noidle':
+            return None
+        return next_line
+
+    def notify(self, *subsystems):
+        for missed in self.missed.values():
+            missed.update(subsystems)
+        for wanted, changed in list(self.idlers):
+            hits = [s for s in subsystems if not wanted or s in wanted]
+            if hits and not changed.done():
+                changed.set_result(hits)
+
+    # Changing the database, as an mpd update or a client saving a playlist would
+
+    def update_database(self, tracks):
+        self.tracks = list(tracks)
+        self.db_update += 1
+        self.notify('database')
+
+    def save_playlist(self, name, files):
+        self.playlists[name] = list(files)
+        self.notify('stored_playlist')
+
+    # Player bookkeeping
+
+    def current_elapsed(self):
+        if self.state == 'play' and self.started is not None:
+            return self.elapsed + (time.monotonic() - self.started)
+        return self.elapsed
+
+    def set_state(self, state, pos=None, elapsed=0.0):
+        self.elapsed = elapsed if state != 'pause' else self.current_elapsed()
+        self.state = state
+        if pos is not None:
+            self.pos = pos
+        self.started = time.monotonic() if state == 'play' else None
+        self.notify('player')
+
+    def queue_changed(self):
+        self.queue_version += 1
+        self.notify('playlist')
+
+    def enqueue(self, tracks):
+        for track in tracks:
+            self.queue.append({'track': track, 'id': self.next_id, 'version': self.queue_version + 1})
+            self.next_id += 1
+        self.queue_changed()
+
+    def song_lines(self, pos):
+        entry = self.queue[pos]
+        lines = self.track_lines(entry['track'])
+        lines.append("Pos: {}".format(pos))
+        lines.append("Id: {}".format(entry['id']))
+        return lines
+
+    @staticmethod
+    def track_lines(track):
+        lines = ["file: {}".format(track['file'])]
+        for key, value in track.items():
+            if key == 'file':
+                continue
+            if key == 'duration':
+                lines.append("Time: {}".format(int(value)))
+                lines.append("duration: {:.3f}".format(value))
+                continue
+            values = value if isinstance(value, list) else [value]
+            for v in values:
+                lines.append("{}: {}".format(key[0].upper() + key[1:], v))
+        return lines
+
+    # Database queries
+
+    @staticmethod
+    def tag_values(track, tag):
+        tag = tag.lower()
+        if tag == 'albumartist' and 'albumartist' not in track:
+            tag = 'artist'
+        value = track.get(tag)
+        if value is None:
+            return []
+        return value if isinstance(value, list) else [value]
+
+    def matches(self, track, terms, exact=True):
+        if len(terms) == 1 and terms[0].startswith('('):
+            return self.matches_expression(track, terms[0])
+        for tag, value in zip(terms[0::2], terms[1::2]):
+            if tag.lower() == 'base':
+                if not track['file'].startswith(value.rstrip('/') + '/'):
+                    return False
+                continue
+            if tag.lower() in ('file', 'any'):
+                candidates = [track['file']] + [str(v) for k, v in track.items() if tag.lower() == 'any']
+            else:
+                candidates = self.tag_values(track, tag)
+            if exact:
+                if value not in candidates:
+                    return False
+            elif not any(value.lower() in c.lower() for c in candidates):
+                return False
+        return True
+
+    @staticmethod
+    def matches_expression(track, expression):
+        # Only the "everything" filter opuscule uses for bulk queries
+        if "modified-since" in expression:
+            return True
+        raise MPDError(2, 'find', "Unsupported filter")
+
+    def find(self, args, exact=True):
+        window = None
+        if 'window' in args:
+            at = args.index('window')
+            start, end = args[at + 1].split(':')
+            window = (int(start), int(end))
+            args = args[:at] + args[at + 2:]
+        if 'sort' in args:
+            at = args.index('sort')
+            args = args[:at] + args[at + 2:]
+        found = [t for t in self.tracks if self.matches(t, args, exact)]
+        if window:
+            found = found[window[0]:window[1]]
+        return found
+
+    def list_tag(self, args):
+        tag = args[0].lower()
+        args = args[1:]
+        groups = []
+        while 'group' in args:
+            at = args.index('group')
+            groups.append(args[at + 1].lower())
+            args = args[:at] + args[at + 2:]
+        tracks = [t for t in self.tracks if self.matches(t, args)]
+
+        lines = []
+        seen = set()
+        for track in tracks:
+            group_values = [(self.tag_values(track, g) or [''])[0] for g in groups]
+            for value in self.tag_values(track, tag) or ([''] if groups else []):
+                key = tuple(group_values) + (value,)
+                if key in seen:
+                    continue
+                seen.add(key)
+                lines.append((group_values, value))
+        lines.sort(key=lambda item: (item[0], item[1]))
+
+        out = []
+        previous_groups = None
+        for group_values, value in lines:
+            for n, g in enumerate(groups):
+                if previous_groups is None or previous_groups[:n + 1] != group_values[:n + 1]:
+                    out.append("{}: {}".format(g[0].upper() + g[1:], group_values[n]))
+            previous_groups = group_values
+            out.append("{}: {}".format(tag[0].upper() + tag[1:], value))
+        return out
+
+    # Commands
+
+    def execute(self, command, args):
+        handler = getattr(self, "cmd_{}".format(command), None)
+        if handler is None:
+            raise MPDError(5, command, "unknown command \"{}\"".format(command))
+        lines = handler(args) or []
+        return ["{}\n".format(line).encode('utf-8') if isinstance(line, str) else line for line in lines]
+
+    def cmd_ping(self, args):
+        pass
+
+    def cmd_noidle(self, args):
+        pass
+
+    def cmd_status(self, args):
+        lines = ["volume: {}".format(self.volume),
+                 "repeat: {}".format(self.repeat),
+                 "random: {}".format(self.random),
+                 "single: 0",
+                 "consume: {}".format(self.consume),
+                 "playlist: {}".format(self.queue_version),
+                 "playlistlength: {}".format(len(self.queue)),
+                 "state: {}".format(self.state)]
+        if self.state != 'stop' and self.pos is not None and self.pos < len(self.queue):
+            duration = self.queue[self.pos]['track']['duration']
+            elapsed = self.current_elapsed()
+            lines += ["song: {}".format(self.pos),
+                      "songid: {}".format(self.queue[self.pos]['id']),
+                      "time: {}:{}".format(int(elapsed), int(duration)),
+                      "elapsed: {:.3f}".format(elapsed),
+                      "duration: {:.3f}".format(duration)]
+            if self.pos + 1 < len(self.queue):
+                lines += ["nextsong: {}".format(self.pos + 1),
+                          "nextsongid: {}".format(self.queue[self.pos + 1]['id'])]
+        return lines
+
+    def cmd_stats(self, args):
+        return ["artists: {}".format(len({a for t in self.tracks for a in self.tag_values(t, 'artist')})),
+                "albums: {}".format(len({a for t in self.tracks for a in self.tag_values(t, 'album')})),
+                "songs: {}".format(len(self.tracks)),
+                "uptime: 100",
+                "db_playtime: {}".format(int(sum(t['duration'] for t in self.tracks))),
+                "db_update: {}".format(self.db_update),
+                "playtime: 0"]
+
+    def cmd_currentsong(self, args):
+        if self.state != 'stop' and self.pos is not None and self.pos < len(self.queue):
+            return self.song_lines(self.pos)
+
+    def cmd_consume(self, args):
+        self.consume = int(args[0])
+        self.notify('options')
+
+    def cmd_random(self, args):
+        self.random = int(args[0])
+        self.notify('options')
+
+    def cmd_repeat(self, args):
+        self.repeat = int(args[0])
+        self.notify('options')
+
+    def cmd_setvol(self, args):
+        self.volume = int(args[0])
+        self.notify('mixer')
+
+    def cmd_clear(self, args):
+        self.queue = []
+        if self.state != 'stop':
+            self.set_state('stop')
+        self.pos = None
+        self.queue_changed()
+
+    def cmd_add(self, args):
+        uri = args[0]
+        tracks = [t for t in self.tracks if t['file'] == uri or t['file'].startswith(uri.rstrip('/') + '/')]
+        if not tracks:
+            if '://' in uri:
+                tracks = [{'file': uri, 'duration': 0.0}]
+            else:
+                raise MPDError(50, 'add', "No such directory")
+        self.enqueue(tracks)
+
+    def cmd_addid(self, args):
+        self.cmd_add(args[:1])
+        return ["Id: {}".format(self.queue[-1]['id'])]
+
+    def cmd_findadd(self, args):
+        self.enqueue(self.find(args))
+
+    def cmd_searchadd(self, args):
+        self.enqueue(self.find(args, exact=False))
+
+    def cmd_find(self, args):
+        lines = []
+        for track in self.find(args):
+            lines.extend(self.track_lines(track))
+        return lines
+
+    def cmd_search(self, args):
+        lines = []
+        for track in self.find(args, exact=False):
+            lines.extend(self.track_lines(track))
+        return lines
+
+    def cmd_count(self, args):
+        found = self.find(args)
+        return ["songs: {}".format(len(found)),
+                "playtime: {}".format(int(sum(t['duration'] for t in found)))]
+
+    def cmd_list(self, args):
+        return self.list_tag(args)
+
+    def cmd_listallinfo(self, args):
+        lines = []
+        for track in self.tracks:
+            lines.extend(self.track_lines(track))
+        return lines
+
+    def cmd_lsinfo(self, args):
+        base = args[0].strip('/') if args else ''
+        prefix = base + '/' if base else ''
+        directories = []
+        lines = []
+        for track in self.tracks:
+            if not track['file'].startswith(prefix):
+                continue
+            rest = track['file'][len(prefix):]
+            if '/' in rest:
+                directory = prefix + rest.split('/')[0]
+                if directory not in directories:
+                    directories.append(directory)
+            else:
+                lines.extend(self.track_lines(track))
+        return ["directory: {}".format(d) for d in directories] + lines
+
+    def cmd_listplaylists(self, args):
+        return ["playlist: {}\nLast-Modified: 2020-01-01T00:00:00Z".format(name) for name in self.playlists]
+
+    def cmd_load(self, args):
+        if args[0] not in self.playlists:
+            raise MPDError(50, 'load', "No such playlist")
+        files = self.playlists[args[0]]
+        self.enqueue([t for f in files for t in self.tracks if t['file'] == f])
+
+    def cmd_playlistinfo(self, args):
+        lines = []
+        for pos in range(len(self.queue)):
+            lines.extend(self.song_lines(pos))
+        return lines
+
+    def cmd_plchanges(self, args):
+        version = int(args[0])
+        lines = []
+        for pos, entry in enumerate(self.queue):
+            if entry['version'] > version:
+                lines.extend(self.song_lines(pos))
+        return lines
+
+    def cmd_delete(self, args):
+        if ':' in args[0]:
+            start, end = (int(v) for v in args[0].split(':'))
+        else:
+            start = int(args[0])
+            end = start + 1
+        del self.queue[start:end]
+        for entry in self.queue[start:]:
+            entry['version'] = self.queue_version + 1
+        if self.pos is not None and self.pos >= end:
+            self.pos -= end - start
+        self.queue_changed()
+
+    def cmd_play(self, args):
+        if not self.queue:
+            return
+        pos = int(args[0]) if args else (self.pos if self.pos is not None else 0)
+        if pos >= len(self.queue):
+            raise MPDError(2, 'play', "Bad song index")
+        self.set_state('play', pos)
+
+    def cmd_playid(self, args):
+        for pos, entry in enumerate(self.queue):
+            if entry['id'] == int(args[0]):
+                self.set_state('play', pos)
+                return
+        raise MPDError(50, 'playid', "No such song")
+
+    def cmd_seek(self, args):
+        self.set_state('play', int(args[0]), float(args[1]))
+
+    def cmd_seekcur(self, args):
+        self.set_state(self.state if self.state != 'stop' else 'play', self.pos, float(args[0]))
+
+    def cmd_stop(self, args):
+        self.set_state('stop')
+
+    def cmd_pause(self, args):
+        if self.state == 'stop':
+            return
+        if args and args[0] == '0' or not args and self.state == 'pause':
+            self.set_state('play', self.pos, self.elapsed)
+        else:
+            self.set_state('pause')
+
+    def cmd_next(self, args):
+        if self.pos is not None and self.pos + 1 < len(self.queue):
+            self.set_state('play', self.pos + 1)
+        else:
+            self.set_state('stop')
+
+    def cmd_previous(self, args):
+        if self.pos:
+            self.set_state('play', self.pos - 1)
+
+    def cmd_albumart(self, args):
+        return self.binary_chunk('albumart', args)
+
+    def cmd_readpicture(self, args):
+        return self.binary_chunk('readpicture', args)
+
+    def binary_chunk(self, command, args):
+        directory = args[0].rsplit('/', 1)[0]
+        data = self.art.get(directory)
+        if data is None:
+            if command == 'readpicture':
+                return []
+            raise MPDError(50, command, "No file exists")
+        offset = int(args[1])
+        chunk = data[offset:offset + 8192]
+        return ["size: {}".format(len(data)), "binary: {}".format(len(chunk)),
+                chunk + b"\n"]
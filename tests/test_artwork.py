@@ -0,0 +1,95 @@
+import io
+import os
+import tempfile
+import unittest
+
+from artwork import ArtworkCache, NO_PILLOW
+from mpdpool import MPDPool
+from tests.fake_mpd import FakeMPD, make_track
+
+COVER = b'\x89PNG' + bytes(range(256)) * 80
+
+
+class TestArtworkCache(unittest.IsolatedAsyncioTestCase):
+    """
+    Read each cover from mpd once, and keep what we've read within bounds
+    """
+
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmpdir.name, "artwork")
+        self.fake = FakeMPD([make_track("{}/{}.mp3".format(album, n)) for album in ("a", "b", "c") for n in range(3)])
+        self.fake.art = {"a": COVER, "b": COVER, "c": b'\xff\xd8' + bytes(30000)}
+        self.pool = MPDPool('127.0.0.1', await self.fake.start())
+        await self.pool.connect()
+
+    async def asyncTearDown(self):
+        self.pool.disconnect()
+        await self.fake.stop()
+        self.tmpdir.cleanup()
+
+    def reads(self):
+        return sum(1 for command in self.fake.commands_seen if command in ('albumart', 'readpicture'))
+
+    async def test_read_once(self):
+        cache = ArtworkCache(self.pool, self.directory)
+        self.assertIsNone(cache.key_for("a/0.mp3"))
+
+        key = await cache.art_for("a/0.mp3")
+        # albumart comes in 8k chunks
+        reads = self.reads()
+        self.assertEqual(reads, 3)
+        self.assertEqual(cache.image(key)[1:], ('image/png', COVER))
+
+        # The rest of the album shares the cover, and another album with the same cover shares the image
+        self.assertEqual(await cache.art_for("a/2.mp3"), key)
+        self.assertEqual(self.reads(), reads)
+        self.assertEqual(await cache.art_for("b/1.mp3"), key)
+        self.assertEqual(len(cache.images), 1)
+
+        # No artwork is remembered too
+        self.fake.tracks.append(make_track("bare.mp3"))
+        self.assertEqual(await cache.art_for("bare.mp3"), '')
+        reads = self.reads()
+        self.assertEqual(await cache.art_for("bare.mp3"), '')
+        self.assertEqual(self.reads(), reads)
+
+        cache.flush()
+        self.assertEqual(ArtworkCache(self.pool, self.directory).key_for("b/0.mp3"), key)
+
+    async def test_bounded(self):
+        cache = ArtworkCache(self.pool, self.directory, limit=35000)
+        first = await cache.art_for("a/0.mp3")
+        second = await cache.art_for("c/0.mp3")
+
+        self.assertEqual(list(cache.images), [second])
+        self.assertIsNone(cache.image(first))
+        self.assertEqual(sorted(os.listdir(self.directory)), ["{}-0".format(second)])
+        # Tracks whose image went will read it again, next time
+        self.assertIsNone(cache.key_for("a/0.mp3"))
+
+    @unittest.skipIf(NO_PILLOW, "needs Pillow")
+    async def test_thumbnails(self):
+        from PIL import Image
+        out = io.BytesIO()
+        Image.new('RGBA', (640, 480), (200, 40, 40, 255)).save(out, 'PNG')
+        self.fake.art["a"] = out.getvalue()
+
+        cache = ArtworkCache(self.pool, self.directory, sizes=(96, 320))
+        key = await cache.art_for("a/0.mp3")
+
+        self.assertEqual(cache.images[key][2], [96, 320])
+        for size, wanted in ((50, (96, 72)), (200, (320, 240)), (1000, (320, 240))):
+            stored, mime, data = cache.image(key, size)
+            self.assertEqual(mime, 'image/jpeg')
+            with Image.open(io.BytesIO(data)) as thumbnail:
+                self.assertEqual((thumbnail.format, thumbnail.size), ('JPEG', wanted))
+
+    async def test_undecodable_art_is_kept_as_it_is(self):
+        cache = ArtworkCache(self.pool, self.directory)
+        key = await cache.art_for("c/0.mp3")
+        self.assertEqual(cache.image(key)[1:], ('image/jpeg', self.fake.art["c"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from bookmarks import Bookmark, BookmarkStore
+from components.library import SliceOpus
+from mpdpool import MPDPool
+from persistence import read_json
+from tests.fake_mpd import FakeMPD, make_track
+
+
+class TestBookmarkStore(unittest.IsolatedAsyncioTestCase):
+    """
+    Remember where operai were left, in a small file written now and then
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "bookmarks.json")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    async def test_writes_are_coalesced(self):
+        store = BookmarkStore(self.path, delay=0.05)
+        for elapsed in range(10):
+            store.record("a", Bookmark(2, float(elapsed), 1, 0, 7))
+        self.assertFalse(os.path.exists(self.path))
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(read_json(self.path), {"a": [2, 9.0, 1, 0, 7]})
+        self.assertEqual(BookmarkStore(self.path).get("a").elapsed, 9.0)
+
+    async def test_oldest_are_forgotten(self):
+        store = BookmarkStore(self.path, limit=2)
+        for key in ("a", "b", "a", "c"):
+            store.record(key, Bookmark(0, 0.0))
+        store.forget("missing")
+        store.flush()
+
+        self.assertEqual(list(read_json(self.path)), ["a", "c"])
+
+
+class TestResume(unittest.IsolatedAsyncioTestCase):
+    """
+    Play a library slice from where it was left
+    """
+
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fake = FakeMPD([make_track("book/{:02}.mp3".format(n), album="Book") for n in range(10)])
+        self.pool = MPDPool('127.0.0.1', await self.fake.start())
+        await self.pool.connect()
+        await self.pool.mirror.refresh(['stats', 'status'])
+        self.store = BookmarkStore(os.path.join(self.tmpdir.name, "bookmarks.json"))
+
+    async def asyncTearDown(self):
+        self.pool.disconnect()
+        await self.fake.stop()
+        self.tmpdir.cleanup()
+
+    async def test_resume(self):
+        book = SliceOpus("Book", self.pool, ['album', "Book"], self.store)
+        await self.pool.command_list(book.opus_play_commands())
+        self.assertIs(self.store.active, book)
+
+        book.shuffle = 1
+        await self.pool.command_list([('random', 1), ('seek', 6, 95.5)])
+        await self.pool.mirror.refresh(['status'])
+        await self.pool.command_list(book.opus_stop_commands())
+        self.assertIsNone(self.store.active)
+
+        # Playing the slice again picks up where it was, settings and all, in one command list
+        again = SliceOpus("Book", self.pool, ['album', "Book"], self.store)
+        commands = again.opus_play_commands()
+        self.assertEqual(commands[-3:], [('random', 1), ('repeat', 0), ('seek', 6, 95.5)])
+        await self.pool.command_list(commands)
+        self.assertEqual((self.fake.state, self.fake.pos, self.fake.random), ('play', 6, 1))
+        self.assertEqual(again.shuffle, 1)
+
+        # A changed database could mean a different queue, so we start again from the top
+        self.fake.update_database(self.fake.tracks)
+        await self.pool.mirror.refresh(['stats'])
+        self.assertEqual(again.opus_play_commands()[-1], ('play',))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,330 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from components.library import LibraryComponent
+from components import libraryindex
+from components.libraryindex import AlbumKey, LibraryIndex, Track
+from components.superfavorites import SuperFavoritesComponent
+from mpdpool import MPDPool
+from radiostate import RadioState
+from tests.fake_mpd import FakeMPD, make_track
+
+
+def library_tracks(*artists):
+    return [make_track("{}/{}/{}.flac".format(genre, artist, n), genre=genre, artist=artist,
+                       album="{} Album".format(artist), title="Song {}".format(n))
+            for genre, artist in artists for n in range(2)]
+
+
+def names(node):
+    return [child.menu_labels['name'] for child in node.children]
+
+
+class TestLibraryIndex(unittest.TestCase):
+    """
+    Work out the menus' view of the library from the tracks alone
+    """
+
+    def test_multiple_values(self):
+        index = LibraryIndex((), [Track({'file': "a.flac", 'genre': ["Jazz", "Rock"], 'artist': "Beta",
+                                         'album': "Two", 'duration': "12.5"}),
+                                  Track({'file': "b.flac", 'genre': "Jazz", 'artist': ["Beta", "Gamma"]})])
+
+        two = AlbumKey("Beta", "Two", "")
+        self.assertEqual(index.albums, {two})
+        self.assertEqual(index.artists, {"Beta": {two}, "Gamma": set()})
+        self.assertEqual(index.genres["Rock"], {'albums': {two}, 'artists': {"Beta": {two}}})
+        self.assertEqual(set(index.genres["Jazz"]['artists']), {"Beta", "Gamma"})
+        self.assertEqual(index.tracks[0].duration, 12.5)
+
+    def test_albums_and_sorting(self):
+        index = LibraryIndex((), [Track({'file': "a.flac", 'artist': "The Zombies", 'album': "Greatest Hits"}),
+                                  Track({'file': "b.flac", 'artist': "Abba", 'album': "Greatest Hits"}),
+                                  Track({'file': "c.flac", 'artist': "Abba", 'albumartist': "Various",
+                                         'album': "Greatest Hits", 'date': "1999"}),
+                                  Track({'file': "d.flac", 'artist': "élan", 'album': "an Album"})])
+
+        # Albums of the same name are told apart by their artist and date
+        self.assertEqual(sorted(index.albums, key=index.album_sort_key),
+                         [AlbumKey("élan", "an Album", ""), AlbumKey("Abba", "Greatest Hits", ""),
+                          AlbumKey("Various", "Greatest Hits", "1999"), AlbumKey("The Zombies", "Greatest Hits", "")])
+        self.assertEqual(index.sorted_albums(index.albums), sorted(index.albums, key=index.album_sort_key))
+        # Regardless of case, accents, and leading articles
+        self.assertEqual(sorted(index.artists, key=index.sort_key), ["Abba", "élan", "The Zombies"])
+        self.assertEqual([index.tracks[n].file for n in index.match_ids(['albumartist', "Abba"])], ["b.flac"])
+
+
+class TestIncrementalRefresh(unittest.IsolatedAsyncioTestCase):
+    """
+    Patch only the parts of the Library that a database change touches
+    """
+
+    async def asyncSetUp(self):
+        # The component keeps its favorites and index cache under saved/, relative to where we run
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        os.mkdir("saved")
+
+        self.fake = FakeMPD(library_tracks(("Rock", "Beta"), ("Rock", "Gamma"), ("Jazz", "Delta")),
+                            playlists={'mix': []})
+        port = await self.fake.start()
+        self.pool = MPDPool('127.0.0.1', port)
+        await self.pool.connect()
+        self.library = LibraryComponent(SuperFavoritesComponent(), self.pool)
+        self.changes = asyncio.Queue()
+        self.library.add_change_listener(self.changes.put_nowait)
+        await self.library.start()
+        self.mirror_task = asyncio.ensure_future(self.pool.mirror.run())
+        await asyncio.wait_for(self.changes.get(), 2)
+        await self.library.refresh_task
+
+    async def asyncTearDown(self):
+        self.mirror_task.cancel()
+        self.pool.disconnect()
+        await self.fake.stop()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    async def test_initial_tree(self):
+        self.assertEqual(names(self.library.playlists_node), ['mix'])
+        self.assertEqual(names(self.library.genres_node), ['Jazz', 'Rock'])
+        self.assertEqual(names(self.library.artists_node), ['Beta', 'Delta', 'Gamma'])
+        rock = self.library.genres_node.children[1]
+        self.assertEqual(names(rock.children[2]), ['Beta', 'Gamma'])
+
+    async def test_views_share_operai(self):
+        rock = self.library.genres_node.children[1]
+        beta = self.library.artists_node.children[0]
+        album = self.library.albums_node.children[0].children[0]
+
+        self.assertIs(rock.children[1].children[0].children[0], album)
+        self.assertIs(beta.children[1].children[0].children[0], album)
+        self.assertIs(rock.children[2].children[0].children[1].children[0].children[0], album)
+        # Favorites come back as the same opus the menus hold
+        self.assertIs(self.library.opus_from_metadata(album.opus_get_metadata()), album)
+        self.assertIs(self.library.slice_opus("All songs by Beta", ['genre', 'Rock', 'artist', 'Beta']),
+                      rock.children[2].children[0].children[0])
+
+    async def test_database_update_keeps_untouched_branches(self):
+        artists = self.library.artists_node
+        artists.index = 1
+        delta, gamma = artists.children[1], artists.children[2]
+        jazz, rock = self.library.genres_node.children
+        rock_gamma = rock.children[2].children[1]
+
+        self.fake.update_database(library_tracks(("Rock", "Alpha"), ("Rock", "Beta"), ("Rock", "Gamma"),
+                                                 ("Jazz", "Delta"), ("Jazz", "Gamma")))
+        await asyncio.wait_for(self.changes.get(), 2)
+
+        self.assertEqual(names(artists), ['Alpha', 'Beta', 'Delta', 'Gamma'])
+        # The cursor stays on the artist it was on
+        self.assertIs(artists.selected_node(), delta)
+        # Unchanged branches are the very same nodes
+        self.assertIs(artists.children[2], delta)
+        self.assertIs(self.library.genres_node.children[1], rock)
+        self.assertIs(rock.children[2].children[2], rock_gamma)
+        # Changed ones are patched in place
+        self.assertIs(self.library.genres_node.children[0], jazz)
+        self.assertIs(artists.children[3], gamma)
+        self.assertEqual(names(jazz.children[2]), ['Delta', 'Gamma'])
+
+    async def test_browsing_an_album_survives_a_refresh(self):
+        rs = RadioState()
+        rs.menu.tree.add_child(self.library)
+        by_album = self.library.genres_node.children[1].children[1]
+        album = by_album.children[0]
+        rs.menu.current_node = album
+
+        self.fake.update_database(self.fake.tracks + [make_track("Rock/Alpha/0.flac", genre="Rock", artist="Alpha",
+                                                                 album="Alpha Album")])
+        await asyncio.wait_for(self.changes.get(), 2)
+        rs.menu.resync()
+
+        # Still in the album, in the genre it was reached through
+        self.assertIs(rs.menu.current_node, album)
+        rs.menu_escape()
+        self.assertIs(rs.menu.current_node, by_album)
+        self.assertEqual(names(by_album), ['Alpha Album', 'Beta Album', 'Gamma Album'])
+
+    async def test_totals(self):
+        rock = self.library.genres_node.children[1]
+        gamma = self.library.artists_node.children[2]
+        album = gamma.children[1].children[0]
+        self.assertEqual(rock.menu_labels['comment'], "2 albums, 4 tracks, 12m")
+        self.assertEqual(rock.children[2].children[0].menu_labels['comment'], "1 album, 2 tracks, 6m")
+        self.assertEqual(album.menu_labels['comment'], "Gamma - 2 tracks, 6m")
+
+        # A new track on an album changes no menus, only the totals shown on them
+        self.fake.update_database(self.fake.tracks + [make_track("Rock/Gamma/2.flac", genre="Jazz", artist="Gamma",
+                                                                 album="Gamma Album", duration=3600.0)])
+        await asyncio.wait_for(self.changes.get(), 2)
+
+        self.assertIs(self.library.artists_node.children[2], gamma)
+        self.assertIs(gamma.children[1].children[0], album)
+        self.assertEqual(gamma.menu_labels['comment'], "1 album, 3 tracks, 1h 06m")
+        self.assertEqual(album.menu_labels['comment'], "Gamma - 3 tracks, 1h 06m")
+        self.assertEqual(rock.menu_labels['comment'], "2 albums, 4 tracks, 12m")
+        self.assertEqual(self.library.albums_node.children[2].menu_labels['comment'], "Gamma - 3 tracks, 1h 06m")
+
+    async def test_index_is_read_in_pages(self):
+        sent = len(self.fake.commands_seen)
+        with patch.object(libraryindex, 'PAGE_SIZE', 4):
+            index = await LibraryIndex.fetch(self.pool)
+
+        self.assertEqual(len(index.tracks), 6)
+        self.assertEqual(sorted(self.fake.commands_seen[sent:]), ['find', 'find', 'listplaylists', 'stats'])
+
+    async def test_pages_past_stale_stats(self):
+        self.fake.tracks.extend(library_tracks(("Jazz", "Epsilon"), ("Jazz", "Zeta")))
+        with patch.object(libraryindex, 'PAGE_SIZE', 4):
+            tracks = await LibraryIndex.fetch_tracks(self.pool, 6)
+
+        self.assertEqual(len({t.file for t in tracks}), 10)
+
+    async def test_index_reads_keep_within_the_limit(self):
+        in_flight = []
+        most = 0
+        run = self.pool.run
+
+        async def counted(*args):
+            nonlocal most
+            in_flight.append(args)
+            most = max(most, len(in_flight))
+            try:
+                return await run(*args)
+            finally:
+                in_flight.remove(args)
+
+        with patch.object(libraryindex, 'PAGE_SIZE', 2), patch.object(self.pool, 'run', counted):
+            index = await LibraryIndex.fetch(self.pool, 2)
+
+        self.assertEqual(len(index.tracks), 6)
+        self.assertEqual(most, 2)
+
+    def test_refresh_leaves_a_connection_free(self):
+        self.assertEqual(self.library.concurrency, len(self.pool.command_clients) - 1)
+        narrower = LibraryComponent(SuperFavoritesComponent(), MPDPool('127.0.0.1', 1, size=2), concurrency=2)
+        self.assertEqual(narrower.concurrency, 1)
+
+    async def test_refresh_reports_timings(self):
+        self.assertEqual(set(self.library.refresh_timings),
+                         {'playlists', 'tracks', 'patch_playlists', 'patch_genres', 'patch_artists',
+                          'patch_albums', 'smart', 'total'})
+
+    async def test_search(self):
+        await self.library.search_task
+        self.assertEqual(self.library.search("gamma song"), 2)
+        results = self.library.search_node.children
+        self.assertEqual(names(self.library.search_node), ['Song 0', 'Song 1'])
+        self.assertEqual(results[0].find_terms, ['file', "Rock/Gamma/0.flac"])
+        self.assertEqual(results[0].menu_labels['comment'], "Gamma - Gamma Album")
+
+        sent = len(self.fake.commands_seen)
+        await results[1]._send_commands([('findadd',) + tuple(results[1].find_terms)])
+        self.assertEqual(self.fake.commands_seen[sent:], ['findadd'])
+
+        self.assertEqual(self.library.search("nobody"), 0)
+
+        # Searches find what the database has now
+        self.fake.update_database(self.fake.tracks + [make_track("Pop/Nobody/0.flac", artist="Nobody")])
+        while len(self.library.library_index.tracks) != len(self.fake.tracks):
+            await asyncio.wait_for(self.changes.get(), 2)
+        # The new tracks are searched once their index is built in the background; until then, the last one answers
+        await self.library.search_task
+        self.assertEqual(self.library.search("nobody"), 1)
+        self.library.apply_index(LibraryIndex())
+        self.assertEqual(self.library.search("nobody"), 1)
+        await self.library.search_task
+        self.assertEqual(self.library.search("nobody"), 0)
+
+        # Before there's any index at all, searching isn't ready
+        self.assertIsNone(LibraryComponent(SuperFavoritesComponent(), self.pool).search("nobody"))
+
+    async def test_albums_play_just_that_album(self):
+        self.fake.update_database(self.fake.tracks + [make_track("Pop/Abba/hits.flac", artist="Abba",
+                                                                 album="Gamma Album")])
+        await asyncio.wait_for(self.changes.get(), 2)
+
+        self.assertEqual([(album.menu_labels['name'], album.menu_labels['comment'])
+                          for album in self.library.albums_node.children],
+                         [("Beta Album", "Beta - 2 tracks, 6m"), ("Delta Album", "Delta - 2 tracks, 6m"),
+                          ("Gamma Album", "Abba - 1 track, 3m"), ("Gamma Album", "Gamma - 2 tracks, 6m")])
+        album = self.library.albums_node.children[3].children[0]
+        await self.library.pool.command_list(album.opus_play_commands())
+        self.assertEqual([entry['track']['file'] for entry in self.fake.queue], ["Rock/Gamma/0.flac",
+                                                                                 "Rock/Gamma/1.flac"])
+
+    async def test_album_tracks(self):
+        tracks = [make_track("Pop/Eta/{}.flac".format(n), artist="Eta", album="Eta Album", title="Song {}".format(n),
+                             disc=disc, track=track)
+                  for n, (disc, track) in enumerate([("2", "1"), ("1", "10/12"), ("1", "2/12")])]
+        self.fake.update_database(self.fake.tracks + tracks)
+        await asyncio.wait_for(self.changes.get(), 2)
+
+        album = self.library.albums_node.children[2]
+        self.assertEqual(names(album), ["Eta Album"])
+        sent = len(self.fake.commands_seen)
+        album.menu_enter()
+        await album.listing
+        # One find for the album, in disc and track order
+        self.assertEqual(self.fake.commands_seen[sent:], ['find'])
+        self.assertEqual(names(album), ["Eta Album", "Song 2", "Song 1", "Song 0"])
+        self.assertEqual(album.children[2].menu_labels['shortname'], "10")
+
+        # The other views of the album don't ask again
+        other = self.library.artists_node.children[2].children[1].children[0]
+        self.assertIsNot(other, album)
+        other.menu_enter()
+        self.assertEqual(self.fake.commands_seen[sent:], ['find'])
+        self.assertEqual(names(other), names(album))
+        self.assertIs(other.children[0], album.children[0])
+
+        # A track plays the whole album from there, in one go
+        commands = album.children[2].opus_play_commands()
+        self.assertEqual(commands[-1], ('play', 1))
+        await self.library.pool.command_list(commands)
+        self.assertEqual(len(self.fake.queue), 3)
+        self.assertEqual(self.fake.pos, 1)
+        self.assertEqual(album.children[2].opus_get_metadata()['terms'], ['file', "Pop/Eta/1.flac"])
+
+    async def test_stored_playlist_change(self):
+        rock = self.library.genres_node.children[1]
+        self.fake.save_playlist('evening', [])
+        await asyncio.wait_for(self.changes.get(), 2)
+
+        self.assertEqual(names(self.library.playlists_node), ['evening', 'mix'])
+        self.assertIs(self.library.genres_node.children[1], rock)
+
+
+    async def test_cached_index_is_used_while_current(self):
+        self.assertTrue(os.path.exists(self.library.index_cache_file))
+
+        # A second run has its menus before it has even spoken to mpd
+        pool = MPDPool('127.0.0.1', self.fake.port)
+        library = LibraryComponent(SuperFavoritesComponent(), pool)
+        await library.start()
+        self.assertEqual(names(library.genres_node), ['Jazz', 'Rock'])
+
+        await pool.connect()
+        await pool.mirror.refresh(['stats'])
+        sent = len(self.fake.commands_seen)
+        library.library_changed(['database'])
+        await library.refresh_task
+        self.assertNotIn('find', self.fake.commands_seen[sent:])
+
+        self.fake.update_database(library_tracks(("Jazz", "Delta")))
+        await pool.mirror.refresh(['stats'])
+        library.library_changed(['database'])
+        await library.refresh_task
+        self.assertIn('find', self.fake.commands_seen[sent:])
+        self.assertEqual(names(library.genres_node), ['Jazz'])
+        await library.stop()
+        pool.disconnect()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+from components.library import SliceOpus
+from components.libraryfolders import FolderBrowser, FolderMenuList
+from mpdpool import MPDPool
+from tests.fake_mpd import FakeMPD, make_track
+
+
+def names(node):
+    return [child.menu_labels['name'] for child in node.children]
+
+
+class TestFolderBrowser(unittest.IsolatedAsyncioTestCase):
+    """
+    List folders as they're entered, a page at a time, and play them whole
+    """
+
+    async def asyncSetUp(self):
+        tracks = [make_track("live/1999/{:02}.flac".format(n)) for n in range(3)]
+        tracks += [make_track("live/2001/set.flac", title="The Set")]
+        tracks += [make_track("field/{:03}.wav".format(n)) for n in range(25)]
+        self.fake = FakeMPD(tracks)
+        self.pool = MPDPool('127.0.0.1', await self.fake.start())
+        await self.pool.connect()
+        self.browser = FolderBrowser(self.pool, lambda name, terms: SliceOpus(name, self.pool, terms), page=10)
+
+    async def asyncTearDown(self):
+        self.pool.disconnect()
+        await self.fake.stop()
+
+    async def enter(self, folder):
+        folder.menu_enter()
+        if folder.listing is not None:
+            await folder.listing
+        return folder
+
+    async def test_lazy_listing(self):
+        root = self.browser.root
+        self.assertEqual(root.children, [])
+        await self.enter(root)
+        self.assertEqual(names(root), ['live', 'field'])
+
+        live = await self.enter(root.children[0])
+        self.assertEqual(names(live), ['All of live', '1999', '2001'])
+        self.assertEqual(live.children[0].find_terms, ['base', 'live'])
+        year = await self.enter(live.children[2])
+        self.assertEqual(names(year)[1:], ['The Set'])
+
+        # Entering again doesn't ask mpd again
+        sent = len(self.fake.commands_seen)
+        await self.enter(live)
+        self.assertEqual(len(self.fake.commands_seen), sent)
+
+        # Until the database changes; the folders inside are kept, so no one is thrown out of them
+        self.browser.database_changed()
+        await self.enter(live)
+        self.assertEqual(self.fake.commands_seen[sent:], ['lsinfo'])
+        self.assertIs(live.children[2], year)
+
+    async def test_pages(self):
+        await self.enter(self.browser.root)
+        field = await self.enter(self.browser.root.children[1])
+
+        self.assertEqual(names(field), ['All of field', '000.wav - 009.wav', '010.wav - 019.wav',
+                                        '020.wav - 024.wav'])
+        self.assertEqual(len(field.children[3].children), 5)
+
+        # Playing the folder plays everything under it
+        await self.pool.command_list(field.children[0].opus_play_commands())
+        self.assertEqual(len(self.fake.queue), 25)
+
+    async def test_subfolders_survive_paging(self):
+        self.browser.page = 1
+        await self.enter(self.browser.root)
+        live = self.browser.root.children[0].children[0]
+        self.assertIsInstance(live, FolderMenuList)
+
+        self.browser.database_changed()
+        await self.enter(self.browser.root)
+        self.assertIs(self.browser.root.children[0].children[0], live)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import asyncio
+import unittest
+
+from components.libraryqueue import QueueView
+from mpdpool import MPDPool
+from tests.fake_mpd import FakeMPD, make_track
+
+
+def names(node):
+    return [child.menu_labels['name'] for child in node.children]
+
+
+class TestQueueView(unittest.IsolatedAsyncioTestCase):
+    """
+    Follow mpd's queue a few changes at a time, and show it around the track playing
+    """
+
+    async def asyncSetUp(self):
+        self.fake = FakeMPD([make_track("{:03}.mp3".format(n), title="Song {}".format(n)) for n in range(200)])
+        self.pool = MPDPool('127.0.0.1', await self.fake.start())
+        await self.pool.connect()
+        self.changes = asyncio.Queue()
+        self.view = QueueView(self.pool, on_change=lambda: self.changes.put_nowait(None), behind=2, ahead=3)
+        self.view.start()
+        self.mirror_task = asyncio.ensure_future(self.pool.mirror.run())
+
+    async def asyncTearDown(self):
+        self.mirror_task.cancel()
+        self.view.stop()
+        self.pool.disconnect()
+        await self.fake.stop()
+
+    async def caught_up(self):
+        while self.view.version != self.fake.queue_version or not self.view.refresh_task.done():
+            await asyncio.sleep(0.01)
+
+    async def showing(self, name):
+        while not self.view.children or names(self.view)[0] != name:
+            await self.changes.get()
+
+    async def test_window_follows_playback(self):
+        self.fake.enqueue(self.fake.tracks)
+        await self.pool.run('play', 10)
+        await asyncio.wait_for(self.showing("Song 8"), 2)
+        self.assertEqual(names(self.view), ["Song {}".format(n) for n in range(8, 14)])
+        self.assertEqual(self.view.children[2].menu_labels['shortname'], "11")
+        self.assertEqual(self.view.menu_labels['comment'], "Playing 11 of 200")
+
+        # Selecting an entry jumps to it
+        self.view.children[4].command_execute()
+        await asyncio.wait_for(self.showing("Song 10"), 2)
+        self.assertEqual(self.fake.pos, 12)
+
+    async def test_changes_are_read_incrementally(self):
+        self.fake.enqueue(self.fake.tracks)
+        await asyncio.wait_for(self.caught_up(), 2)
+        self.assertEqual(len(self.view.songs), 200)
+
+        sent = len(self.fake.commands_seen)
+        seen = self.fake.queue_version
+        await self.pool.run('delete', "195:198")
+        await asyncio.wait_for(self.caught_up(), 2)
+
+        self.assertEqual(self.fake.commands_seen[sent:].count('plchanges'), 1)
+        self.assertEqual(sum(1 for entry in self.fake.queue if entry['version'] > seen), 2)
+        self.assertEqual([song[1] for song in self.view.songs[-3:]], ["Song 194", "Song 198", "Song 199"])
+        self.assertEqual(len(self.view.songs), 197)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from components.libraryindex import Track
+from components.librarysearch import SearchIndex, fold
+
+
+def track(file, **tags):
+    tags['file'] = file
+    return Track(tags)
+
+
+class TestSearchIndex(unittest.TestCase):
+    """
+    Find tracks by the words in their tags, without asking mpd
+    """
+
+    def setUp(self):
+        self.index = SearchIndex([
+            track("a.flac", title="Jóga", artist="Björk", album="Homogenic", genre="Electronic"),
+            track("b.flac", title="Hunter", artist="Björk", album="Homogenic", genre="Electronic"),
+            track("c.flac", title="Bachelorette", artist=["Björk", "Guest"], album="Homogenic"),
+            track("d.flac", title="Goldberg Variations", artist="Glenn Gould", composer="Johann Sebastian Bach"),
+        ])
+
+    def files(self, query):
+        return [t.file for t in self.index.search(query)]
+
+    def test_accents_and_case_fold(self):
+        self.assertEqual(fold("BJÖRK Jóga"), "bjork joga")
+        self.assertEqual(self.files("joga"), ["a.flac"])
+        self.assertEqual(self.files("BJORK hunter"), ["b.flac"])
+
+    def test_every_word_matches_the_start_of_a_word(self):
+        self.assertEqual(self.files("homo hun"), ["b.flac"])
+        self.assertEqual(self.files("bjork gould"), [])
+        self.assertEqual(self.files("omogenic"), [])
+        self.assertEqual(self.files("  "), [])
+
+    def test_ranked_by_where_the_match_is(self):
+        # A title match beats a composer match, and a whole word beats the start of one
+        self.assertEqual(self.files("bach"), ["d.flac", "c.flac"])
+        self.assertEqual(self.files("bachelorette"), ["c.flac"])
+
+    def test_limit(self):
+        self.assertEqual(self.files("bjork"), ["a.flac", "b.flac", "c.flac"])
+        self.assertEqual(len(self.index.search("bjork", limit=2)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
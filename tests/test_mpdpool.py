@@ -0,0 +1,200 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from mpd.base import CommandError
+
+import mpdpool
+from mpdpool import MPDPool, MPDUnavailable
+from tests.fake_mpd import FakeMPD, make_track
+
+
+class TestCommandLists(unittest.IsolatedAsyncioTestCase):
+    """
+    Send command lists through the pool to a stand-in mpd
+    """
+
+    async def asyncSetUp(self):
+        self.fake = FakeMPD([make_track("a/1.flac", genre="Rock"),
+                             make_track("a/2.flac", genre="Rock"),
+                             make_track("b/1.flac", genre="Jazz")])
+        port = await self.fake.start()
+        self.pool = MPDPool('127.0.0.1', port)
+        await self.pool.connect()
+
+    async def asyncTearDown(self):
+        self.pool.disconnect()
+        await self.fake.stop()
+
+    async def test_command_list_runs_in_order(self):
+        results = await self.pool.command_list([('clear',),
+                                                ('findadd', 'genre', 'Rock'),
+                                                ('random', 0),
+                                                ('play',),
+                                                ('status',)])
+
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[4]['state'], 'play')
+        self.assertEqual(results[4]['playlistlength'], '2')
+        self.assertEqual(self.fake.state, 'play')
+
+    async def test_failing_command_abandons_the_list(self):
+        with self.assertRaises(CommandError):
+            await self.pool.command_list([('clear',), ('load', 'no such playlist'), ('play',)])
+
+        self.assertEqual(self.fake.state, 'stop')
+        # The connection is still usable afterwards
+        self.assertEqual((await self.pool.run('status'))['state'], 'stop')
+
+    async def test_health_report(self):
+        await self.pool.run('status')
+        with self.assertRaises(CommandError):
+            await self.pool.run('load', 'no such playlist')
+        health = self.pool.health()
+
+        self.assertTrue(health['up'])
+        self.assertTrue(health['idle_connected'])
+        self.assertEqual(health['command_connected'], health['command_connections'])
+        self.assertEqual(health['available'], health['command_connections'])
+        self.assertEqual((health['borrows'], health['errors'], health['reconnects']), (2, 1, 0))
+        self.assertIsNotNone(health['latency_ms'])
+        self.assertIsNotNone(health['last_latency_ms'])
+
+    async def test_borrow_times_out(self):
+        pool = MPDPool('127.0.0.1', self.fake.port, borrow_timeout=0.1)
+        await pool.connect()
+        held = asyncio.Event()
+        release = asyncio.Event()
+
+        async def hold():
+            async with pool.borrow():
+                held.set()
+                await release.wait()
+
+        holders = [asyncio.ensure_future(hold()) for _ in pool.command_clients]
+        await held.wait()
+        await asyncio.sleep(0)
+        self.assertEqual(pool.health()['available'], 0)
+
+        # Every connection is busy, so the command is refused rather than left waiting
+        with self.assertRaises(MPDUnavailable):
+            await pool.run('status')
+        self.assertEqual(pool.health()['errors'], 1)
+
+        release.set()
+        await asyncio.gather(*holders)
+        self.assertEqual((await pool.run('status'))['state'], 'stop')
+        pool.disconnect()
+
+
+
+class TestReconnect(unittest.IsolatedAsyncioTestCase):
+    """
+    Refuse commands while mpd is away, and get the connections back when it returns
+    """
+
+    async def asyncSetUp(self):
+        self.fake = FakeMPD([make_track("a/1.flac", genre="Rock")])
+        port = await self.fake.start()
+        self.pool = MPDPool('127.0.0.1', port)
+        self.changes = asyncio.Queue()
+        self.pool.add_connection_listener(self.changes.put_nowait)
+        await self.pool.connect()
+        self.supervisor = asyncio.ensure_future(self.pool.supervise())
+
+    async def asyncTearDown(self):
+        self.supervisor.cancel()
+        self.pool.disconnect()
+        await self.fake.stop()
+
+    async def test_reconnects_after_mpd_hangs_up(self):
+        self.assertTrue(await self.changes.get())
+
+        self.fake.drop_connections()
+        with self.assertRaises(Exception):
+            await self.pool.run('status')
+        self.assertFalse(await self.changes.get())
+
+        # The breaker is open: no waiting on a dead connection
+        with self.assertRaises(MPDUnavailable):
+            await self.pool.run('status')
+
+        self.assertTrue(await asyncio.wait_for(self.changes.get(), 5))
+        self.assertEqual((await self.pool.run('status'))['state'], 'stop')
+        self.assertEqual(self.pool.health()['reconnects'], 1)
+
+    async def test_backoff_grows_to_the_limit(self):
+        delays = []
+        sleep = asyncio.sleep
+
+        async def record(delay):
+            delays.append(delay)
+            if len(delays) == 9:
+                raise asyncio.CancelledError
+            await sleep(0)
+
+        self.assertTrue(await self.changes.get())
+        await self.fake.stop()
+        with patch.object(mpdpool.random, 'uniform', return_value=1), patch.object(mpdpool.asyncio, 'sleep', record):
+            self.pool.connection_lost(ConnectionError("gone"))
+            with self.assertRaises(asyncio.CancelledError):
+                await self.supervisor
+
+        self.assertEqual(delays, [0.5, 1, 2, 4, 8, 16, 30, 30, 30])
+        self.assertEqual(self.pool.health()['reconnects'], 0)
+
+    async def test_unreachable_mpd_at_startup(self):
+        pool = MPDPool('127.0.0.1', 1)
+        await pool.connect()
+
+        self.assertFalse(pool.health()['up'])
+        with self.assertRaises(MPDUnavailable):
+            await pool.run('status')
+
+
+class TestMirror(unittest.IsolatedAsyncioTestCase):
+    """
+    Keep the local mirror of mpd's state current from idle notifications
+    """
+
+    async def asyncSetUp(self):
+        self.fake = FakeMPD([make_track("a/1.flac", genre="Rock", title="One"),
+                             make_track("a/2.flac", genre="Rock", title="Two")])
+        port = await self.fake.start()
+        self.pool = MPDPool('127.0.0.1', port)
+        await self.pool.connect()
+        self.changes = asyncio.Queue()
+        self.pool.mirror.add_listener(self.changes.put_nowait)
+        self.mirror_task = asyncio.ensure_future(self.pool.mirror.run())
+        await asyncio.wait_for(self.changes.get(), 1)
+
+    async def asyncTearDown(self):
+        self.mirror_task.cancel()
+        self.pool.disconnect()
+        await self.fake.stop()
+
+    async def wait_for(self, subsystem):
+        while subsystem not in await asyncio.wait_for(self.changes.get(), 1):
+            pass
+
+    async def test_follows_the_player(self):
+        self.assertEqual(self.pool.mirror.state, 'stop')
+
+        await self.pool.command_list([('findadd', 'genre', 'Rock'), ('play',)])
+        await self.wait_for('player')
+
+        self.assertEqual(self.pool.mirror.state, 'play')
+        self.assertEqual(self.pool.mirror.currentsong['title'], 'One')
+        self.assertTrue(self.pool.mirror.has_next())
+
+    async def test_options_only_refresh_the_status(self):
+        sent = len(self.fake.commands_seen)
+        await self.pool.command_list([('repeat', 1)])
+        await self.wait_for('options')
+
+        self.assertEqual(self.pool.mirror.status['repeat'], '1')
+        self.assertNotIn('currentsong', self.fake.commands_seen[sent:])
+
+
+if __name__ == '__main__':
+    unittest.main()
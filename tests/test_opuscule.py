@@ -3,8 +3,21 @@ import sys
 import os
 sys.path.insert(0, os.path.abspath('..'))
 
-import opuscule
+import asyncio
+import json
+import socket
+import tempfile
 import unittest
+from configparser import ConfigParser
+from unittest.mock import patch
+
+import opuscule
+from base_classes import MenuComponent
+from bookmarks import Bookmark
+from components.libraryindex import LibraryIndex
+from mpdpool import MPDPool
+from persistence import read_json, write_json, write_pickle
+from tests.fake_mpd import FakeMPD, make_track
 
 
 class TestOpusculeController(unittest.TestCase):
@@ -19,5 +32,185 @@ class TestOpusculeController(unittest.TestCase):
         result = opuscule.handle(1, 2)
         self.assertEqual(result, 3)
 
+class TestRestoreState(unittest.IsolatedAsyncioTestCase):
+    """
+    Pick up where the last session left off, once the components have what they need to
+    """
+
+    async def asyncSetUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        os.mkdir("saved")
+
+        self.fake = FakeMPD([make_track("Rock/Beta/{}.flac".format(n), genre="Rock", artist="Beta",
+                                        album="Beta Album") for n in range(3)])
+        self.pool = MPDPool('127.0.0.1', await self.fake.start())
+        await self.pool.connect()
+        # The last session cached the Library's index, and was playing a shuffled slice from deep in its menus
+        write_pickle("saved/library_index.cache", (await LibraryIndex.fetch(self.pool)).to_cache())
+        write_json(opuscule.STATE_FILE, {'menu': [{'name': 'root', 'index': 1}, {'name': 'Library', 'index': 4},
+                                                  {'name': 'Artists', 'index': 0}, {'name': 'Beta', 'index': 0}],
+                                         'playstate': 'playing',
+                                         'opus': {'component': 'library', 'type': 'slice',
+                                                  'name': "All songs by Beta", 'terms': ['artist', 'Beta']},
+                                         'shuffle': 1, 'repeat': 0, 'volume': 40, 'muted': False})
+
+        self.op = opuscule.OpusculeController(ConfigParser(), self.pool)
+        self.op.components = [self.op.library]
+
+    async def asyncTearDown(self):
+        await self.op.library.stop()
+        self.op.rs.save_state()
+        self.pool.disconnect()
+        await self.fake.stop()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    async def test_restores_library_position_and_slice(self):
+        sent = len(self.fake.commands_seen)
+        await self.op.start_components()
+
+        menu = self.op.rs.menu
+        self.assertEqual(menu.current_node.menu_labels['name'], "Beta")
+        self.assertEqual(menu.current_node.parent.menu_labels['name'], "Artists")
+        opus = self.op.rs.now_playing.current_opus
+        self.assertIs(opus, self.op.library.artists_node.children[0].children[0])
+
+        while self.fake.state != 'play':
+            await asyncio.sleep(0.01)
+        # Played from the cached index, a window at a time, rather than searched for again
+        self.assertIsNotNone(opus.feeder)
+        self.assertNotIn('findadd', self.fake.commands_seen[sent:])
+        self.assertEqual(len(self.fake.queue), 3)
+
+    async def test_handoff_takes_over_what_mpd_kept_playing(self):
+        # The last server fed mpd part of the shuffled slice, and mpd carried on through the restart
+        await self.pool.command_list([('clear',), ('add', "Rock/Beta/2.flac"), ('add', "Rock/Beta/0.flac"),
+                                      ('play', 1)])
+        sent = len(self.fake.commands_seen)
+        self.op.handoff = True
+        await self.op.start_components()
+
+        opus = self.op.rs.now_playing.current_opus
+        self.assertEqual(self.op.rs.current_state, 'playing')
+        while len(self.fake.queue) != 3:
+            await asyncio.sleep(0.01)
+        # Nothing is started over: the track playing stays, and the rest of the slice is fed after it
+        self.assertNotIn('clear', self.fake.commands_seen[sent:])
+        self.assertEqual((self.fake.pos, self.fake.queue[0]['track']['file']), (0, "Rock/Beta/0.flac"))
+        self.assertEqual(self.fake.state, 'play')
+        self.assertEqual(opus.queue_track(0), 0)
+
+
+class TestStartUp(unittest.IsolatedAsyncioTestCase):
+    """
+    Start the components without waiting on mpd
+    """
+
+    async def asyncSetUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        os.mkdir("saved")
+
+    async def asyncTearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    async def test_components_start_while_mpd_connects(self):
+        started = asyncio.Event()
+        reachable = asyncio.Event()
+
+        class Clock(MenuComponent):
+            def requirements_met(self):
+                return True
+
+            async def start(self):
+                started.set()
+
+        pool = MPDPool('127.0.0.1', 1)
+        op = opuscule.OpusculeController(ConfigParser(), pool)
+        op.components = [Clock("Clock", "", "")]
+        restored = []
+        op.restore_state = lambda: restored.append(reachable.is_set())
+
+        async def connect():
+            await reachable.wait()
+
+        with patch.object(opuscule, 'mpd_pool', pool, create=True), patch.object(opuscule, 'op', op, create=True), \
+                patch.object(pool, 'connect', connect):
+            start_up = asyncio.ensure_future(opuscule._start_up(handoff=False))
+            await asyncio.wait_for(started.wait(), 1)
+            # The state waits for mpd, though
+            self.assertEqual(restored, [])
+            reachable.set()
+            await asyncio.wait_for(start_up, 1)
+
+        self.assertEqual(restored, [True])
+
+
+class TestRestart(unittest.IsolatedAsyncioTestCase):
+    """
+    Hand over to a new server process without dropping anyone
+    """
+
+    async def asyncSetUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        os.mkdir("saved")
+        self.op = opuscule.OpusculeController(ConfigParser(), MPDPool('127.0.0.1', 1))
+
+    async def asyncTearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def test_reexec_argv(self):
+        for args in (['opuscule.py', '--port', '7400'],
+                     ['opuscule.py', '--listen-fds', '3,4', '--port', '7400'],
+                     ['opuscule.py', '--port', '7400', '--listen-fds=3']):
+            self.assertEqual(opuscule.reexec_argv(args, ['5', '6']),
+                             [sys.executable, os.path.abspath('opuscule.py'), '--port', '7400', '--listen-fds', '5,6'])
+
+    async def test_restart(self):
+        clients = []
+
+        class Client(asyncio.Protocol):
+            def connection_made(self, transport):
+                self.transport = transport
+                clients.append(self)
+
+        self.op.registered_components.append(self.op.library)
+        self.op.library.bookmarks.record('slice:test', Bookmark(3, 12.5, version="1"))
+        self.op.library.history.record("Rock/Beta/0.flac", 1700000000)
+
+        server = await asyncio.get_running_loop().create_server(Client, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        while not clients:
+            await asyncio.sleep(0.01)
+
+        with patch.object(opuscule, '_reexec_server') as reexec, patch.object(opuscule, 'RESTART_DRAIN_TIME', 0):
+            await opuscule._restart(self.op, [server], clients)
+            await asyncio.sleep(0.05)
+
+        # Connected clients are told to come back shortly
+        self.assertEqual(json.loads(await reader.read()), {'response': "RECONNECT", 'delay': opuscule.RECONNECT_DELAY})
+        writer.close()
+        self.assertTrue(os.path.exists(opuscule.STATE_FILE))
+        # Along with the bookmarks, which would otherwise have waited to be written
+        self.assertEqual(read_json("saved/library_bookmarks.json"), {'slice:test': [3, 12.5, 0, 0, "1"]})
+        self.assertEqual(read_json("saved/library_history.json"), {"Rock/Beta/0.flac": [1, 1700000000]})
+
+        # We've stopped accepting, but the socket handed on still listens, queueing clients for the new process
+        self.assertFalse(server.is_serving())
+        (fd,), = reexec.call_args.args
+        self.assertTrue(os.get_inheritable(int(fd)))
+        with socket.create_connection(('127.0.0.1', port), timeout=1):
+            pass
+        os.close(int(fd))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
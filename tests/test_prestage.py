@@ -0,0 +1,128 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from base_classes import Opus
+from components.library import SliceOpus
+from components.streaming import read_stream_playlist
+from mpdpool import MPDPool
+from prestage import Prestager
+from tests.fake_mpd import FakeMPD, make_track
+
+
+class PreparingOpus(Opus):
+    def __init__(self, name, delay=0.0):
+        super().__init__(name, "", "")
+        self.delay = delay
+        self.started = self.finished = self.unprepared = 0
+
+    async def opus_prepare(self):
+        self.started += 1
+        await asyncio.sleep(self.delay)
+        self.finished += 1
+
+    def opus_unprepare(self):
+        self.unprepared += 1
+
+
+class TestPrestager(unittest.IsolatedAsyncioTestCase):
+    """
+    Prepare the opus the cursor rests on, and nothing it merely passes over
+    """
+
+    async def test_dwell(self):
+        prestager = Prestager(dwell=0.05)
+        operai = [PreparingOpus(str(n)) for n in range(5)]
+        for opus in operai:
+            prestager.rest_on(opus)
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+
+        self.assertEqual([opus.started for opus in operai], [0, 0, 0, 0, 1])
+        self.assertEqual(list(prestager.prepared), [operai[4]])
+
+    async def test_moving_on_cancels(self):
+        prestager = Prestager(dwell=0.01)
+        slow, other = PreparingOpus("slow", delay=1), PreparingOpus("other")
+        prestager.rest_on(slow)
+        await asyncio.sleep(0.05)
+        prestager.rest_on(other)
+        await asyncio.sleep(0.05)
+
+        self.assertEqual((slow.started, slow.finished), (1, 0))
+        self.assertEqual(list(prestager.prepared), [other])
+
+    async def test_bounded(self):
+        prestager = Prestager(dwell=0.0, timeout=0.05, keep=2)
+        stuck = PreparingOpus("stuck", delay=1)
+        prestager.rest_on(stuck)
+        await asyncio.sleep(0.1)
+        self.assertIsNone(prestager.task)
+        self.assertEqual(stuck.finished, 0)
+
+        operai = [PreparingOpus(str(n)) for n in range(3)]
+        for opus in operai:
+            prestager.rest_on(opus)
+            await asyncio.sleep(0.01)
+        self.assertEqual(list(prestager.prepared), operai[1:])
+        self.assertEqual([opus.unprepared for opus in operai], [1, 0, 0])
+
+
+class TestSliceStaging(unittest.IsolatedAsyncioTestCase):
+    """
+    A prepared library slice plays its files without asking mpd to search for them
+    """
+
+    async def asyncSetUp(self):
+        self.fake = FakeMPD([make_track("a/{}.flac".format(n), album="A") for n in range(3)] +
+                            [make_track("b/{}.flac".format(n), album="B") for n in range(600)])
+        self.pool = MPDPool('127.0.0.1', await self.fake.start())
+        await self.pool.connect()
+        await self.pool.mirror.refresh(['stats'])
+
+    async def asyncTearDown(self):
+        self.pool.disconnect()
+        await self.fake.stop()
+
+    async def test_staged_files(self):
+        album = SliceOpus("A", self.pool, ['album', "A"])
+        self.assertIn(('findadd', 'album', "A"), album.opus_play_commands())
+
+        await album.opus_prepare()
+        commands = album.opus_play_commands()
+        self.assertEqual(commands[:4], [('clear',), ('add', "a/0.flac"), ('add', "a/1.flac"), ('add', "a/2.flac")])
+
+        # Once the database moves on, what we found may be out of date
+        self.fake.update_database(self.fake.tracks[:2])
+        await self.pool.mirror.refresh(['stats'])
+        self.assertIn(('findadd', 'album', "A"), album.opus_play_commands())
+
+    async def test_big_slices_are_left_to_mpd(self):
+        album = SliceOpus("B", self.pool, ['album', "B"])
+        await album.opus_prepare()
+        self.assertIsNone(album.staged_files)
+
+
+class TestStreamPlaylists(unittest.TestCase):
+    """
+    Find the stream in a station's playlist
+    """
+
+    def test_pls_and_m3u(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, text in (("a.pls", "[playlist]\nNumberOfEntries=1\nFile1=http://example.com:8000/live\n"),
+                               ("b.m3u", "#EXTM3U\n#EXTINF:-1,Station\nhttp://example.com/stream.mp3\n"),
+                               ("c.m3u", "#EXTM3U\n")):
+                with open(os.path.join(tmpdir, name), "w") as the_file:
+                    the_file.write(text)
+
+            self.assertEqual(read_stream_playlist("file://" + os.path.join(tmpdir, "a.pls")),
+                             "http://example.com:8000/live")
+            self.assertEqual(read_stream_playlist("file://" + os.path.join(tmpdir, "b.m3u")),
+                             "http://example.com/stream.mp3")
+            self.assertIsNone(read_stream_playlist("file://" + os.path.join(tmpdir, "c.m3u")))
+
+
+if __name__ == '__main__':
+    unittest.main()
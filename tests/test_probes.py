@@ -0,0 +1,87 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from persistence import read_json
+from probes import BinaryProbe, Probe, Prober, TCPProbe, USBDeviceProbe
+
+
+class SlowProbe(Probe):
+    def __init__(self, key, result, delay=0.2):
+        super().__init__(key)
+        self.result = result
+        self.delay = delay
+        self.runs = 0
+
+    async def check(self):
+        self.runs += 1
+        await asyncio.sleep(self.delay)
+        return self.result
+
+
+class TestProber(unittest.IsolatedAsyncioTestCase):
+    """
+    Check requirements concurrently, and remember the answers between boots
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmpdir.name, "probes.json")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    async def test_probes_run_at_once(self):
+        probes = [SlowProbe("a", True), SlowProbe("b", False), SlowProbe("c", True)]
+
+        start = time.monotonic()
+        results = await Prober(self.cache_file).check(probes)
+
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(results, {"a": True, "b": False, "c": True})
+
+    async def test_cached_results_are_used_until_verified(self):
+        await Prober(self.cache_file).verify([SlowProbe("a", True)])
+        self.assertEqual(read_json(self.cache_file), {"a": True})
+
+        probe = SlowProbe("a", False)
+        prober = Prober(self.cache_file)
+        self.assertEqual(await prober.check([probe]), {"a": True})
+        self.assertEqual(probe.runs, 0)
+
+        self.assertEqual(await prober.verify([probe]), {"a"})
+        self.assertEqual(read_json(self.cache_file), {"a": False})
+
+    async def test_slow_and_broken_probes_fail(self):
+        class BrokenProbe(Probe):
+            async def check(self):
+                raise OSError("no")
+
+        results = await Prober(self.cache_file, timeout=0.1).check([SlowProbe("slow", True, delay=1),
+                                                                    BrokenProbe("broken")])
+        self.assertEqual(results, {"slow": False, "broken": False})
+
+    async def test_system_probes(self):
+        devices = os.path.join(self.tmpdir.name, "usb")
+        os.makedirs(os.path.join(devices, "1-1"))
+        for name, value in (("idVendor", "0bda\n"), ("idProduct", "2838\n")):
+            with open(os.path.join(devices, "1-1", name), "w") as the_file:
+                the_file.write(value)
+
+        server = await asyncio.start_server(lambda r, w: w.close(), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        results = await Prober(self.cache_file).check([USBDeviceProbe("0bda", "2838", devices),
+                                                       USBDeviceProbe("0bda", "2832", devices),
+                                                       BinaryProbe("python3"),
+                                                       BinaryProbe("no-such-program-here"),
+                                                       TCPProbe('127.0.0.1', port)])
+        server.close()
+
+        self.assertEqual(list(results.values()), [True, False, True, False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+from array import array
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from components import library
+from components.libraryindex import LibraryIndex, Track
+from components.library import SliceOpus
+from components.queuefeeder import QueueFeeder, QUEUE_BEHIND
+from mpdpool import MPDPool
+from tests.fake_mpd import FakeMPD, make_track
+
+
+def added(commands):
+    return [args[0] for command, *args in commands if command == 'add']
+
+
+class TestQueueFeeder(unittest.TestCase):
+    """
+    Keep a window of a long list of files in mpd's queue
+    """
+
+    def setUp(self):
+        self.files = ["{:03}.flac".format(n) for n in range(100)]
+        # The slice is every other track in the index
+        self.tracks = [Track({'file': "other.flac"}) if n % 2 else Track({'file': self.files[n // 2]})
+                       for n in range(200)]
+        self.ids = array('I', range(0, 200, 2))
+
+    def feeder(self, **kwargs):
+        return QueueFeeder(self.tracks, self.ids, **kwargs)
+
+    def test_window_moves_along(self):
+        feeder = self.feeder(start=5, window=10, low_water=5)
+        self.assertEqual(added(feeder.start_commands()), self.files[5:15])
+        self.assertEqual(feeder.top_up_commands(4), [])
+
+        # Running low ahead: top up, and trim what's well behind us
+        commands = feeder.top_up_commands(9)
+        self.assertEqual(added(commands), self.files[15:25])
+        self.assertEqual(feeder.index_at(9), 14)
+        feeder.top_up_commands(19)
+
+        commands = feeder.top_up_commands(2 * QUEUE_BEHIND + 5)
+        self.assertEqual(commands[0], ('delete', "0:{}".format(QUEUE_BEHIND + 5)))
+        self.assertEqual(feeder.index_at(QUEUE_BEHIND), 5 + 2 * QUEUE_BEHIND + 5)
+
+    def test_end_of_the_slice(self):
+        feeder = self.feeder(start=95, window=10)
+        self.assertEqual(added(feeder.start_commands()), self.files[95:])
+
+        feeder = self.feeder(start=95, repeat=1, window=10)
+        self.assertEqual(added(feeder.start_commands()), self.files[95:] + self.files[:5])
+
+    def test_shuffle_plays_everything_once_per_pass(self):
+        feeder = self.feeder(start=42, shuffle=1, repeat=1, window=250)
+        files = added(feeder.start_commands())
+        self.assertEqual(files[0], "042.flac")
+        self.assertEqual(sorted(files[:100]), self.files)
+        self.assertEqual(sorted(files[100:200]), self.files)
+        self.assertNotEqual(files[100:200], files[:100])
+
+    def test_switching_shuffle_refills_ahead(self):
+        feeder = self.feeder(window=10)
+        feeder.start_commands()
+        commands = feeder.reorder_commands(3, 1)
+        self.assertEqual(commands[0], ('delete', "4:10"))
+        self.assertEqual(len(added(commands)), 10)
+        self.assertNotIn("003.flac", added(commands))
+
+        commands = feeder.reorder_commands(3, 0)
+        self.assertEqual(added(commands), self.files[4:14])
+
+    def test_taking_over_a_queue(self):
+        feeder = self.feeder(window=10)
+        position = feeder.position_of("030.flac")
+        commands = feeder.take_over_commands(5, 12, position)
+
+        self.assertEqual(commands[:2], [('delete', "6:12"), ('delete', "0:5")])
+        self.assertEqual(added(commands), self.files[31:40])
+        self.assertEqual(feeder.index_at(0), 30)
+        self.assertIsNone(feeder.position_of("other.flac"))
+
+
+class TestWindowedSlice(unittest.IsolatedAsyncioTestCase):
+    """
+    Play a huge slice without handing mpd all of it
+    """
+
+    async def asyncSetUp(self):
+        tracks = [make_track("rock/{:03}.flac".format(n), genre="Rock") for n in range(300)]
+        self.fake = FakeMPD(tracks)
+        self.pool = MPDPool('127.0.0.1', await self.fake.start())
+        await self.pool.connect()
+        await self.pool.mirror.refresh(['stats'])
+        self.index = LibraryIndex((), [Track(t) for t in tracks], self.pool.mirror.stats['db_update'])
+
+    async def asyncTearDown(self):
+        self.pool.disconnect()
+        await self.fake.stop()
+
+    async def test_windowed_play(self):
+        rock = SliceOpus("Rock", self.pool, ['genre', "Rock"],
+                         resolve=lambda terms: (self.index.tracks, self.index.match_ids(terms)))
+        with patch.object(library, 'WINDOWED_THRESHOLD', 100):
+            await self.pool.command_list(rock.opus_play_commands())
+        self.assertEqual(len(self.fake.queue), 50)
+        self.assertEqual((self.fake.state, self.fake.random, self.fake.repeat), ('play', 0, 0))
+
+        await self.pool.command_list([('play', 40)])
+        # As the mirror would on the player event
+        await self.pool.mirror.refresh(['status'])
+        await rock.refeed(rock.feeder, rock.feeder.top_up_commands)
+        self.assertEqual(self.fake.queue[self.fake.pos]['track']['file'], "rock/040.flac")
+        self.assertEqual(self.fake.pos, QUEUE_BEHIND)
+        self.assertEqual(len(self.fake.queue), QUEUE_BEHIND + 1 + 50)
+
+        # Another event straight after finds the queue in line from the mirror, without asking mpd
+        sent = len(self.fake.commands_seen)
+        await rock.refeed(rock.feeder, rock.feeder.top_up_commands)
+        self.assertEqual(self.fake.commands_seen[sent:], [])
+        self.assertEqual(len(self.fake.queue), QUEUE_BEHIND + 1 + 50)
+
+        # Small slices played in order still go to mpd whole; shuffled, we do the shuffling
+        with patch.object(library, 'WINDOWED_THRESHOLD', 1000):
+            commands = rock.opus_play_commands()
+            self.assertIsNone(rock.feeder)
+            self.assertIn(('findadd', 'genre', "Rock"), commands)
+
+            rock.shuffle = 1
+            rock.opus_update_shuffle()
+            await asyncio.sleep(0.1)
+            self.assertIsNotNone(rock.feeder)
+
+    async def test_adopted_after_a_restart(self):
+        def slice_opus():
+            return SliceOpus("Rock", self.pool, ['genre', "Rock"],
+                             resolve=lambda terms: (self.index.tracks, self.index.match_ids(terms)))
+
+        with patch.object(library, 'WINDOWED_THRESHOLD', 100):
+            await self.pool.command_list(slice_opus().opus_play_commands())
+            await self.pool.command_list([('play', 30)])
+
+            # The new server carries on feeding from the track mpd kept playing
+            rock = slice_opus()
+            rock.opus_adopt()
+            await asyncio.sleep(0.1)
+
+        self.assertEqual(self.fake.queue[self.fake.pos]['track']['file'], "rock/030.flac")
+        self.assertEqual(self.fake.pos, 0)
+        self.assertEqual(len(self.fake.queue), 50)
+        self.assertEqual(rock.queue_track(1), 31)
+        self.assertEqual(self.fake.state, 'play')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import tempfile
+import unittest
+
+from base_classes import MenuList, Opus
+from radiostate import NowPlaying, RadioState
+from persistence import write_json
+
+
+class SavedOpus(Opus):
+    def __init__(self, name):
+        super().__init__(name, "", "")
+        self.component = "testing"
+        self.repeat_support = True
+        self.played = False
+        self.adopted = False
+
+    def opus_play(self):
+        self.played = True
+
+    def opus_adopt(self):
+        self.adopted = True
+
+    def opus_get_metadata(self):
+        return {'component': self.component, 'name': self.menu_labels['name']}
+
+
+class TestRadioStateSnapshot(unittest.TestCase):
+    """
+    Save the radio state and bring it back in a fresh session
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmpdir.name, "radio_state.json")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def build_menu(rs):
+        outer = MenuList("Outer", "", "")
+        inner = MenuList("Inner", "", "")
+        rs.menu.tree.add_child(MenuList("First", "", ""))
+        rs.menu.tree.add_child(outer)
+        outer.add_child(inner)
+        for name in ("One", "Two", "Three"):
+            inner.add_child(SavedOpus(name))
+        return inner
+
+    def test_round_trip(self):
+        rs = RadioState(self.state_file)
+        inner = self.build_menu(rs)
+        rs.menu.tree.index = 1
+        rs.menu.current_node = inner
+        inner.index = 2
+        rs.menu.selected_node = inner.children[2]
+        rs.volume.set_level(35)
+        rs.update('play')
+        rs.toggle_repeat()
+        write_json(self.state_file, rs.compose_snapshot())
+
+        restored = RadioState(self.state_file)
+        self.build_menu(restored)
+        restored.restore_state(lambda md: SavedOpus(md['name']))
+
+        self.assertEqual(restored.menu.current_node.menu_labels['name'], "Inner")
+        self.assertEqual(restored.menu.selected_node.menu_labels['name'], "Three")
+        self.assertEqual(restored.volume.get_level(), 35)
+        self.assertEqual(restored.current_state, 'playing')
+        self.assertTrue(restored.now_playing.current_opus.played)
+        self.assertEqual(restored.now_playing.current_opus.repeat, 1)
+
+    def test_handoff_adopts_what_kept_playing(self):
+        write_json(self.state_file, {'menu': [], 'playstate': 'playing', 'opus': {'name': "One"}})
+        opus = SavedOpus("One")
+        opus.survives_restart = True
+        rs = RadioState(self.state_file)
+        rs.restore_state(lambda md: opus, handoff=True)
+
+        self.assertEqual(rs.current_state, 'playing')
+        self.assertTrue(opus.adopted)
+        self.assertFalse(opus.played)
+
+    def test_missing_branch_stops_at_deepest_node(self):
+        write_json(self.state_file, {'menu': [{'name': 'root', 'index': 1},
+                                              {'name': 'Outer', 'index': 0},
+                                              {'name': 'Gone', 'index': 4}],
+                                     'playstate': 'stopped',
+                                     'opus': {}})
+        rs = RadioState(self.state_file)
+        self.build_menu(rs)
+        rs.restore_state(lambda md: None)
+
+        self.assertEqual(rs.menu.current_node.menu_labels['name'], "Outer")
+        self.assertEqual(rs.current_state, 'stopped')
+
+    def test_resync_backs_out_of_a_removed_branch(self):
+        rs = RadioState()
+        inner = self.build_menu(rs)
+        outer = inner.parent
+        rs.menu.current_node = inner
+        outer.replace_children([])
+
+        rs.menu.resync()
+
+        self.assertIs(rs.menu.current_node, outer)
+        self.assertIsNone(rs.menu.selected_node)
+
+
+
+class TestProgress(unittest.TestCase):
+    """
+    Only send progress corrections when playback stops following the clock
+    """
+
+    def setUp(self):
+        self.now_playing = NowPlaying()
+        self.now_playing.update_progress({'state': 'play', 'songid': '1', 'elapsed': '10.0', 'duration': '200.0'},
+                                         100.0)
+
+    def test_steady_playback_needs_no_correction(self):
+        self.assertFalse(self.now_playing.update_progress({'state': 'play', 'songid': '1', 'elapsed': '15.2'},
+                                                          105.0))
+        self.assertAlmostEqual(self.now_playing.expected_elapsed(106.0), 16.2)
+
+    def test_seek_pause_and_track_change_are_corrections(self):
+        self.assertTrue(self.now_playing.update_progress({'state': 'play', 'songid': '1', 'elapsed': '90.0'},
+                                                         101.0))
+        self.assertTrue(self.now_playing.update_progress({'state': 'pause', 'songid': '1', 'elapsed': '91.0'},
+                                                         102.0))
+        self.assertEqual(self.now_playing.expected_elapsed(500.0), 91.0)
+        self.assertTrue(self.now_playing.update_progress({'state': 'pause', 'songid': '2', 'elapsed': '91.0'},
+                                                         103.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from components.sdr import FmOpus, FmRadioComponent
+from components.superfavorites import SuperFavoritesComponent
+from persistence import write_json
+from radiostate import RadioState
+
+
+class TestFmState(unittest.TestCase):
+    """
+    Bring back the FM station that was playing
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmpdir.name, "radio_state.json")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_metadata_round_trip(self):
+        fm = FmRadioComponent(SuperFavoritesComponent())
+        station = FmOpus("WESA", "NPR Radio", "90.5")
+
+        rebuilt = fm.opus_from_metadata(station.opus_get_metadata())
+        self.assertEqual((rebuilt.menu_labels['name'], rebuilt.menu_labels['comment'], rebuilt.freq),
+                         ("WESA", "NPR Radio", "90.5"))
+
+    def test_playing_station_is_restored(self):
+        fm = FmRadioComponent(SuperFavoritesComponent())
+        rs = RadioState(self.state_file)
+        rs.now_playing.load(FmOpus("WESA", "NPR Radio", "90.5"))
+        rs.current_state = 'playing'
+        write_json(self.state_file, rs.compose_snapshot())
+
+        restored = RadioState(self.state_file)
+        with patch.object(FmOpus, 'opus_play') as play:
+            restored.restore_state(fm.opus_from_metadata)
+
+        self.assertEqual(restored.now_playing.current_opus.freq, "90.5")
+        self.assertEqual(restored.current_state, 'playing')
+        play.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
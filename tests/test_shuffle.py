@@ -0,0 +1,40 @@
+import time
+import unittest
+
+from components.shuffle import Permutation, shuffled
+
+
+class TestShuffle(unittest.TestCase):
+    """
+    Shuffle big slices lazily, without playing the same artist twice running
+    """
+
+    def test_permutations(self):
+        for count in (1, 2, 3, 7, 64, 1000, 1025):
+            order = Permutation(count, seed=count)
+            self.assertEqual(sorted(order[n] for n in range(count)), list(range(count)))
+
+        self.assertEqual([Permutation(100, 5)[n] for n in range(100)], [Permutation(100, 5)[n] for n in range(100)])
+        self.assertNotEqual([Permutation(100, 5)[n] for n in range(100)], [Permutation(100, 6)[n] for n in range(100)])
+
+    def test_artists_are_spread_out(self):
+        # A hundred artists, a few with many more tracks than the rest, as in most libraries
+        artists = ["artist {}".format(n % 7 if n % 3 else n % 100) for n in range(2000)]
+        order = list(shuffled(2000, lambda n: (artists[n], artists[n]), first=7, seed=1))
+
+        self.assertEqual(order[0], 7)
+        self.assertEqual(sorted(order), list(range(2000)))
+        runs = sum(artists[a] == artists[b] for a, b in zip(order, order[1:]))
+        # A plain shuffle would play the same artist twice running more than a hundred times
+        self.assertLess(runs, 10)
+
+    def test_lazy(self):
+        start = time.perf_counter()
+        upcoming = shuffled(10 ** 7, lambda n: (n % 100, n % 1000))
+        first = [next(upcoming) for _ in range(100)]
+        self.assertLess(time.perf_counter() - start, 0.1)
+        self.assertEqual(len(set(first)), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from components.library import LibraryComponent
+from components.libraryindex import LibraryIndex, Track
+from components.playhistory import PlayHistory
+from components.smartplaylists import Rule, RuleError, SmartPlaylist, SmartPlaylists, load_playlists, DAY
+from components.superfavorites import SuperFavoritesComponent
+from mpdpool import MPDPool
+from tests.fake_mpd import FakeMPD, make_track
+
+NOW = 1700000000
+
+
+def track(file, **tags):
+    return Track(dict(file=file, **tags))
+
+
+class TestRules(unittest.IsolatedAsyncioTestCase):
+    """
+    Read rules, and test tracks against them
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.history = PlayHistory(os.path.join(self.tmpdir.name, "history.json"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def matching(self, text, tracks):
+        rule = Rule(text)
+        return [t.file for t in tracks if rule.matches(t, self.history, NOW)]
+
+    def test_comparisons(self):
+        tracks = [track("a", genre="Jazz", date="1964-03-01", artist="Miles Davis"),
+                  track("b", genre=["Rock", "jazz"], date="1971"),
+                  track("c", genre="Rock and Roll", artist="Élan")]
+
+        self.assertEqual(self.matching("genre is Jazz and date < 1965", tracks), ["a"])
+        self.assertEqual(self.matching("genre is jazz", tracks), ["a", "b"])
+        self.assertEqual(self.matching('genre is "Rock and Roll" or artist contains davis', tracks), ["a", "c"])
+        self.assertEqual(self.matching("artist is elan", tracks), ["c"])
+        self.assertEqual(self.matching("not (genre is Jazz or date >= 1971)", tracks), ["c"])
+        self.assertEqual(self.matching("genre is not Rock", tracks), ["a", "c"])
+
+    def test_history_and_clock(self):
+        tracks = [track("old", **{'last-modified': "2020-01-01T00:00:00Z"}),
+                  track("new", **{'last-modified': "2023-11-10T00:00:00Z"})]
+        self.history.record("old", NOW - 2 * DAY)
+        self.history.record("old", NOW - 2 * DAY)
+
+        self.assertEqual(self.matching("recently added", tracks), ["new"])
+        self.assertEqual(self.matching("never played", tracks), ["new"])
+        self.assertEqual(self.matching("played within 3 days", tracks), ["old"])
+        self.assertEqual(self.matching("plays >= 2", tracks), ["old"])
+        self.assertEqual(Rule("never played or added within 1 day").uses, {'history', 'clock'})
+
+    def test_bad_rules(self):
+        for text in ("", "genre is", "mood is happy", "genre is Jazz and", "(genre is Jazz", "added within a week"):
+            with self.assertRaises(RuleError, msg=text):
+                Rule(text)
+
+    def test_load(self):
+        path = os.path.join(self.tmpdir.name, "smart.ini")
+        with open(path, 'w') as the_file:
+            the_file.write("[Early Jazz]\nrule = genre is Jazz and date < 1965\n[Broken]\nrule = mood is happy\n"
+                           "[Unheard]\nrule = never played\n")
+        self.assertEqual([playlist.name for playlist in load_playlists(path)], ["Early Jazz", "Unheard"])
+        self.assertEqual(load_playlists(os.path.join(self.tmpdir.name, "missing.ini")), [])
+
+
+class TestIncremental(unittest.IsolatedAsyncioTestCase):
+    """
+    Test only what changed again when the index or history does
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.history = PlayHistory(os.path.join(self.tmpdir.name, "history.json"))
+        self.jazz = SmartPlaylist("Jazz", Rule("genre is Jazz"))
+        self.unheard = SmartPlaylist("Unheard", Rule("never played"))
+        self.smart = SmartPlaylists([self.jazz, self.unheard], self.history)
+        self.tracks = [track("{}.flac".format(n), genre="Jazz" if n % 2 else "Rock", duration="60") for n in range(6)]
+        self.smart.index_changed(LibraryIndex((), self.tracks), NOW)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_database_change(self):
+        self.assertEqual(self.jazz.totals()[1:], (3, 180.0))
+        tested = []
+        rule = self.jazz.rule
+        self.jazz.rule.matches = lambda t, history, now: tested.append(t.file) or rule.test(t, history, now)
+
+        tracks = self.tracks[1:] + [track("0.flac", genre="Jazz"), track("9.flac", genre="Rock")]
+        changed = self.smart.index_changed(LibraryIndex((), tracks), NOW)
+
+        self.assertEqual(sorted(tested), ["0.flac", "9.flac"])
+        self.assertEqual(changed, [self.jazz, self.unheard])
+        self.assertEqual(self.jazz.files, {"0.flac", "1.flac", "3.flac", "5.flac"})
+        self.assertEqual([tracks[n].file for n in self.smart.resolve(self.jazz, NOW)[1]],
+                         ["1.flac", "3.flac", "5.flac", "0.flac"])
+
+        self.smart.index_changed(LibraryIndex((), tracks[2:]), NOW)
+        self.assertEqual(self.jazz.files, {"3.flac", "5.flac", "0.flac"})
+
+    def test_history_change(self):
+        generation = self.jazz.generation
+        self.history.add_listener(lambda files: self.assertEqual(self.smart.history_changed(files, NOW),
+                                                                 [self.unheard]))
+        self.history.record("3.flac", NOW)
+        self.assertNotIn("3.flac", self.unheard.files)
+        self.assertEqual(len(self.unheard.files), 5)
+        self.assertEqual(self.jazz.generation, generation)
+
+
+class TestSmartMenu(unittest.IsolatedAsyncioTestCase):
+    """
+    Show smart playlists in the Library, play them, and count what's played
+    """
+
+    async def asyncSetUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        os.mkdir("saved")
+        with open("smart.ini", 'w') as the_file:
+            the_file.write("[Jazz]\nrule = genre is Jazz\n[Unheard]\nrule = never played\n")
+
+        self.fake = FakeMPD([make_track("{}.flac".format(n), genre="Jazz" if n % 2 else "Rock") for n in range(6)])
+        self.pool = MPDPool('127.0.0.1', await self.fake.start())
+        await self.pool.connect()
+        self.library = LibraryComponent(SuperFavoritesComponent(), self.pool, smart_file="smart.ini")
+        self.changes = asyncio.Queue()
+        self.library.add_change_listener(self.changes.put_nowait)
+        await self.library.start()
+        self.mirror_task = asyncio.ensure_future(self.pool.mirror.run())
+        await asyncio.wait_for(self.changes.get(), 2)
+        await self.library.refresh_task
+
+    async def asyncTearDown(self):
+        self.mirror_task.cancel()
+        self.pool.disconnect()
+        await self.fake.stop()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    async def test_play_and_count(self):
+        jazz, unheard = self.library.smart_node.children
+        self.assertEqual(jazz.menu_labels['comment'], "3 tracks, 9m")
+        self.assertIs(self.library.opus_from_metadata(jazz.opus_get_metadata()), jazz)
+
+        await self.pool.command_list(jazz.opus_play_commands())
+        self.assertEqual([entry['track']['file'] for entry in self.fake.queue], ["1.flac", "3.flac", "5.flac"])
+
+        # Each song is counted as it starts, and the playlists that look at plays follow along
+        while self.library.history.plays("1.flac") == 0:
+            await asyncio.wait_for(self.changes.get(), 2)
+        self.assertEqual(unheard.menu_labels['comment'], "5 tracks, 15m")
+        await self.pool.run('next')
+        while self.library.history.plays("3.flac") == 0:
+            await asyncio.wait_for(self.changes.get(), 2)
+        self.assertEqual(self.library.history.plays("1.flac"), 1)
+        self.assertEqual(unheard.playlist.files, {"0.flac", "2.flac", "4.flac", "5.flac"})
+
+
+if __name__ == '__main__':
+    unittest.main()